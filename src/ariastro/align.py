@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from scipy import fft as sp_fft
+
+from .logger import logger
+from .rv import _refine_peak
+from .utils import get_header
+from .quicklook import decimate
+from .readers import DEFAULT_BLOCK_ROWS
+from .readers import GzipRowReader
+from .readers import is_gzipped
+from .readers import read_image
+from .readers import read_rows
+
+
+def _hann2d(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+
+
+def correlation_surfaces(frames, reference, whiten=True):
+    """
+    Batched FFT (phase) correlation of frames with a reference.
+
+    Parameters
+    ----------
+    frames : numpy.ndarray
+        Stack of shape (nframes, ny, nx).
+    reference : numpy.ndarray
+        Reference of shape (ny, nx).
+    whiten : bool, optional
+        Normalize the cross-power spectrum to unit amplitude (phase
+        correlation). Default is True.
+
+    Returns
+    -------
+    numpy.ndarray
+        Correlation surfaces, shape (nframes, ny, nx). The peak of a
+        frame displaced by ``d`` from the reference is at ``d`` (modulo
+        the size).
+    """
+    shape = reference.shape
+    window = _hann2d(shape)
+    frames = np.nan_to_num(frames - np.nanmean(frames, axis=(1, 2),
+                                               keepdims=True))
+    reference = np.nan_to_num(reference - np.nanmean(reference))
+    cross = sp_fft.rfft2(frames * window) \
+        * np.conj(sp_fft.rfft2(reference * window))
+    if whiten:
+        cross /= np.maximum(np.abs(cross), np.finfo(float).tiny)
+    return sp_fft.irfft2(cross, s=shape)
+
+
+def peak_offsets(surfaces):
+    """
+    Sub-pixel peak position of every correlation surface, as (dy, dx)
+    offsets in ``[-n/2, n/2)``.
+    """
+    nframes, ny, nx = surfaces.shape
+    flat = surfaces.reshape(nframes, -1).argmax(axis=1)
+    iy, ix = np.unravel_index(flat, (ny, nx))
+    frames = np.arange(nframes)
+    offsets = np.empty((nframes, 2))
+    for axis, (index, size) in enumerate(((iy, ny), (ix, nx))):
+        samples = []
+        for step in (-1, 0, 1):
+            if axis == 0:
+                samples.append(surfaces[frames, (iy + step) % ny, ix])
+            else:
+                samples.append(surfaces[frames, iy, (ix + step) % nx])
+        refined = _refine_peak(np.stack(samples, axis=-1),
+                               np.ones(nframes, dtype=int)) - 1 + index
+        offsets[:, axis] = (refined + size / 2) % size - size / 2
+    return offsets
+
+
+def _cutout(fname, ext, shape, center, size):
+    """Rows and columns ``center +- size/2`` of an image, zero padded."""
+    lo = np.round(np.asarray(center) - np.asarray(size) / 2).astype(int)
+    hi = lo + np.asarray(size)
+    out = np.zeros(size)
+    rlo, rhi = max(lo[0], 0), min(hi[0], shape[0])
+    clo, chi = max(lo[1], 0), min(hi[1], shape[1])
+    if rlo < rhi and clo < chi:
+        out[rlo - lo[0]:rhi - lo[0], clo - lo[1]:chi - lo[1]] = \
+            read_rows(fname, ext, rlo, rhi)[:, clo:chi]
+    return out
+
+
+def estimate_shifts(files, ext=0, reference=0, factor=4, cutout=256,
+                    batch=16, workers=4):
+    """
+    Estimate the shifts that register frames onto a reference frame.
+
+    The frames are block-averaged by `factor` and phase-correlated with
+    the reference in batches of `batch` frames (one FFT call per batch).
+    The coarse offsets are then refined at full resolution on a central
+    cutout of `cutout` pixels, taken at the coarse offset in every frame,
+    again in batched FFTs.
+
+    Parameters
+    ----------
+    files : list of str
+        Input frames.
+    ext : int, optional
+        Image extension. Default is 0.
+    reference : int, optional
+        Position of the reference frame in `files`. Default is 0.
+    factor : int, optional
+        Downsampling factor of the coarse stage. Default is 4.
+    cutout : int, optional
+        Size of the full-resolution cutout of the fine stage. Default is
+        256.
+    batch : int, optional
+        Frames per FFT batch. Default is 16.
+    workers : int, optional
+        Number of reader threads. Default is 4.
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape (nframes, 2). Row ``i`` is the (dy, dx) shift that moves
+        frame ``i`` onto the reference, as used by ``scipy.ndimage.shift``.
+    """
+    files = list(files)
+    header = get_header(files[reference], ext=ext)
+    shape = (header['NAXIS2'], header['NAXIS1'])
+
+    def small(fname):
+        return decimate(read_image(fname, ext=ext), factor, mode='bin')
+
+    offsets = np.empty((len(files), 2))
+    ref_small = small(files[reference])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(files), batch):
+            frames = np.array(list(pool.map(small,
+                                            files[start:start + batch])))
+            offsets[start:start + batch] = peak_offsets(
+                correlation_surfaces(frames, ref_small)) * factor
+
+        size = (min(cutout, shape[0]), min(cutout, shape[1]))
+        center = np.array(shape) / 2
+        ref_cut = _cutout(files[reference], ext, shape, center, size)
+        for start in range(0, len(files), batch):
+            chunk = range(start, min(start + batch, len(files)))
+            coarse = np.round(offsets[list(chunk)])
+            frames = np.array(list(pool.map(
+                lambda item: _cutout(files[item[0]], ext, shape,
+                                     center + item[1], size),
+                zip(chunk, coarse))))
+            offsets[list(chunk)] = coarse + peak_offsets(
+                correlation_surfaces(frames, ref_cut))
+    offsets[reference] = 0.0
+    logger.info("Frame offsets: {}".format(offsets.round(2).tolist()))
+    return -offsets
+
+
+def iter_shifted_blocks(fname, ext, shift, block_rows=DEFAULT_BLOCK_ROWS,
+                        order=1):
+    """
+    Read an image extension in blocks of rows, shifted by `shift`.
+
+    Every block is read with the margin the shift needs and interpolated
+    with ``scipy.ndimage.shift``; pixels that depend on data from outside
+    the image (or on NaNs) are NaN, so NaN-aware combines ignore them.
+    Nothing is written to disk.
+
+    Parameters
+    ----------
+    fname : str
+        Input frame.
+    ext : int
+        Image extension.
+    shift : tuple of float
+        (dy, dx) shift, e.g. a row of `estimate_shifts`.
+    block_rows : int, optional
+        Rows per block.
+    order : int, optional
+        Spline order of the interpolation. Default is 1 (bilinear), which
+        keeps NaNs local.
+
+    Yields
+    ------
+    start, stop, block
+        As `ariastro.readers.iter_row_blocks`.
+    """
+    header = get_header(fname, ext=ext)
+    nrows = header['NAXIS2']
+    dy, dx = shift
+    margin = order + 1
+    # The windows of consecutive blocks move forward and overlap: a
+    # gzipped frame is streamed once instead of once per block.
+    rows = GzipRowReader(fname, ext) if is_gzipped(fname) else None
+    try:
+        for start in range(0, nrows, block_rows):
+            stop = min(start + block_rows, nrows)
+            lo = int(np.floor(start - dy)) - margin
+            hi = int(np.ceil(stop - dy)) + margin
+            window = np.full((hi - lo, header['NAXIS1']), np.nan)
+            rlo, rhi = max(lo, 0), min(hi, nrows)
+            if rlo < rhi:
+                window[rlo - lo:rhi - lo] = (
+                    read_rows(fname, ext, rlo, rhi) if rows is None
+                    else rows.read(rlo, rhi))
+            # Row k of the block is input row start + k - dy, i.e. row
+            # k + (start - dy - lo) of the window. Values and validity are
+            # interpolated separately, so that a NaN with zero weight does
+            # not spread.
+            valid = np.isfinite(window)
+            offset = (lo + dy - start, dx)
+            shifted = ndimage.shift(np.where(valid, window, 0.0), offset,
+                                    order=order, mode='constant', cval=0.0,
+                                    prefilter=order > 1)
+            weight = ndimage.shift(valid.astype(np.float64), offset,
+                                   order=order, mode='constant', cval=0.0,
+                                   prefilter=order > 1)
+            block = np.where(weight > 1 - 1e-6, shifted, np.nan)
+            yield start, stop, block[:stop - start]
+    finally:
+        if rows is not None:
+            rows.close()
+
+# End
@@ -4,12 +4,16 @@ import logging
 
 
 from .logger import logger
+from .logger import configure_logging
 
 from .setups import read_args
 
 
 from .handle_frame import operate_process
+from .handle_frame import operate_batch
 from .handle_frame import combine_process
+from .cube import build_cube
+from .calibration import CalibrationLibrary
 
 
 def setup_logging():
@@ -33,10 +37,48 @@ def process_inputs(file2: str):
         return file2
 
 
+def run_service(args):
+    # Imported here so the one-shot modes do not pay for it.
+    from .service import WatchService
+
+    operand = args.operand
+    if operand is not None:
+        operand = process_inputs(operand)
+    service = WatchService(args.directory,
+                           outdir=args.outdir,
+                           pattern=args.pattern,
+                           operation=args.operator,
+                           operand=operand,
+                           cosmic=args.cosmic,
+                           combine=args.combine,
+                           combine_every=args.combine_every,
+                           fluxext=args.flux,
+                           varext=args.var,
+                           workers=args.workers,
+                           poll_interval=args.poll,
+                           status_file=args.status_file,
+                           backend=args.backend)
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        logger.info("Stopping the service")
+    finally:
+        service.stop()
+
+
 def main():
     parser = read_args()
-    print(parser)
     args = parser.parse_args()
+    configure_logging()
+    if args.mode == 'watch':
+        run_service(args)
+        return
+    if args.mode == 'pipeline':
+        from .pipeline import Pipeline
+        status = Pipeline.from_file(args.config,
+                                    workers=args.workers).run(args.force)
+        logger.info("Pipeline finished: {}".format(status))
+        return
     fnames = args.fnames
     logger.info("Starting the pipeline")
     logger.info("Flux extensions: {}".format(args.flux))
@@ -46,14 +88,61 @@ def main():
         logger.info("Wavelength extensions: {}".format(args.wl))
 
     if args.mode == 'combine':
-        print(fnames)
+        logger.info("Input files: {}".format(fnames))
         combine_process(fnames,
                         args.output,
                         method=args.method,
                         fluxext=args.flux,
                         varext=args.var,
-                        instrument=args.instrument
+                        instrument=args.instrument,
+                        backend=args.backend,
+                        checkpoint_dir=args.checkpoint_dir,
+                        quicklook=args.quicklook,
+                        quicklook_mode=args.quicklook_mode,
+                        output_format=args.output_format,
+                        chunk_rows=args.chunk_rows,
+                        subset=args.subset,
+                        uncertainty=args.uncertainty,
+                        align=args.align,
+                        scale=args.scale,
+                        offset=args.offset,
+                        exptime_key=args.exptime_key,
+                        orders=args.orders,
+                        wl_range=args.wl_range,
+                        velocity=args.velocity,
+                        diagnostics=args.diagnostics,
+                        crreject=args.crreject,
+                        cr_threshold=args.cr_threshold,
+                        cr_grow=args.cr_grow,
+                        crmask_dir=args.crmask_dir,
+                        wl_mask=args.wl_mask
                         )
+    elif args.mode == 'calibrate':
+        with CalibrationLibrary(args.library,
+                                fluxext=args.flux,
+                                varext=args.var,
+                                backend=args.backend) as library:
+            if args.calib_frames is not None:
+                library.build(args.calib_frames, method=args.method)
+            library.calibrate(fnames, args.output)
+    elif args.mode == 'indices':
+        from .indices import measure_indices_files
+        measure_indices_files(fnames, args.output,
+                              instrumentname=args.instrument,
+                              lines=args.lines)
+    elif args.mode == 'stack':
+        build_cube(fnames, args.output,
+                   fluxext=args.flux,
+                   varext=args.var)
+    elif args.mode == 'operation' and args.template is not None:
+        operate_batch(fnames[:-1], process_inputs(fnames[-1]),
+                      args.template,
+                      operation=args.operator,
+                      fluxext=args.flux,
+                      varext=args.var,
+                      outdir=args.output,
+                      workers=args.workers,
+                      backend=args.backend)
     elif args.mode == 'operation':
         file1, file2 = fnames
 
@@ -62,7 +151,10 @@ def main():
                         args.output,
                         args.operator,
                         args.flux,
-                        args.var)
+                        args.var,
+                        backend=args.backend,
+                        quicklook=args.quicklook,
+                        quicklook_mode=args.quicklook_mode)
 
 
 if __name__ == '__main__':
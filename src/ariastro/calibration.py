@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+import json
+import hashlib
+import threading
+from pathlib import Path
+from datetime import date as Date
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from .logger import logger
+from .utils import get_header
+from .operations import ari_operations_out
+from .checkpoint import _atomic_write_text
+from .handle_frame import combine_blocks
+from .readers import DEFAULT_BLOCK_ROWS
+from .readers import iter_row_blocks
+
+CALIB_KINDS = ('bias', 'dark', 'flat')
+TYPE_VALUES = {'bias': ('BIAS', 'ZERO'),
+               'dark': ('DARK',),
+               'flat': ('FLAT', 'FLATFIELD', 'DOMEFLAT', 'SKYFLAT')}
+CONFIG_KEYS = ('INSTRUME', 'DETECTOR', 'CCDSUM', 'GAIN', 'READMODE')
+FLAT_KEYS = ('FILTER',)
+
+
+def frame_kind(header, type_key='IMAGETYP'):
+    """
+    Calibration kind ('bias', 'dark' or 'flat') of a raw frame from its
+    `type_key` keyword, or None for any other frame.
+    """
+    value = str(header.get(type_key, '')).strip().upper()
+    for kind, values in TYPE_VALUES.items():
+        if value in values:
+            return kind
+    return None
+
+
+def observing_date(header):
+    """Date (``YYYY-MM-DD``) of ``DATE-OBS``."""
+    if 'DATE-OBS' not in header:
+        raise ValueError("DATE-OBS is missing from the header")
+    return str(header['DATE-OBS'])[:10]
+
+
+def frame_config(header, kind, shape):
+    """
+    Configuration a master of `kind` must match: the detector keywords
+    present in `header` (plus ``FILTER`` for flats) and the image shape.
+    """
+    keys = CONFIG_KEYS + (FLAT_KEYS if kind == 'flat' else ())
+    config = {key: str(header[key]) for key in keys if key in header}
+    config['SHAPE'] = 'x'.join(str(size) for size in shape)
+    return config
+
+
+class CalibrationLibrary:
+    """
+    Master bias, dark and flat frames, keyed by date and configuration.
+
+    Masters are built from raw frames selected by their headers and saved
+    as FITS files in `directory`, with a JSON index. For every science
+    frame the closest master in date with the same configuration is used.
+    Loaded masters are kept in memory (or memmapped) between frames; the
+    files of memmapped masters stay open until the master is rebuilt or
+    :meth:`close` is called.
+
+    - A master bias is the combine of the raw bias frames.
+    - A master dark is the combine of the bias-subtracted darks divided by
+      their exposure time, i.e. a dark current per second, scaled to the
+      exposure time of the frame it is applied to.
+    - A master flat is the combine of the bias- and dark-subtracted flats,
+      normalized by its median.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory of the library.
+    fluxext : list of int, optional
+        Image extensions. Default is ``[0]``.
+    varext : list of int or None, optional
+        Variance extensions of the raw frames. Default is None.
+    type_key : str, optional
+        Header keyword giving the frame type. Default is ``'IMAGETYP'``.
+    exptime_key : str, optional
+        Header keyword of the exposure time. Default is ``'EXPTIME'``.
+    memmap : bool, optional
+        Memmap the masters instead of loading them. Default is False.
+    block_rows : int, optional
+        Rows processed at once.
+    workers : int, optional
+        Number of threads. Default is 4.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend of the combines and of the variance propagation.
+    """
+
+    index_name = "index.json"
+
+    def __init__(self, directory, fluxext=[0], varext=None,
+                 type_key='IMAGETYP', exptime_key='EXPTIME',
+                 memmap=False, block_rows=DEFAULT_BLOCK_ROWS, workers=4,
+                 backend='numpy'):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fluxext = [int(ext) for ext in np.atleast_1d(fluxext)]
+        self.varext = None if varext is None \
+            else [int(ext) for ext in varext]
+        self.type_key = type_key
+        self.exptime_key = exptime_key
+        self.memmap = memmap
+        self.block_rows = block_rows
+        self.workers = workers
+        self.backend = backend
+        self.index_path = self.directory / self.index_name
+        self.records = []
+        if self.index_path.exists():
+            with open(self.index_path) as fobj:
+                self.records = json.load(fobj)
+        self._masters = {}
+        self._lock = threading.Lock()
+
+    def describe(self, fname):
+        """Return the primary header and the image shape of `fname`."""
+        header = get_header(fname, ext=0)
+        fluxheader = get_header(fname, ext=self.fluxext[0])
+        shape = tuple(fluxheader['NAXIS{}'.format(i)]
+                      for i in range(fluxheader['NAXIS'], 0, -1))
+        return header, shape
+
+    def find(self, kind, header, shape):
+        """
+        Record of the master of `kind` for a frame with `header` and
+        `shape`: same configuration, closest date. None if there is none.
+        """
+        config = frame_config(header, kind, shape)
+        day = Date.fromisoformat(observing_date(header))
+        candidates = [record for record in self.records
+                      if record['kind'] == kind
+                      and record['config'] == config]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda record: abs(
+            (Date.fromisoformat(record['date']) - day).days))
+
+    def load(self, record):
+        """
+        Master arrays of `record`: ``(datas, variances)``, one entry per
+        flux extension (``variances`` is None without variance).
+        """
+        if record is None:
+            return None
+        path = self.directory / record['file']
+        with self._lock:
+            if path not in self._masters:
+                self._masters[path] = self._read_master(path)
+            return self._masters[path][1]
+
+    def _evict(self, path):
+        hdul, _ = self._masters.pop(path, (None, None))
+        if hdul is not None:
+            hdul.close()
+
+    def close(self):
+        """Drop the loaded masters and close the memmapped files."""
+        with self._lock:
+            for path in list(self._masters):
+                self._evict(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_master(self, path):
+        """
+        ``(hdul, (datas, variances))`` of the master `path`; `hdul` is the
+        open HDUList of the memmapped arrays, or None if they were loaded.
+        """
+        hdul = fits.open(path, memmap=self.memmap)
+        names = [hdu.name for hdu in hdul]
+        datas, variances = [], []
+        for index in range(len(self.fluxext)):
+            datas.append(hdul['MASTER', index + 1].data)
+            if 'VARIANCE' in names:
+                variances.append(hdul['VARIANCE', index + 1].data)
+        if not self.memmap:
+            datas = [np.array(data) for data in datas]
+            variances = [np.array(var) for var in variances]
+            hdul.close()
+            hdul = None
+        return hdul, (datas, variances or None)
+
+    def build(self, files, method='median'):
+        """
+        Sort raw calibration frames by kind, date and configuration and
+        build every master: biases first, then darks, then flats.
+
+        Returns
+        -------
+        list of Path
+            Master files written.
+        """
+        groups = {}
+        for fname in files:
+            header, shape = self.describe(fname)
+            kind = frame_kind(header, self.type_key)
+            if kind is None:
+                continue
+            key = (kind, observing_date(header),
+                   json.dumps(frame_config(header, kind, shape),
+                              sort_keys=True))
+            groups.setdefault(key, []).append(fname)
+        built = []
+        for kind in CALIB_KINDS:
+            for key in sorted(groups):
+                if key[0] == kind:
+                    built.append(self.build_master(kind, groups[key],
+                                                   method=method))
+        return built
+
+    def build_master(self, kind, files, method='median'):
+        """
+        Build the master of `kind` from `files` and add it to the library.
+
+        Darks are bias-subtracted, flats are bias- and dark-subtracted
+        with the masters already in the library, frame by frame and block
+        by block while they are combined.
+
+        Returns
+        -------
+        Path
+            Master file.
+        """
+        if kind not in CALIB_KINDS:
+            raise ValueError(f"Unsupported calibration kind '{kind}'.")
+        header, shape = self.describe(files[0])
+        date = observing_date(header)
+        config = frame_config(header, kind, shape)
+        exptimes = [float(get_header(fname, ext=0).get(self.exptime_key, 0))
+                    for fname in files]
+        bias = dark = None
+        if kind != 'bias':
+            bias = self.load(self.find('bias', header, shape))
+        if kind == 'flat':
+            dark = self.load(self.find('dark', header, shape))
+        if kind == 'dark' and min(exptimes) <= 0:
+            raise ValueError("Darks need a positive {}".format(
+                self.exptime_key))
+
+        hdul = fits.HDUList([fits.PrimaryHDU(header=header.copy())])
+        hdul[0].header[self.type_key] = 'MASTER ' + kind.upper()
+        hdul[0].header['NCOMBINE'] = (len(files), 'Number of raw frames')
+        hdul[0].header['HISTORY'] = method + str([Path(fname).name
+                                                  for fname in files])
+        for index, ext in enumerate(self.fluxext):
+            vext = None if self.varext is None else self.varext[index]
+
+            def preprocess(frame, start, stop, data, var):
+                data = np.array(data, dtype=np.float64)
+                if var is not None:
+                    var = np.array(var, dtype=np.float64)
+                data, var = self.apply_block(data, var, index, start, stop,
+                                             exptimes[frame], bias, dark)
+                if kind == 'dark':
+                    ari_operations_out(data, exptimes[frame], var, None,
+                                       operation='/', inplace=True,
+                                       backend=self.backend)
+                return data, var
+
+            result, variance = combine_blocks(files, ext, vext,
+                                              method=method,
+                                              block_rows=self.block_rows,
+                                              workers=self.workers,
+                                              backend=self.backend,
+                                              preprocess=preprocess)
+            if kind == 'flat':
+                norm = np.nanmedian(result)
+                ari_operations_out(result, norm, variance, None,
+                                   operation='/', inplace=True,
+                                   backend=self.backend)
+            hdul.append(fits.ImageHDU(result, name='MASTER',
+                                      ver=index + 1))
+            if variance is not None:
+                hdul.append(fits.ImageHDU(variance, name='VARIANCE',
+                                          ver=index + 1))
+
+        key = hashlib.sha1(json.dumps(config, sort_keys=True)
+                           .encode()).hexdigest()[:8]
+        fname = "{}_{}_{}.fits".format(kind, date, key)
+        with self._lock:
+            self._evict(self.directory / fname)
+        hdul.writeto(self.directory / fname, overwrite=True)
+        self.records = [record for record in self.records
+                        if record['file'] != fname]
+        self.records.append({'kind': kind, 'date': date, 'config': config,
+                             'file': fname, 'nframes': len(files),
+                             'method': method})
+        _atomic_write_text(self.index_path,
+                           json.dumps(self.records, indent=1))
+        logger.info("Master {} {} built from {} frames".format(
+            kind, fname, len(files)))
+        return self.directory / fname
+
+    def apply_block(self, data, var, index, start, stop, exptime,
+                    bias=None, dark=None, flat=None):
+        """
+        Calibrate rows ``start:stop`` of flux extension number `index`, in
+        place: subtract the bias, subtract the dark scaled to `exptime`,
+        divide by the flat. The variance is propagated with
+        `ari_operations_out` when `var` is given.
+
+        Returns
+        -------
+        data, var : numpy.ndarray
+        """
+        def master_var(master):
+            if var is None or master[1] is None:
+                return None
+            return master[1][index][start:stop]
+
+        if bias is not None:
+            ari_operations_out(data, bias[0][index][start:stop], var,
+                               master_var(bias), operation='-',
+                               inplace=True, backend=self.backend)
+        if dark is not None and exptime > 0:
+            dark_var = master_var(dark)
+            if dark_var is not None:
+                dark_var = dark_var * exptime**2
+            ari_operations_out(data, dark[0][index][start:stop] * exptime,
+                               var, dark_var, operation='-', inplace=True,
+                               backend=self.backend)
+        if flat is not None:
+            ari_operations_out(data, flat[0][index][start:stop], var,
+                               master_var(flat), operation='/',
+                               inplace=True, backend=self.backend)
+        return data, var
+
+    def calibrate_frame(self, fname, opfilename):
+        """
+        Calibrate one science frame with the matching masters and write
+        it to `opfilename`. Returns the records of the masters used.
+        """
+        header, shape = self.describe(fname)
+        exptime = float(header.get(self.exptime_key, 0))
+        records = {kind: self.find(kind, header, shape)
+                   for kind in CALIB_KINDS}
+        missing = [kind for kind, record in records.items()
+                   if record is None]
+        if missing:
+            logger.warning("No master {} for {}".format(missing, fname))
+        masters = {kind: self.load(record)
+                   for kind, record in records.items()}
+
+        hdul = fits.HDUList([fits.PrimaryHDU()])
+        for index, ext in enumerate(self.fluxext):
+            vext = None if self.varext is None else self.varext[index]
+            blocks = iter_row_blocks(fname, ext, self.block_rows)
+            vblocks = None if vext is None \
+                else iter_row_blocks(fname, vext, self.block_rows)
+            result = np.empty(shape)
+            variance = None if vext is None else np.empty(shape)
+            for start, stop, data in blocks:
+                data = np.array(data, dtype=np.float64)
+                var = None
+                if vblocks is not None:
+                    var = np.array(next(vblocks)[2], dtype=np.float64)
+                self.apply_block(data, var, index, start, stop, exptime,
+                                 masters['bias'], masters['dark'],
+                                 masters['flat'])
+                result[start:stop] = data
+                if variance is not None:
+                    variance[start:stop] = var
+            extheader = get_header(fname, ext=ext)
+            for kind, record in records.items():
+                if record is not None:
+                    extheader['HISTORY'] = "{} {}".format(kind,
+                                                          record['file'])
+            if ext == 0:
+                hdul[0] = fits.PrimaryHDU(result, header=extheader)
+            else:
+                hdul.append(fits.ImageHDU(result, header=extheader,
+                                          name="FLUX"))
+            if variance is not None:
+                hdul.append(fits.ImageHDU(variance,
+                                          header=get_header(fname, ext=vext),
+                                          name="VARIANCE"))
+        hdul.writeto(opfilename, overwrite=True)
+        return records
+
+    def calibrate(self, files, outdir, suffix='_cal'):
+        """
+        Calibrate many science frames in parallel.
+
+        Each frame is read once, block of rows by block of rows, and
+        written to ``<outdir>/<stem><suffix>.fits``.
+
+        Returns
+        -------
+        list of Path
+            Calibrated frames.
+        """
+        outdir = Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        outputs = [outdir / "{}{}.fits".format(
+            Path(fname).name.split('.')[0], suffix) for fname in files]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self.calibrate_frame, files, outputs))
+        logger.info("Calibrated {} frames into {}".format(len(files),
+                                                          outdir))
+        return outputs
+
+# End
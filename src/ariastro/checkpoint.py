@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from .logger import logger
+
+
+def file_identity(fname):
+    """
+    Identify a file by its resolved path, size and modification time.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Path to the file.
+
+    Returns
+    -------
+    dict
+        ``{'path': str, 'size': int, 'mtime_ns': int}``.
+    """
+    fname = Path(fname).resolve()
+    stat = fname.stat()
+    return {'path': str(fname), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def _atomic_write_text(fname, text):
+    tmpname = '{}.tmp'.format(fname)
+    with open(tmpname, 'w') as fobj:
+        fobj.write(text)
+    os.replace(tmpname, fname)
+
+
+def _atomic_savez(fname, **arrays):
+    tmpname = '{}.tmp.npz'.format(fname)
+    np.savez(tmpname, **arrays)
+    os.replace(tmpname, fname)
+
+
+class CombineCheckpoint:
+    """
+    Scratch-directory checkpoint for long ``combine_spectra`` runs.
+
+    Every input file that has been preprocessed and resampled is saved as
+    an ``.npz`` file together with its headers and the header quantities
+    collected for the combine. The reference wavelength grid of the
+    resampling is saved once, so that the epochs processed after a resume
+    are resampled onto the same grid as the saved ones. A manifest journal
+    (one JSON line per event, appended) records the finished and the
+    quarantined files by their identity. A rerun with the same file list
+    and parameters maps to the same run directory and reuses the saved
+    epochs; files that changed on disk since they were saved are processed
+    again.
+
+    The combine itself is not checkpointed: the median and biweight need
+    all the samples of a pixel, so it runs on the stack of the saved
+    epochs at the end.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Scratch directory. A sub-directory is created for every run.
+    files : list of str or Path
+        Input files of the run.
+    params : dict
+        Parameters that change the preprocessed arrays (method,
+        extensions, instrument, ...). Must be JSON serializable.
+
+    Attributes
+    ----------
+    rundir : Path
+        Directory holding the checkpoint of this run.
+    manifest : dict
+        ``{'params': ..., 'files': {...}, 'quarantined': {...}}``.
+    """
+
+    manifest_name = "manifest.jsonl"
+    reference_name = "reference.npz"
+
+    def __init__(self, directory, files, params):
+        names = [str(Path(fname).resolve()) for fname in files]
+        runkey = hashlib.sha1(
+            json.dumps({'params': params, 'files': names},
+                       sort_keys=True, default=str).encode()
+        ).hexdigest()[:16]
+        self.rundir = Path(directory) / "combine_{}".format(runkey)
+        self.rundir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.rundir / self.manifest_name
+        self.manifest = {'params': params, 'files': {}, 'quarantined': {}}
+        if self.manifest_path.exists():
+            self._read_manifest()
+            logger.info("Resuming from checkpoint {} ({} files done)".format(
+                self.rundir, len(self.manifest['files'])))
+        else:
+            self._append({'params': params})
+
+    def _read_manifest(self):
+        with open(self.manifest_path) as fobj:
+            for line in fobj:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line cut by an interrupted run.
+                    continue
+                if 'params' in entry:
+                    continue
+                path = entry['record']['path']
+                if entry['event'] == 'saved':
+                    self.manifest['files'][path] = entry['record']
+                    self.manifest['quarantined'].pop(path, None)
+                else:
+                    self.manifest['quarantined'][path] = entry['record']
+
+    def _append(self, entry):
+        with open(self.manifest_path, 'a') as fobj:
+            fobj.write(json.dumps(entry, default=str) + '\n')
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+    def _is_current(self, record, fname):
+        try:
+            identity = file_identity(fname)
+        except OSError:
+            return False
+        return (record['size'] == identity['size']
+                and record['mtime_ns'] == identity['mtime_ns'])
+
+    def is_quarantined(self, fname):
+        """Return True if `fname` failed before and did not change since."""
+        record = self.manifest['quarantined'].get(
+            str(Path(fname).resolve()))
+        return record is not None and self._is_current(record, fname)
+
+    def load(self, fname):
+        """
+        Load the saved epoch of `fname`.
+
+        Returns
+        -------
+        tuple or None
+            ``(datadict, headerdict, qtys)`` if a current checkpoint
+            exists, otherwise None.
+        """
+        record = self.manifest['files'].get(str(Path(fname).resolve()))
+        if record is None or not self._is_current(record, fname):
+            return None
+        with np.load(self.rundir / record['arrays']) as arrays:
+            keys = [str(key) for key in arrays['keys']]
+            datadict = {}
+            for index, key in enumerate(keys):
+                name = 'arr_{}'.format(index)
+                datadict[key] = arrays[name] if name in arrays else None
+            headerdict = {key: fits.Header.fromstring(str(hdr))
+                          for key, hdr in zip(keys, arrays['headers'])}
+            qtys = json.loads(str(arrays['qtys']))
+        return datadict, headerdict, qtys
+
+    def save(self, fname, datadict, headerdict, qtys=None):
+        """
+        Save the preprocessed and resampled epoch of `fname`.
+
+        Parameters
+        ----------
+        fname : str or Path
+            Input file the arrays were produced from.
+        datadict : dict
+            Extension name to array (``None`` for empty HDUs).
+        headerdict : dict
+            Extension name to header.
+        qtys : dict or None, optional
+            Header quantities collected for the combine,
+            ``{extname: {keyword: value}}``.
+        """
+        identity = file_identity(fname)
+        keys = list(datadict.keys())
+        arrname = "{:05d}_{}.npz".format(len(self.manifest['files']),
+                                         Path(fname).name)
+        arrays = {'arr_{}'.format(index): datadict[key]
+                  for index, key in enumerate(keys)
+                  if datadict[key] is not None}
+        # The headers stay next to the arrays, the manifest only records
+        # the identity of the file.
+        arrays['keys'] = np.array(keys, dtype=str)
+        arrays['headers'] = np.array(
+            [headerdict[key].tostring() for key in keys], dtype=str)
+        arrays['qtys'] = np.array(json.dumps(qtys or {}, default=str))
+        _atomic_savez(self.rundir / arrname, **arrays)
+        identity['arrays'] = arrname
+        self.manifest['files'][identity['path']] = identity
+        self.manifest['quarantined'].pop(identity['path'], None)
+        self._append({'event': 'saved', 'record': identity})
+
+    def quarantine(self, fname, error):
+        """Record that `fname` failed with `error`."""
+        try:
+            identity = file_identity(fname)
+        except OSError:
+            identity = {'path': str(Path(fname).resolve()),
+                        'size': None, 'mtime_ns': None}
+        identity['error'] = repr(error)
+        self.manifest['quarantined'][identity['path']] = identity
+        self._append({'event': 'quarantined', 'record': identity})
+
+    def load_reference(self):
+        """
+        Reference wavelength arrays saved by :meth:`save_reference`, one
+        per wavelength extension, or None.
+        """
+        fname = self.rundir / self.reference_name
+        if not fname.exists():
+            return None
+        with np.load(fname) as arrays:
+            return [arrays['arr_{}'.format(index)]
+                    for index in range(len(arrays.files))]
+
+    def save_reference(self, ref_wl):
+        """Save the reference wavelength arrays of the resampling."""
+        _atomic_savez(self.rundir / self.reference_name,
+                      **{'arr_{}'.format(index): np.asarray(wl)
+                         for index, wl in enumerate(ref_wl)})
+
+    def remove(self):
+        """Delete the checkpoint of this run."""
+        shutil.rmtree(self.rundir, ignore_errors=True)
+
+# End
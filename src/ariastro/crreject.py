@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import warnings
+
+import numpy as np
+from scipy import ndimage
+
+MAD_TO_SIGMA = 1.4826
+MIN_FRAMES = 3
+
+
+def stack_outliers(dataarr, var=None, threshold=5.0):
+    """
+    Flag the positive outliers of a stack of aligned frames.
+
+    Every sample is compared with the median of its pixel over the stack.
+    The deviation is scaled by the standard deviation of the sample from
+    its variance, or without variance by the median absolute deviation of
+    the pixel (times 1.4826, and at least its median over the stack
+    section). Only positive deviations are flagged, as cosmic rays only
+    add charge.
+
+    Parameters
+    ----------
+    dataarr : array_like
+        Stack of shape (N, rows, cols).
+    var : array_like or None, optional
+        Variance stack of the same shape. Default is None.
+    threshold : float, optional
+        Rejection threshold in sigma. Default is 5.
+
+    Returns
+    -------
+    numpy.ndarray of bool
+        Flags, same shape as `dataarr`.
+    """
+    dataarr = np.asarray(dataarr, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'), \
+            warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(dataarr, axis=0)
+        deviation = dataarr - median
+        if var is None:
+            # The MAD of a few samples is noisy: it is floored by its
+            # median over the block.
+            sigma = MAD_TO_SIGMA * np.nanmedian(np.abs(deviation), axis=0)
+            sigma = np.fmax(sigma, np.nanmedian(sigma))
+        else:
+            sigma = np.sqrt(np.asarray(var, dtype=np.float64))
+        flags = deviation > threshold * sigma
+    return flags & (sigma > 0)
+
+
+def grow_flags(flags, grow=1):
+    """
+    Grow the flags of every frame of a stack to the neighboring pixels.
+
+    Parameters
+    ----------
+    flags : numpy.ndarray of bool
+        Flags of shape (N, rows, cols).
+    grow : int, optional
+        Number of pixels (8-connected) added around every flag. Default
+        is 1.
+
+    Returns
+    -------
+    numpy.ndarray of bool
+    """
+    if grow <= 0 or not flags.any():
+        return flags
+    structure = np.ones((1,) + (3,) * (flags.ndim - 1), dtype=bool)
+    return ndimage.binary_dilation(flags, structure=structure,
+                                   iterations=grow)
+
+
+class StackCosmicRays:
+    """
+    Stack-based cosmic-ray rejection of blocks of rows of aligned frames.
+
+    Calling the instance on an iterator of ``(start, stop, data, var)``
+    blocks (``data`` and ``var`` are lists with one array per frame, or
+    ``var`` is None) yields the same blocks with the cosmic rays set to
+    NaN in the data and in the variance, in one pass. The outliers of a
+    block are found with `stack_outliers` from the block alone; the
+    output is delayed by one block, so that the flags grow across the
+    block boundaries exactly as on the full frames.
+
+    Parameters
+    ----------
+    threshold : float, optional
+        Rejection threshold in sigma. Default is 5.
+    grow : int, optional
+        Growth of the flags in pixels. Default is 1.
+    keep_masks : bool, optional
+        Keep the flags of every block in `masks`. Default is False.
+
+    Attributes
+    ----------
+    counts : numpy.ndarray or None
+        Number of rejected pixels of every frame.
+    masks : list of tuple
+        ``(start, stop, flags)`` of every block, with `keep_masks`.
+    """
+
+    def __init__(self, threshold=5.0, grow=1, keep_masks=False):
+        self.threshold = threshold
+        self.grow = int(grow)
+        self.keep_masks = keep_masks
+        self.counts = None
+        self.masks = []
+
+    def __call__(self, blocks):
+        pending = None
+        # Flags of the rows just before the pending block.
+        previous = None
+        for start, stop, data, var in blocks:
+            flags = stack_outliers(data, var, self.threshold)
+            if pending is not None:
+                yield self._reject(pending, previous, flags)
+                context = pending[4] if previous is None \
+                    else np.concatenate([previous, pending[4]], axis=1)
+                previous = context[:, context.shape[1] - self.grow:]
+            pending = (start, stop, data, var, flags)
+        if pending is not None:
+            yield self._reject(pending, previous, None)
+
+    def _reject(self, pending, previous, following):
+        start, stop, data, var, flags = pending
+        nrows = flags.shape[1]
+        context = [flags]
+        offset = 0
+        if previous is not None:
+            context.insert(0, previous)
+            offset = previous.shape[1]
+        if following is not None:
+            context.append(following[:, :self.grow])
+        flags = grow_flags(np.concatenate(context, axis=1),
+                           self.grow)[:, offset:offset + nrows]
+        counts = flags.reshape(len(flags), -1).sum(axis=1)
+        self.counts = counts if self.counts is None \
+            else self.counts + counts
+        if self.keep_masks:
+            self.masks.append((start, stop, flags))
+        data = [np.where(mask, np.nan, frame)
+                for mask, frame in zip(flags, data)]
+        if var is not None:
+            var = [np.where(mask, np.nan, frame)
+                   for mask, frame in zip(flags, var)]
+        return start, stop, data, var
+
+    def frame_masks(self):
+        """Flags of the full frames, shape (N, rows, cols)."""
+        return np.concatenate([flags for _, _, flags in self.masks],
+                              axis=1)
+
+# End
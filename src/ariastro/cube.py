@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from .logger import logger
+from .utils import get_header
+from .operations import combine_data
+from .checkpoint import file_identity
+from .checkpoint import _atomic_write_text
+from .readers import DEFAULT_BLOCK_ROWS
+from .readers import aligned_block_rows
+from .readers import iter_row_blocks
+
+CUBE_MANIFEST = "manifest.json"
+
+
+def is_cube(path):
+    """Return True if `path` is a stack cube written by `build_cube`."""
+    return (Path(path) / CUBE_MANIFEST).is_file()
+
+
+def _image_shape(header):
+    return tuple(header['NAXIS{}'.format(i)]
+                 for i in range(header['NAXIS'], 0, -1))
+
+
+def build_cube(files, cubedir, fluxext=[0], varext=None,
+               block_rows=DEFAULT_BLOCK_ROWS, workers=4):
+    """
+    Transpose a set of frames into a pixel-major stack cube.
+
+    Every flux (and variance) extension is written to a memmapped
+    ``.npy`` array of shape ``image_shape + (nframes,)``, so the samples
+    of one pixel are contiguous and a block of image rows is one
+    contiguous chunk of the file. The frames are read once, block of rows
+    by block of rows (see `iter_row_blocks`). A JSON manifest records the
+    source files, their size and modification time, the extensions and
+    the headers of the first frame.
+
+    Parameters
+    ----------
+    files : list of str
+        Input FITS files (plain, tile-compressed or gzipped).
+    cubedir : str or Path
+        Output directory of the cube.
+    fluxext : list of int, optional
+        Flux extensions. Default is ``[0]``.
+    varext : list of int or None, optional
+        Variance extensions. Default is None.
+    block_rows : int, optional
+        Image rows read from every frame at once.
+    workers : int, optional
+        Number of reader threads. Default is 4.
+
+    Returns
+    -------
+    FrameCube
+        The cube just written.
+    """
+    files = [str(fname) for fname in files]
+    cubedir = Path(cubedir)
+    cubedir.mkdir(parents=True, exist_ok=True)
+    fluxext = [int(ext) for ext in np.atleast_1d(fluxext)]
+    varext = None if varext is None else [int(ext) for ext in varext]
+    exts = fluxext + (varext or [])
+    headers = {}
+    for ext in exts:
+        header = get_header(files[0], ext=ext)
+        headers[str(ext)] = header.tostring()
+        shape = _image_shape(header)
+        cube = np.lib.format.open_memmap(
+            cubedir / "ext_{}.npy".format(ext), mode='w+',
+            dtype=np.float64, shape=shape + (len(files),))
+        rows = aligned_block_rows(files, ext, block_rows)
+        readers = [iter_row_blocks(fname, ext, rows) for fname in files]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                blocks = list(pool.map(lambda reader: next(reader, None),
+                                       readers))
+                if blocks[0] is None:
+                    break
+                start, stop = blocks[0][:2]
+                cube[start:stop] = np.stack([block[2] for block in blocks],
+                                            axis=-1)
+        cube.flush()
+        del cube
+
+    manifest = {'files': [file_identity(fname) for fname in files],
+                'fluxext': fluxext, 'varext': varext,
+                'headers': headers}
+    _atomic_write_text(cubedir / CUBE_MANIFEST,
+                       json.dumps(manifest, indent=1))
+    logger.info("Stacked {} frames into {}".format(len(files), cubedir))
+    return FrameCube(cubedir)
+
+
+class FrameCube:
+    """
+    Read access to a stack cube written by `build_cube`.
+
+    Parameters
+    ----------
+    cubedir : str or Path
+        Directory of the cube.
+
+    Attributes
+    ----------
+    names : list of str
+        File names of the stacked frames, in stack order.
+    fluxext, varext : list of int
+        Extensions stored in the cube.
+    """
+
+    def __init__(self, cubedir):
+        self.cubedir = Path(cubedir)
+        with open(self.cubedir / CUBE_MANIFEST) as fobj:
+            self.manifest = json.load(fobj)
+        self.fluxext = self.manifest['fluxext']
+        self.varext = self.manifest['varext']
+        self.names = [Path(record['path']).name
+                      for record in self.manifest['files']]
+
+    def __len__(self):
+        return len(self.names)
+
+    def data(self, ext):
+        """Memmap of extension `ext`, shape ``image_shape + (nframes,)``."""
+        return np.load(self.cubedir / "ext_{}.npy".format(int(ext)),
+                       mmap_mode='r')
+
+    def header(self, ext):
+        """Header of extension `ext` of the first frame."""
+        return fits.Header.fromstring(self.manifest['headers'][str(ext)])
+
+    def stale(self):
+        """Return the source files that changed since they were stacked."""
+        changed = []
+        for record in self.manifest['files']:
+            try:
+                identity = file_identity(record['path'])
+            except OSError:
+                changed.append(record['path'])
+                continue
+            if (identity['size'], identity['mtime_ns']) != \
+                    (record['size'], record['mtime_ns']):
+                changed.append(record['path'])
+        return changed
+
+    def indices(self, subset=None):
+        """
+        Convert `subset` (frame names or positions) to stack positions.
+        None selects every frame.
+        """
+        if subset is None:
+            return list(range(len(self)))
+        indices = []
+        for item in subset:
+            if isinstance(item, str) and not item.isdigit():
+                if item not in self.names:
+                    raise ValueError("{} is not in the cube".format(item))
+                indices.append(self.names.index(item))
+            else:
+                indices.append(int(item))
+        return indices
+
+    def combine(self, ext, varext=None, method='mean', subset=None,
+                block_rows=DEFAULT_BLOCK_ROWS, backend='numpy',
+                uncertainty='propagate'):
+        """
+        Combine extension `ext` along the stack axis.
+
+        Parameters
+        ----------
+        ext : int
+            Flux extension.
+        varext : int or None, optional
+            Variance extension. Default is None.
+        method : str, optional
+            Combine method passed to `combine_data`. Default is ``'mean'``.
+        subset : list of str or int, optional
+            Frames to combine (names or positions). Default is all.
+        block_rows : int, optional
+            Image rows combined at once.
+        backend : {'numpy', 'numba', 'auto'}, optional
+            Kernel backend passed to `combine_data`.
+        uncertainty : {'propagate', 'bootstrap', 'jackknife'}, optional
+            Variance estimate passed to `combine_data`.
+
+        Returns
+        -------
+        result, variance : numpy.ndarray
+            Combined image and variance (None if `varext` is None and
+            `uncertainty` is ``'propagate'``).
+        """
+        indices = self.indices(subset)
+        whole = indices == list(range(len(self)))
+        data = self.data(ext)
+        var = None if varext is None else self.data(varext)
+        result = np.empty(data.shape[:-1])
+        variance = None
+        if var is not None or uncertainty != 'propagate':
+            variance = np.empty(data.shape[:-1])
+        for start in range(0, data.shape[0], block_rows):
+            stop = min(start + block_rows, data.shape[0])
+            block = data[start:stop] if whole \
+                else data[start:stop][..., indices]
+            vblock = None
+            if var is not None:
+                vblock = var[start:stop] if whole \
+                    else var[start:stop][..., indices]
+            # Reduced along the stack axis of the pixel-major block.
+            comb, comb_var = combine_data(block, vblock, method=method,
+                                          backend=backend,
+                                          uncertainty=uncertainty,
+                                          axis=-1)
+            result[start:stop] = comb
+            if variance is not None:
+                variance[start:stop] = comb_var
+        return result, variance
+
+
+def combine_cube(cubedir, opfilename, method='mean', subset=None,
+                 block_rows=DEFAULT_BLOCK_ROWS, backend='numpy',
+                 uncertainty='propagate'):
+    """
+    Combine the frames of a stack cube and write a FITS file.
+
+    The output has the same layout as the one of `combine_process`.
+
+    Parameters
+    ----------
+    cubedir : str or Path
+        Directory of the cube.
+    opfilename : str
+        Output FITS filename.
+    method : str, optional
+        Combine method. Default is ``'mean'``.
+    subset : list of str or int, optional
+        Frames to combine (names or positions). Default is all.
+    block_rows : int, optional
+        Image rows combined at once.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend passed to `combine_data`.
+    uncertainty : {'propagate', 'bootstrap', 'jackknife'}, optional
+        Variance estimate passed to `combine_data`.
+    """
+    cube = FrameCube(cubedir)
+    stale = cube.stale()
+    if stale:
+        logger.warning("Sources changed since stacking: {}".format(stale))
+    names = [cube.names[index] for index in cube.indices(subset)]
+    hdul = fits.HDUList([fits.PrimaryHDU()])
+    for index, ext in enumerate(cube.fluxext):
+        vext = None if cube.varext is None else cube.varext[index]
+        result, variance = cube.combine(ext, vext, method=method,
+                                        subset=subset,
+                                        block_rows=block_rows,
+                                        backend=backend,
+                                        uncertainty=uncertainty)
+        header = cube.header(ext)
+        header["HISTORY"] = method + str(names)
+        if ext == 0:
+            hdul[0] = fits.PrimaryHDU(result, header=header)
+        else:
+            hdul.append(fits.ImageHDU(result, header=header, name="FLUX"))
+        if variance is not None:
+            varheader = fits.Header() if vext is None \
+                else cube.header(vext)
+            varheader['VARMODE'] = (uncertainty, 'Variance estimate')
+            hdul.append(fits.ImageHDU(variance, header=varheader,
+                                      name="VARIANCE"))
+    hdul.writeto(opfilename, overwrite=True)
+
+# End
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+
+import numpy as np
+
+from .logger import logger
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+EPOCH_HEADER_KEYS = ('OBJECT', 'DATE-OBS', 'MJD-OBS', 'EXPTIME')
+
+
+def _format_from_name(filename):
+    suffix = Path(filename).suffix.lower()
+    if suffix in ('.h5', '.hdf5', '.hdf'):
+        return 'hdf5'
+    if suffix == '.zarr':
+        return 'zarr'
+    raise ValueError("Cannot infer the format of {}. Use .h5/.hdf5 or "
+                     ".zarr, or give the format.".format(filename))
+
+
+def _attr_value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value)
+    return str(value)
+
+
+def header_to_attrs(header):
+    """
+    Convert a FITS header into a dictionary of attribute values.
+
+    ``COMMENT`` and ``HISTORY`` cards are joined into one string each.
+    Values are converted to bool, int, float or str, which both HDF5 and
+    Zarr can store.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header or dict
+        Header to convert.
+
+    Returns
+    -------
+    dict
+    """
+    attrs = {}
+    if header is None:
+        return attrs
+    for key in ('COMMENT', 'HISTORY'):
+        if key in header:
+            attrs[key] = '\n'.join(str(card) for card in header[key])
+    for key, value in header.items():
+        if key in ('COMMENT', 'HISTORY', ''):
+            continue
+        attrs[key] = _attr_value(value)
+    return attrs
+
+
+class _Store:
+    """Minimal common interface to an HDF5 file or a Zarr group."""
+
+    def __init__(self, filename, fmt, mode):
+        self.fmt = fmt
+        if fmt == 'hdf5':
+            if h5py is None:
+                raise ImportError("HDF5 output needs h5py.")
+            self.root = h5py.File(filename, mode)
+        elif fmt == 'zarr':
+            if zarr is None:
+                raise ImportError("Zarr output needs zarr.")
+            self.root = zarr.open_group(str(filename), mode=mode)
+        else:
+            raise ValueError(f"Unsupported format '{fmt}'.")
+
+    def create(self, name, data, chunks, level):
+        if self.fmt == 'hdf5':
+            dset = self.root.create_dataset(
+                name, data=data, chunks=chunks, compression='gzip',
+                compression_opts=level, shuffle=True)
+        elif hasattr(self.root, 'create_array'):
+            from zarr.codecs import BloscCodec
+            dset = self.root.create_array(
+                name, shape=data.shape, chunks=chunks, dtype=data.dtype,
+                compressors=BloscCodec(cname='zstd', clevel=level,
+                                       shuffle='shuffle'))
+            dset[...] = data
+        else:
+            dset = self.root.create_dataset(name, data=data, chunks=chunks)
+        return dset
+
+    def close(self):
+        if self.fmt == 'hdf5':
+            self.root.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_spectra(datadict, headerdicts, filename, fmt=None,
+                   fluxext=(1, 2, 3), varext=(4, 5, 6), wlext=(7, 8, 9),
+                   epoch_names=None, chunk_epochs=16, chunk_pixels=1024,
+                   compression_level=4, header_keys=EPOCH_HEADER_KEYS):
+    """
+    Write spectra to a chunked, compressed HDF5 file or Zarr store.
+
+    Flux, variance and wavelength extensions are stored as
+    (epoch, order, pixel) datasets named after their extensions. A
+    combined spectrum is stored with a single epoch. Chunks hold
+    `chunk_epochs` epochs of one order and `chunk_pixels` pixels, so both
+    reading one order of all epochs and reading the time series of a few
+    pixels touch only a few chunks.
+
+    Parameters
+    ----------
+    datadict : dict
+        Extension name to array, as from `extract_allexts`,
+        `Handle_NEID.process_data`, or the per-epoch stack of
+        `combine_spectra`. Flux, variance and wavelength entries have the
+        shape (orders, pixels) or (epochs, orders, pixels).
+    headerdicts : dict or list of dict
+        Extension name to header, for one epoch or for every epoch.
+    filename : str or Path
+        Output file (``.h5``/``.hdf5`` or ``.zarr``).
+    fmt : {'hdf5', 'zarr'} or None, optional
+        Output format. Inferred from `filename` if None.
+    fluxext, varext, wlext : tuple of int, optional
+        Positions of the flux, variance and wavelength extensions in
+        ``datadict.keys()``. Defaults are the NEID layout.
+    epoch_names : list of str or None, optional
+        Name (e.g. input file name) of every epoch.
+    chunk_epochs, chunk_pixels : int, optional
+        Chunk size along epochs and pixels. Defaults are 16 and 1024.
+    compression_level : int, optional
+        Compression level. Default is 4.
+    header_keys : tuple of str, optional
+        Primary-header keywords stored for every epoch.
+
+    Notes
+    -----
+    Each dataset carries the header of its extension (first epoch) as
+    attributes, and the root carries the primary header. The per-epoch
+    values of `header_keys` are stored as ``EPOCH_<KEY>`` root attributes.
+    """
+    fmt = fmt or _format_from_name(filename)
+    if isinstance(headerdicts, dict):
+        headerdicts = [headerdicts]
+    keys = list(datadict.keys())
+    primary_key = list(headerdicts[0].keys())[0]
+
+    with _Store(filename, fmt, 'w') as store:
+        nepochs = 1
+        for ext in list(fluxext) + list(varext) + list(wlext):
+            name = keys[ext]
+            data = np.asarray(datadict[name])
+            if data.ndim == 2:
+                data = data[np.newaxis]
+            nepochs = data.shape[0]
+            chunks = (min(chunk_epochs, data.shape[0]), 1,
+                      min(chunk_pixels, data.shape[2]))
+            dset = store.create(str(name), data, chunks, compression_level)
+            dset.attrs.update(header_to_attrs(headerdicts[0].get(name)))
+
+        store.root.attrs.update(header_to_attrs(headerdicts[0][primary_key]))
+        store.root.attrs['NEPOCHS'] = nepochs
+        store.root.attrs['FLUXEXT'] = [str(keys[ext]) for ext in fluxext]
+        store.root.attrs['VAREXT'] = [str(keys[ext]) for ext in varext]
+        store.root.attrs['WLEXT'] = [str(keys[ext]) for ext in wlext]
+        if epoch_names is not None:
+            store.root.attrs['EPOCHS'] = [str(name) for name in epoch_names]
+        for key in header_keys:
+            values = [header[primary_key].get(key)
+                      for header in headerdicts]
+            if any(value is not None for value in values):
+                store.root.attrs['EPOCH_' + key] = [
+                    '' if value is None else _attr_value(value)
+                    for value in values]
+    logger.info("Exported {} epoch(s) to {}".format(nepochs, filename))
+
+
+def read_spectra(filename, name, epochs=None, orders=None, pixels=None,
+                 fmt=None):
+    """
+    Read a slice of an exported (epoch, order, pixel) dataset.
+
+    Only the chunks overlapping the slice are read and decompressed.
+
+    Parameters
+    ----------
+    filename : str or Path
+        File written by :func:`export_spectra`.
+    name : str
+        Dataset (extension) name, e.g. ``'SCIFLUX'``.
+    epochs, orders, pixels : slice, int or None, optional
+        Selection along each axis. Default is everything.
+    fmt : {'hdf5', 'zarr'} or None, optional
+        Format. Inferred from `filename` if None.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    fmt = fmt or _format_from_name(filename)
+    selection = tuple(slice(None) if sel is None else sel
+                      for sel in (epochs, orders, pixels))
+    with _Store(filename, fmt, 'r') as store:
+        return np.asarray(store.root[name][selection])
+
+
+def wavelength_slices(filename, wl_range, wlname=None, fmt=None):
+    """
+    Find the orders and pixels covering a wavelength range.
+
+    Only the wavelength grid of the first epoch is read.
+
+    Parameters
+    ----------
+    filename : str or Path
+        File written by :func:`export_spectra`.
+    wl_range : tuple of float
+        (minimum, maximum) wavelength.
+    wlname : str or None, optional
+        Wavelength dataset. Default is the first ``WLEXT`` entry.
+
+    Returns
+    -------
+    orders, pixels : slice
+        Selections to pass to :func:`read_spectra`.
+    """
+    fmt = fmt or _format_from_name(filename)
+    with _Store(filename, fmt, 'r') as store:
+        if wlname is None:
+            wlname = list(store.root.attrs['WLEXT'])[0]
+        wl = np.asarray(store.root[wlname][0])
+    inside = (wl >= wl_range[0]) & (wl <= wl_range[1])
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    if rows.size == 0:
+        raise ValueError("No pixel inside {}".format(wl_range))
+    return (slice(int(rows[0]), int(rows[-1]) + 1),
+            slice(int(cols[0]), int(cols[-1]) + 1))
+
+# End
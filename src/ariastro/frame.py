@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from .logger import logger
+from .utils import get_header
+from .readers import read_image
+from .operations import ari_operations_out
+from .operations import combine_data
+from .handle_frame import clean_cosmic_rays
+from .handle_frame import normalize_smoothgradient
+
+
+class Frame:
+    """
+    In-memory frame passed between processing steps.
+
+    The steps are the ones of the file-based commands (`operate_process`,
+    `divide_smoothgradient`, `remove_cosmic_rays`, `combine_process`) but
+    they work on arrays in memory and return the frame, so they can be
+    chained::
+
+        science = (Frame.read("sci.fits", ext=1, varext=2)
+                   .operate(Frame.read("bias.fits", ext=1, varext=2), '-')
+                   .divide_smoothgradient()
+                   .clean_cosmic_rays()
+                   .write("sci_reduced.fits"))
+
+    Nothing is written until `checkpoint` or `write` is called.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Image data.
+    var : numpy.ndarray or None, optional
+        Variance of `data`. Default is None.
+    mask : numpy.ndarray of bool or None, optional
+        Bad pixels (True). Default is None (no bad pixels).
+    header : astropy.io.fits.Header or None, optional
+        Header of the frame.
+    history : list of str, optional
+        Steps applied so far; written as HISTORY cards.
+    varheader : astropy.io.fits.Header or None, optional
+        Header of the variance extension.
+    """
+
+    def __init__(self, data, var=None, mask=None, header=None,
+                 history=None, varheader=None):
+        self.data = np.asarray(data, dtype=np.float64)
+        self.var = None if var is None else np.asarray(var, dtype=np.float64)
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+        self.header = fits.Header() if header is None else header.copy()
+        self.history = [] if history is None else list(history)
+        self.varheader = varheader
+        for name, arr in (('var', self.var), ('mask', self.mask)):
+            if arr is not None and arr.shape != self.data.shape:
+                raise ValueError("{} has shape {}, data has shape {}"
+                                 .format(name, arr.shape, self.data.shape))
+
+    @classmethod
+    def read(cls, fname, ext=0, varext=None, maskext=None):
+        """
+        Read a frame from a FITS file.
+
+        Parameters
+        ----------
+        fname : str
+            Input FITS file (plain, tile-compressed or gzipped).
+        ext : int, optional
+            Flux extension. Default is 0.
+        varext : int or None, optional
+            Variance extension. Default is None.
+        maskext : int or None, optional
+            Extension with the bad pixel mask (non-zero is bad).
+
+        Returns
+        -------
+        Frame
+        """
+        ext = int(ext)
+        var = None
+        varheader = None
+        if varext is not None:
+            var = read_image(fname, ext=int(varext))
+            varheader = get_header(fname, ext=int(varext))
+        mask = None
+        if maskext is not None:
+            mask = read_image(fname, ext=int(maskext)) != 0
+        return cls(read_image(fname, ext=ext), var=var, mask=mask,
+                   header=get_header(fname, ext=ext),
+                   history=['read {}[{}]'.format(Path(fname).name, ext)],
+                   varheader=varheader)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def name(self):
+        """Name of the source of the frame (first HISTORY step)."""
+        return self.history[0] if self.history else 'frame'
+
+    def copy(self):
+        """Return a deep copy of the frame."""
+        return Frame(self.data.copy(),
+                     None if self.var is None else self.var.copy(),
+                     None if self.mask is None else self.mask.copy(),
+                     self.header, self.history, self.varheader)
+
+    def _record(self, step):
+        self.history.append(step)
+        logger.info(step)
+
+    def operate(self, other, operation='+', backend='numpy'):
+        """
+        Apply an arithmetic operation with a frame, an array or a constant,
+        in place.
+
+        Parameters
+        ----------
+        other : Frame, numpy.ndarray or float
+            Second operand. Its variance is propagated and its mask is
+            merged if it is a Frame.
+        operation : {'+', '-', '*', '/'}, optional
+            Arithmetic operation. Default is ``'+'``.
+        backend : {'numpy', 'numba', 'auto'}, optional
+            Kernel backend passed to `ari_operations_out`.
+
+        Returns
+        -------
+        Frame
+            This frame.
+        """
+        if isinstance(other, Frame):
+            operand, var2, label = other.data, other.var, other.name
+            if other.mask is not None:
+                self.mask = other.mask.copy() if self.mask is None \
+                    else self.mask | other.mask
+        else:
+            operand, var2 = other, None
+            label = str(other) if np.ndim(other) == 0 else 'array'
+        if var2 is not None and self.var is None:
+            self.var = np.zeros_like(self.data)
+        ari_operations_out(self.data, operand, self.var, var2,
+                           operation=operation, inplace=True,
+                           backend=backend)
+        self._record('{} {}'.format(operation, label))
+        return self
+
+    def divide_smoothgradient(self, medsmoothsize=(25, 51)):
+        """
+        Divide by the median-smoothed background gradient, in place.
+        See `ariastro.handle_frame.divide_smoothgradient`.
+        """
+        self.data, self.var = normalize_smoothgradient(
+            self.data, self.var, medsmoothsize=medsmoothsize)
+        self._record('Divided median filter size: {}'.format(medsmoothsize))
+        return self
+
+    def clean_cosmic_rays(self):
+        """
+        Clean cosmic rays with astroscrappy, in place. The detected pixels
+        are added to the mask.
+        """
+        crmask, cleaned = clean_cosmic_rays(self.data, self.var)
+        self.data = np.asarray(cleaned, dtype=np.float64)
+        self.mask = crmask if self.mask is None else self.mask | crmask
+        self._record('Cosmic Rays removed with astroscrappy ({} pixels)'
+                     .format(int(crmask.sum())))
+        return self
+
+    def masked_data(self):
+        """Data with the masked pixels set to NaN."""
+        if self.mask is None or not self.mask.any():
+            return self.data
+        return np.where(self.mask, np.nan, self.data)
+
+    def to_hdulist(self):
+        """
+        Return the frame as an HDUList: the data in the primary HDU with
+        the HISTORY steps, then VARIANCE and MASK extensions if present.
+        """
+        header = self.header.copy()
+        for step in self.history:
+            header['HISTORY'] = step
+        hdul = fits.HDUList([fits.PrimaryHDU(self.data, header=header)])
+        if self.var is not None:
+            hdul.append(fits.ImageHDU(self.var, header=self.varheader,
+                                      name="VARIANCE"))
+        if self.mask is not None:
+            hdul.append(fits.ImageHDU(self.mask.astype(np.uint8),
+                                      name="MASK"))
+        return hdul
+
+    def write(self, fname):
+        """Write the frame to `fname`. Returns the frame."""
+        self.to_hdulist().writeto(fname, overwrite=True)
+        logger.info("Frame written to {}".format(fname))
+        return self
+
+    def checkpoint(self, fname):
+        """
+        Write the current state to `fname` and continue with the same
+        frame. The checkpoint is recorded in the history.
+        """
+        self.write(fname)
+        self.history.append('checkpoint {}'.format(Path(fname).name))
+        return self
+
+
+def combine_frames(frames, method='mean', backend='numpy',
+                   uncertainty='propagate'):
+    """
+    Combine in-memory frames into a new frame.
+
+    Masked pixels are ignored (set to NaN before the NaN-aware combine).
+
+    Parameters
+    ----------
+    frames : list of Frame
+        Frames of the same shape.
+    method : {'mean', 'median', 'biweight', 'weightedavg'}, optional
+        Combine method passed to `combine_data`. Default is ``'mean'``.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend passed to `combine_data`.
+    uncertainty : {'propagate', 'bootstrap', 'jackknife'}, optional
+        Variance estimate passed to `combine_data`.
+
+    Returns
+    -------
+    Frame
+        The combined frame, with the header of the first frame. Pixels
+        masked in every frame are masked. The history lists the steps of
+        every input, prefixed with its position, then the combine.
+    """
+    frames = list(frames)
+    if not frames:
+        raise ValueError("No frames to combine")
+    data = np.array([frame.masked_data() for frame in frames])
+    var = None
+    if all(frame.var is not None for frame in frames):
+        var = np.array([frame.var for frame in frames])
+    result, variance = combine_data(data, var, method=method,
+                                    backend=backend,
+                                    uncertainty=uncertainty)
+    mask = None
+    if any(frame.mask is not None for frame in frames):
+        mask = np.all([np.zeros(frame.shape, dtype=bool)
+                       if frame.mask is None else frame.mask
+                       for frame in frames], axis=0)
+    combined = Frame(result, variance, mask, header=frames[0].header,
+                     varheader=frames[0].varheader)
+    for index, frame in enumerate(frames):
+        combined.history.extend('[{}] {}'.format(index, step)
+                                for step in frame.history)
+    combined._record(method + str([frame.name for frame in frames]))
+    return combined
+
+# End
@@ -4,18 +4,46 @@ import numpy as np
 import astroscrappy
 from scipy.ndimage import filters
 
+import os
+import glob
+import contextvars
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
-from .operations import ari_operations
+from .readers import DEFAULT_BLOCK_ROWS
+from .readers import handle_pool
+from .readers import aligned_block_rows
+from .readers import is_compressed
+from .readers import iter_row_blocks
+from .readers import read_image
+from .operations import ari_operations_out
+from .logger import logger
+from .jobs import check_cancelled
+from .utils import get_header
 from .operations import combine_data
+from .operations import combine_diagnostics
 from .spectral_utils import combine_spectra
+from .quicklook import quicklook_operate
+from .quicklook import quicklook_process
+from .quicklook import quicklook_spectra
+from .cube import combine_cube
+from .cube import is_cube
+from .align import estimate_shifts
+from .align import iter_shifted_blocks
+from .normalize import frame_normalization
+from .crreject import MIN_FRAMES
+from .crreject import StackCosmicRays
 
 
 def operate_process(ip1, ip2,
                     opfilename,
                     operation='+',
                     fluxext=[0],
-                    varext=None):
+                    varext=None,
+                    backend='numpy',
+                    quicklook=None,
+                    quicklook_mode='stride'):
     """
     Perform arithmetic operations on FITS file extensions and write results.
 
@@ -45,13 +73,25 @@ def operate_process(ip1, ip2,
         List of extension numbers containing variance data corresponding to
         each entry in ``fluxext``. If ``None`` (default), variance propagation
         is skipped.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend passed to ``ari_operations_out``.
+        Default is ``'numpy'``.
+    quicklook : int or None, optional
+        Write a preview instead, with both operands decimated by this
+        factor (see ``ariastro.quicklook.quicklook_operate``). Default is
+        ``None``.
+    quicklook_mode : {'stride', 'bin'}, optional
+        Decimation of the quick-look preview. Default is ``'stride'``.
 
     Notes
     -----
     - For each extension in ``fluxext``:
 
-      1. Data are read from ``ip1`` and ``ip2``.
-      2. The operation is applied using ``ari_operations``.
+      1. Data are read from ``ip1`` and ``ip2``. Tile-compressed inputs
+         are decompressed over several threads and gzipped inputs are
+         streamed (see ``ariastro.readers``).
+      2. The operation is applied using ``ari_operations_out``, which
+         propagates the variance in the same pass.
       3. Results are stored in the output HDUList.
       4. If ``varext`` is provided, the corresponding variance extensions are
          also operated on and appended to the output.
@@ -82,36 +122,69 @@ def operate_process(ip1, ip2,
                         fluxext=[1, 2], varext=[3, 4])
     """
 
+    if quicklook is not None:
+        quicklook_operate(ip1, ip2, opfilename, factor=int(quicklook),
+                          mode=quicklook_mode, operation=operation,
+                          fluxext=fluxext, varext=varext, backend=backend)
+        return
+    label = ip2 if isinstance(ip2, float) else Path(ip2).name
+    _operate_file(ip1, _load_operand(ip2, fluxext, varext), label,
+                  opfilename, operation=operation, fluxext=fluxext,
+                  varext=varext, backend=backend)
+
+
+def _load_operand(ip2, fluxext, varext=None):
+    """
+    Read the second operand of `operate_process` once: a list of
+    ``(data, var)`` per flux extension (read-only arrays), or the constant
+    itself.
+    """
+    if isinstance(ip2, float):
+        return ip2
+    operands = []
+    for index, ext in enumerate(fluxext):
+        data2 = read_image(ip2, ext=int(ext))
+        var2 = None
+        if varext is not None:
+            var2 = read_image(ip2, ext=int(varext[index]))
+        for arr in (data2, var2):
+            if arr is not None:
+                arr.setflags(write=False)
+        operands.append((data2, var2))
+    return operands
+
+
+def _operate_file(ip1, operands, label, opfilename, operation='+',
+                  fluxext=[0], varext=None, backend='numpy'):
+    """
+    Apply `operation` with operands loaded by `_load_operand` to `ip1` and
+    write `opfilename`. `label` names the operand in the HISTORY.
+    """
     primary_hdu = fits.PrimaryHDU()
     hdul = fits.HDUList([primary_hdu])
     for index, ext in enumerate(fluxext):
+        check_cancelled()
         ext = int(ext)
-        header = fits.getheader(ip1, ext=ext)
-        hdul1 = fits.open(ip1)
-        data1 = hdul1[ext].data
+        header = get_header(ip1, ext=ext)
+        data1 = read_image(ip1, ext=ext)
         header['HISTORY'] = '{} {} {}'.format(Path(ip1).name,
                                               operation,
-                                              Path(ip2).name)
+                                              label)
         if varext is None:
             var1 = None
         else:
-            var1 = hdul1[int(varext[index])].data
-        hdul1.close()
+            var1 = read_image(ip1, ext=int(varext[index]))
 
-        if isinstance(ip2, float):
-            data2 = ip2
-            var2 = 0
+        if isinstance(operands, float):
+            # A constant operand is exact: no variance, no full-size array.
+            data2 = operands
+            var2 = None
         else:
-            hdul2 = fits.open(ip2)
-            data2 = hdul2[ext].data
-            if varext is None:
-                var2 = None
-            else:
-                var2 = hdul2[int(varext[index])].data
-            hdul2.close()
-        result, var = ari_operations(data1, data2,
-                                     var1, var2,
-                                     operation=operation)
+            data2, var2 = operands[index]
+        result, var = ari_operations_out(data1, data2,
+                                         var1, var2,
+                                         operation=operation,
+                                         backend=backend)
         if int(ext) == 0:
             hdul[0] = fits.PrimaryHDU(result, header=header)
         else:
@@ -121,7 +194,7 @@ def operate_process(ip1, ip2,
         if varext is not None:
             hdul.append(
                 fits.ImageHDU(var,
-                              header=fits.getheader(
+                              header=get_header(
                                   ip1, ext=int(varext[index])
                               ),
                               name="VARIANCE"
@@ -130,13 +203,125 @@ def operate_process(ip1, ip2,
     hdul.writeto(opfilename, overwrite=True)
 
 
+@handle_pool.scope()
+def operate_batch(files, ip2, template, operation='+', fluxext=[0],
+                  varext=None, path='.', outdir='.', workers=4,
+                  backend='numpy'):
+    """
+    Apply one operand to many FITS files in parallel.
+
+    The operand (a reference file or a constant) is read once and shared
+    read-only by a pool of worker threads, each running the
+    `operate_process` step on one input. A failing input is logged and
+    reported; the rest of the batch carries on.
+
+    Parameters
+    ----------
+    files : str or list of str
+        Glob pattern (relative to `path`) or list of input files.
+    ip2 : str or float
+        Reference FITS file or constant operand.
+    template : str
+        Output name template, formatted with ``stem``, ``name``
+        (the input file name) and ``index`` (position in the batch), e.g.
+        ``'{stem}_bsub.fits'``.
+    operation : {'+', '-', '*', '/'}, optional
+        Arithmetic operation. Default is ``'+'``.
+    fluxext : list of int, optional
+        Flux extensions. Default is ``[0]``.
+    varext : list of int or None, optional
+        Variance extensions. Default is None.
+    path : str, optional
+        Directory of the glob pattern. Default is ``'.'``.
+    outdir : str, optional
+        Directory of the outputs. Default is ``'.'``.
+    workers : int, optional
+        Number of worker threads. Default is 4.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend passed to ``ari_operations_out``.
+
+    Returns
+    -------
+    written : list of str
+        Output files, in input order.
+    failed : dict
+        Input file to the exception it raised.
+
+    Examples
+    --------
+    Subtract a master bias from every science frame::
+
+        written, failed = operate_batch("sci_*.fits", "bias.fits",
+                                        "{stem}_bsub.fits", operation='-')
+    """
+    if isinstance(files, str):
+        files = sorted(Path(path).glob(files))
+    files = [str(fname) for fname in files]
+    outnames = [str(Path(outdir) / template.format(
+        stem=Path(fname).stem, name=Path(fname).name, index=index))
+        for index, fname in enumerate(files)]
+    if len(set(outnames)) != len(outnames):
+        raise ValueError("Template '{}' gives the same output name to "
+                         "several inputs".format(template))
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    operands = _load_operand(ip2, fluxext, varext)
+    label = ip2 if isinstance(ip2, float) else Path(ip2).name
+
+    def work(item):
+        fname, opfilename = item
+        _operate_file(fname, operands, label, opfilename,
+                      operation=operation, fluxext=fluxext, varext=varext,
+                      backend=backend)
+        return opfilename
+
+    written = []
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Each task runs in a copy of the caller context, so it belongs
+        # to the caller's job (logs and cancellation).
+        futures = [pool.submit(contextvars.copy_context().run, work, item)
+                   for item in zip(files, outnames)]
+        for fname, future in zip(files, futures):
+            try:
+                written.append(future.result())
+            except Exception as err:
+                logger.error("Failed to process {}: {}".format(fname, err))
+                failed[fname] = err
+    logger.info("Batch {}: {} written, {} failed".format(
+        operation, len(written), len(failed)))
+    return written, failed
+
+
+@handle_pool.scope()
 def combine_process(files,
                     opfilename,
                     path='.',
                     method='mean',
                     fluxext=[0],
                     varext=None,
-                    instrument=None
+                    instrument=None,
+                    backend='numpy',
+                    checkpoint_dir=None,
+                    quicklook=None,
+                    quicklook_mode='stride',
+                    output_format='fits',
+                    chunk_rows=None,
+                    workers=4,
+                    subset=None,
+                    uncertainty='propagate',
+                    align=False,
+                    scale=None,
+                    offset=None,
+                    exptime_key='EXPTIME',
+                    orders=None,
+                    wl_range=None,
+                    velocity=None,
+                    diagnostics=False,
+                    crreject=False,
+                    cr_threshold=5.0,
+                    cr_grow=1,
+                    crmask_dir=None,
+                    wl_mask=None
                     ):
     """
     Combine spectral or image data from multiple FITS files into a single
@@ -146,7 +331,10 @@ def combine_process(files,
 
     1. If an instrument is specified, it calls an instrument-specific routine
        (`combine_spectra`).
-    2. Otherwise, it manually reads data arrays and (optionally) variance
+    2. If `files` is a pixel-major stack cube written by the ``stack``
+       command, the cube is combined without reading the source frames
+       (`ariastro.cube.combine_cube`).
+    3. Otherwise, it manually reads data arrays and (optionally) variance
        arrays from the input files, combines them using the given method,
        and writes the results into a new FITS file.
 
@@ -158,6 +346,12 @@ def combine_process(files,
         - A list of FITS file paths.
         - A string specifying a pattern/regular expression to match files in
           `path`.
+        - The directory of a stack cube (or a list holding only it).
+
+        Entries of a list that do not exist and hold wildcards (e.g. a
+        quoted pattern on the command line) are expanded in `path` too.
+        The files are resolved before any dispatch (quick-look, cube or
+        instrument run).
 
     opfilename : str
         Output FITS filename to write the combined data.
@@ -184,6 +378,123 @@ def combine_process(files,
         `combine_spectra` instead of the default combination logic.
         Default is `None`.
 
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend passed to `combine_data`. Default is `'numpy'`.
+
+    checkpoint_dir : str or None, optional
+        Scratch directory for checkpoint/resume of instrument runs
+        (see `combine_spectra`). Default is `None`.
+
+    quicklook : int or None, optional
+        If given, write a quick-look preview instead of the full product:
+        frames are reduced by this factor along each axis (spectra: along
+        orders and pixels) before combining. See `ariastro.quicklook`.
+        Default is `None`.
+
+    quicklook_mode : {'stride', 'bin'}, optional
+        Decimation of image frames in quick-look mode. Default is
+        `'stride'`.
+
+    output_format : {'fits', 'hdf5', 'zarr'}, optional
+        Format of the combined spectrum for instrument runs (see
+        `ariastro.export`). Default is `'fits'`.
+
+    chunk_rows : int or None, optional
+        Combine image frames block of rows by block of rows instead of
+        reading every frame in full (see `combine_blocks`). If `None`, the
+        blocked path is used with `DEFAULT_BLOCK_ROWS` rows as soon as one
+        input is tile-compressed or gzipped. Default is `None`.
+
+    workers : int, optional
+        Number of threads reading the inputs of one block. Default is 4.
+
+    subset : list of str or int or None, optional
+        When `files` is a stack cube (see `ariastro.cube.build_cube`),
+        the frames of the cube to combine, by name or position. Default is
+        `None` (all frames). A cube is combined with `method`, `backend`,
+        `uncertainty` and `chunk_rows` only; the options of the frame and
+        spectra paths (`align`, `scale`, `diagnostics`, `crreject`, ...)
+        raise a ValueError.
+
+    uncertainty : {'propagate', 'bootstrap', 'jackknife'}, optional
+        Variance of the combined data (see `combine_data`). With
+        'bootstrap' or 'jackknife' an empirical variance extension is
+        written even without `varext`, and its header records the mode in
+        ``VARMODE``. Default is `'propagate'`.
+
+    align : bool, optional
+        Register the frames onto the first one before combining. The
+        shifts are estimated on the first flux extension by batched FFT
+        phase correlation (`ariastro.align.estimate_shifts`) and applied
+        to every extension while it is read, block by block. Default is
+        `False`.
+
+    scale : {'median', 'mode', 'exptime'} or None, optional
+        Scale every frame to the level of the first one before combining,
+        by the ratio of a pixel statistic or of the exposure times. The
+        statistics are estimated from a pixel subsample of each frame and
+        the normalization is applied while the frames are read (see
+        `ariastro.normalize.frame_normalization`). Default is `None`.
+
+    offset : {'median', 'mode'} or None, optional
+        Add an offset to every frame so that its statistic matches the
+        first one (after scaling). Default is `None`.
+
+    exptime_key : str, optional
+        Exposure time keyword for ``scale='exptime'``. Default is
+        `'EXPTIME'`.
+
+    orders : tuple of int or None, optional
+        First and last echelle order to combine, for instrument runs (see
+        `combine_spectra`). Default is `None` (all orders).
+
+    wl_range : tuple of float or None, optional
+        Wavelength range to combine, for instrument runs. Only the orders
+        and pixels covering it are read. Default is `None`.
+
+    velocity : str or list of float or None, optional
+        Combine spectra of an instrument run in the stellar rest frame,
+        with the RV of every epoch from this header keyword (e.g.
+        ``'CCFRVMOD'``) or from the list, in km/s (see
+        `combine_spectra`). Default is `None`.
+
+    diagnostics : bool, optional
+        Write the quality maps of every combined extension, computed in
+        the same pass as the combine (see
+        `ariastro.operations.combine_diagnostics`): the number of
+        contributing frames (NCOMBINE, unsigned integers), the scatter of
+        the stack (STDDEV) and the rejected fraction (REJFRAC). Their
+        ``FLUXEXT`` keyword gives the input extension. Instrument runs
+        add ``<flux>_NCOMBINE``, ... extensions to FITS outputs. Default
+        is `False`.
+
+    crreject : bool, optional
+        Reject cosmic rays from the stack instead of cleaning every frame
+        with L.A.Cosmic (see `ariastro.crreject.StackCosmicRays`): samples
+        more than `cr_threshold` sigma above the median of their pixel,
+        with sigma from the variance extension (or the median absolute
+        deviation of the pixel without `varext`), are flagged block by
+        block in the combine pass, grown by `cr_grow` pixels and ignored
+        by the combine. The frames must be aligned (or use `align`) and
+        at the same level (or use `scale`/`offset`), and at least three
+        are needed. Default is `False`.
+
+    cr_threshold : float, optional
+        Rejection threshold in sigma. Default is 5.
+
+    cr_grow : int, optional
+        Growth of the flags in pixels. Default is 1.
+
+    crmask_dir : str or None, optional
+        With `crreject`, write the flags of every input frame to
+        ``<crmask_dir>/<stem>_crmask.fits``, one uint8 ``CRMASK``
+        extension per combined extension. Default is `None`.
+
+    wl_mask : WavelengthMask or array_like or str or None, optional
+        Wavelength intervals (e.g. tellurics) masked in every epoch of an
+        instrument run before the combine (see `combine_spectra` and
+        `ariastro.wlmask.WavelengthMask`). Default is `None`.
+
     Returns
     -------
     None
@@ -216,61 +527,403 @@ def combine_process(files,
     ...                 varext=[2],
     ...                 method="median")
     """
+    files_list = _resolve_files(files, path)
+    if quicklook is not None:
+        if instrument is not None:
+            quicklook_spectra(files_list, opfilename,
+                              instrumentname=instrument,
+                              order_step=int(quicklook),
+                              pixel_step=int(quicklook),
+                              method=method)
+        else:
+            quicklook_process(files_list, opfilename,
+                              factor=int(quicklook),
+                              mode=quicklook_mode,
+                              method=method,
+                              fluxext=fluxext,
+                              varext=varext)
+        return
+
+    if len(files_list) == 1 and is_cube(files_list[0]):
+        cubedir = files_list[0]
+        unsupported = {'instrument': instrument is not None,
+                       'checkpoint_dir': checkpoint_dir is not None,
+                       'output_format': output_format != 'fits',
+                       'align': bool(align), 'scale': scale is not None,
+                       'offset': offset is not None,
+                       'orders': orders is not None,
+                       'wl_range': wl_range is not None,
+                       'velocity': velocity is not None,
+                       'diagnostics': bool(diagnostics),
+                       'crreject': bool(crreject),
+                       'crmask_dir': crmask_dir is not None,
+                       'wl_mask': wl_mask is not None}
+        unsupported = [name for name, given in unsupported.items() if given]
+        if unsupported:
+            raise ValueError("Options not supported for a stack cube: "
+                             "{}".format(', '.join(unsupported)))
+        combine_cube(cubedir, opfilename, method=method, subset=subset,
+                     block_rows=chunk_rows or DEFAULT_BLOCK_ROWS,
+                     backend=backend, uncertainty=uncertainty)
+        return
+
     if instrument is not None:
-        combine_spectra(files, opfilename=opfilename,
+        combine_spectra(files_list, opfilename=opfilename,
                         instrumentname=instrument,
                         method=method,
                         fluxext=fluxext,
-                        varext=varext)
+                        varext=varext,
+                        backend=backend,
+                        checkpoint_dir=checkpoint_dir,
+                        output_format=output_format,
+                        uncertainty=uncertainty,
+                        orders=orders,
+                        wl_range=wl_range,
+                        velocity=velocity,
+                        diagnostics=diagnostics,
+                        wl_mask=wl_mask)
         return
 
     primary_hdu = fits.PrimaryHDU()
     hdul = fits.HDUList([primary_hdu])
-    if isinstance(files, list):
-        files_list = files
-    elif isinstance(files, str):
-        files_path = Path(path)
-        files_list = files_path.glib(files)
-    else:
-        print("Enter either files list or the regular expression")
+
+    if chunk_rows is None and any(is_compressed(fname)
+                                  for fname in files_list):
+        chunk_rows = DEFAULT_BLOCK_ROWS
+    shifts = None
+    if align:
+        shifts = estimate_shifts(files_list, ext=int(fluxext[0]),
+                                 workers=workers)
+        chunk_rows = chunk_rows or DEFAULT_BLOCK_ROWS
+    if crreject and len(files_list) < MIN_FRAMES:
+        logger.warning("Stack cosmic-ray rejection needs at least {} "
+                       "frames, skipped".format(MIN_FRAMES))
+        crreject = False
+    crmask_hdus = [[fits.PrimaryHDU()] for _ in files_list]
 
     for index, ext in enumerate(fluxext):
         ext = int(ext)
-        header = fits.getheader(files_list[0], ext=ext)
-        data_array = []
-        var_array = []
-        for fname in files_list:
-            data = fits.getdata(fname, ext=ext)
-            data_array.append(data)
-            if varext is not None:
-                var = fits.getdata(fname, ext=int(varext[index]))
-                var_array.append(var)
-        if len(files_list) == 1:
-            result = data_array[0]
-            if varext is not None:
-                variance = var_array[0]
+        vext = None if varext is None else int(varext[index])
+        header = get_header(files_list[0], ext=ext)
+        normalize = None
+        if scale is not None or offset is not None:
+            scales, offsets, norm_errors = frame_normalization(
+                files_list, ext, scale=scale, offset=offset,
+                exptime_key=exptime_key, workers=workers)
+            normalize = partial(_normalize_block, scales, offsets)
+        reject = None
+        if crreject:
+            reject = StackCosmicRays(cr_threshold, cr_grow,
+                                     keep_masks=crmask_dir is not None)
+        qa_maps = None
+        if chunk_rows is not None:
+            combined = combine_blocks(files_list, ext, vext,
+                                      method=method,
+                                      block_rows=chunk_rows,
+                                      workers=workers,
+                                      backend=backend,
+                                      uncertainty=uncertainty,
+                                      preprocess=normalize,
+                                      shifts=shifts,
+                                      diagnostics=diagnostics,
+                                      reject=reject)
+            result, variance = combined[:2]
+            if diagnostics:
+                qa_maps = combined[2]
         else:
-            result, variance = combine_data(dataarr=data_array,
-                                            var=var_array,
-                                            method=method)
-        to_history = [Path(i).fname for i in files_list]
+            data_array = []
+            var_array = []
+            for findex, fname in enumerate(files_list):
+                check_cancelled()
+                data = read_image(fname, ext=ext)
+                var = None
+                if varext is not None:
+                    var = read_image(fname, ext=vext)
+                if normalize is not None:
+                    data, var = normalize(findex, 0, len(data), data, var)
+                data_array.append(data)
+                if varext is not None:
+                    var_array.append(var)
+            if reject is not None:
+                _, _, data_array, _ = next(reject(iter([
+                    (0, len(data_array[0]), data_array, var_array or None)])))
+            if len(files_list) == 1:
+                result = data_array[0]
+                variance = None
+                if varext is not None:
+                    variance = var_array[0]
+                elif uncertainty != 'propagate':
+                    # No resampling of a single frame.
+                    variance = np.full(np.shape(result), np.nan)
+                if diagnostics:
+                    qa_maps = combine_diagnostics(data_array,
+                                                  var_array or None)
+            else:
+                combined = combine_data(dataarr=data_array,
+                                        var=var_array or None,
+                                        method=method,
+                                        backend=backend,
+                                        uncertainty=uncertainty,
+                                        diagnostics=diagnostics)
+                result, variance = combined[:2]
+                if diagnostics:
+                    qa_maps = combined[2]
+        to_history = [Path(i).name for i in files_list]
         header["HISTORY"] = method + str(to_history)
+        if shifts is not None:
+            for fname, (dy, dx) in zip(to_history, shifts):
+                header["HISTORY"] = "shift {} {:.3f} {:.3f}".format(
+                    fname, dy, dx)
+        if normalize is not None:
+            # Standard errors of the estimates; the scale error is
+            # relative in frame_normalization.
+            for fname, factor, zero, (rel_err, zero_err) in zip(
+                    to_history, scales, offsets, norm_errors):
+                header["HISTORY"] = ("scale {} {:.6g} +- {:.2g} offset "
+                                     "{:.6g} +- {:.2g}").format(
+                    fname, factor, factor * rel_err, zero, zero_err)
+        if reject is not None:
+            header["HISTORY"] = "crreject threshold {} grow {}".format(
+                cr_threshold, cr_grow)
+            for fname, count in zip(to_history, reject.counts):
+                header["HISTORY"] = "crreject {} {} pixels".format(fname,
+                                                                   count)
+            if crmask_dir is not None:
+                maskheader = fits.Header()
+                maskheader['FLUXEXT'] = (ext, 'Combined input extension')
+                for hdus, mask in zip(crmask_hdus, reject.frame_masks()):
+                    hdus.append(fits.ImageHDU(mask.astype(np.uint8),
+                                              header=maskheader,
+                                              name='CRMASK'))
         if int(ext) == 0:
             hdul[0] = fits.PrimaryHDU(result, header=header)
         else:
             imagehdu = fits.ImageHDU(result, header=header,
                                      name="FLUX")
             hdul.append(imagehdu)
-        if varext is not None:
+        if varext is not None or uncertainty != 'propagate':
+            varheader = fits.Header() if vext is None \
+                else get_header(files_list[0], ext=vext)
+            varheader['VARMODE'] = (uncertainty, 'Variance estimate')
             hdul.append(
-                fits.ImageHDU(var,
-                              header=fits.getheader(
-                                  files_list[0], ext=int(varext[index])
-                                  ),
+                fits.ImageHDU(variance,
+                              header=varheader,
                               name="VARIANCE"
                               )
                 )
-        hdul.writeto(opfilename, overwrite=True)
+        if qa_maps is not None:
+            for name, qa_map in qa_maps.items():
+                qaheader = fits.Header()
+                qaheader['FLUXEXT'] = (ext, 'Combined input extension')
+                hdul.append(fits.ImageHDU(qa_map, header=qaheader,
+                                          name=name))
+    hdul.writeto(opfilename, overwrite=True)
+    if crreject and crmask_dir is not None:
+        Path(crmask_dir).mkdir(parents=True, exist_ok=True)
+        for fname, hdus in zip(files_list, crmask_hdus):
+            fits.HDUList(hdus).writeto(
+                Path(crmask_dir) / "{}_crmask.fits".format(Path(fname).stem),
+                overwrite=True)
+
+
+def _resolve_files(files, path='.'):
+    """
+    Input files of `combine_process`: a list, where the missing entries
+    with wildcards are expanded in `path`, or a glob pattern in `path`. A
+    stack cube directory is kept as is.
+    """
+    if isinstance(files, str):
+        if is_cube(files):
+            return [files]
+        return [Path(match) for match
+                in sorted(glob.glob(os.path.join(str(path), files)))]
+    if not isinstance(files, list):
+        raise TypeError("Enter either files list or the regular expression")
+    files_list = []
+    for fname in files:
+        if isinstance(fname, str) and glob.has_magic(fname) \
+                and not Path(fname).exists():
+            matches = sorted(glob.glob(os.path.join(str(path), fname)))
+            if not matches:
+                raise FileNotFoundError(
+                    "No files match {} in {}".format(fname, path))
+            files_list += [Path(match) for match in matches]
+        else:
+            files_list.append(fname)
+    return files_list
+
+
+def _normalize_block(scales, offsets, index, start, stop, data, var):
+    """`combine_blocks` preprocess step: ``data * scale + offset``."""
+    data = data * scales[index] + offsets[index]
+    if var is not None:
+        var = var * scales[index] ** 2
+    return data, var
+
+
+def combine_blocks(files, ext, varext=None, method='mean',
+                   block_rows=DEFAULT_BLOCK_ROWS, workers=4,
+                   backend='numpy', uncertainty='propagate',
+                   preprocess=None, shifts=None, diagnostics=False,
+                   reject=None):
+    """
+    Combine one image extension of many frames, block of rows by block of
+    rows.
+
+    All frames are read in lockstep with `iter_row_blocks`, so only one
+    block of every frame is held in memory. Tile-compressed frames only
+    decompress the tiles of the current block, and gzipped frames are
+    streamed. The blocks of the different frames are read in parallel.
+
+    Parameters
+    ----------
+    files : list of str
+        Input FITS files (plain, ``.fits.fz`` or ``.fits.gz``).
+    ext : int
+        Flux extension.
+    varext : int or None, optional
+        Variance extension. Default is None.
+    method : str, optional
+        Combine method passed to `combine_data`. Default is ``'mean'``.
+    block_rows : int, optional
+        Rows per block. Default is `DEFAULT_BLOCK_ROWS`.
+    workers : int, optional
+        Number of reader threads. Default is 4.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend passed to `combine_data`. Default is ``'numpy'``.
+    uncertainty : {'propagate', 'bootstrap', 'jackknife'}, optional
+        Variance estimate passed to `combine_data`. The resampling runs
+        block by block. Default is ``'propagate'``.
+    preprocess : callable or None, optional
+        ``preprocess(index, start, stop, data, var)`` is applied to the
+        block of rows ``start:stop`` of the `index`-th frame before the
+        combine and returns the new ``(data, var)`` (``var`` is None
+        without `varext`). Used for example to calibrate raw frames on the
+        fly. Default is None.
+    shifts : array_like or None, optional
+        (dy, dx) shift of every frame (see `ariastro.align`). The frames
+        and variances are shifted block by block while they are read
+        (`iter_shifted_blocks`); pixels without data are NaN. Variances
+        are interpolated like the data, an upper bound of the variance
+        of the interpolated pixels. Default is None.
+    diagnostics : bool, optional
+        Also return the quality maps of the stack (see
+        `ariastro.operations.combine_diagnostics`), computed block by
+        block from the blocks read for the combine. Default is False.
+    reject : callable or None, optional
+        ``reject(blocks)`` maps the iterator of ``(start, stop, data,
+        var)`` blocks of all frames (after `preprocess`) to an iterator of
+        blocks with the rejected samples set to NaN, e.g. a
+        `ariastro.crreject.StackCosmicRays`. Default is None.
+
+    Returns
+    -------
+    result : numpy.ndarray
+        Combined image.
+    variance : numpy.ndarray or None
+        Combined variance, None if `varext` is None and `uncertainty` is
+        ``'propagate'``.
+    diagnostics : dict of numpy.ndarray
+        Quality maps, returned only with ``diagnostics=True``.
+    """
+    block_rows = aligned_block_rows(files, ext, block_rows)
+    if shifts is None:
+        def reader(index, fname, ext):
+            return iter_row_blocks(fname, ext, block_rows)
+    else:
+        def reader(index, fname, ext):
+            return iter_shifted_blocks(fname, ext, shifts[index],
+                                       block_rows)
+    readers = [reader(index, fname, ext)
+               for index, fname in enumerate(files)]
+    if varext is not None:
+        readers += [reader(index, fname, varext)
+                    for index, fname in enumerate(files)]
+    nfiles = len(files)
+    results = []
+    variances = []
+    qa_blocks = []
+
+    def stacked_blocks(pool):
+        while True:
+            check_cancelled()
+            blocks = list(pool.map(lambda reader: next(reader, None),
+                                   readers))
+            if blocks[0] is None:
+                return
+            if any(block is None or block[:2] != blocks[0][:2]
+                   for block in blocks):
+                raise ValueError("Input frames do not have the same shape")
+            start, stop = blocks[0][:2]
+            data = [block[2] for block in blocks[:nfiles]]
+            var = None
+            if varext is not None:
+                var = [block[2] for block in blocks[nfiles:]]
+            if preprocess is not None:
+                for index in range(nfiles):
+                    data[index], vblock = preprocess(
+                        index, start, stop, data[index],
+                        None if var is None else var[index])
+                    if var is not None:
+                        var[index] = vblock
+            yield start, stop, data, var
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        blocks = stacked_blocks(pool)
+        if reject is not None:
+            blocks = reject(blocks)
+        for start, stop, data, var in blocks:
+            if nfiles == 1:
+                result = np.asarray(data[0])
+                variance = None if var is None else np.asarray(var[0])
+                if variance is None and uncertainty != 'propagate':
+                    variance = np.full(result.shape, np.nan)
+                if diagnostics:
+                    qa_blocks.append(combine_diagnostics(data, var))
+            else:
+                combined = combine_data(dataarr=data, var=var,
+                                        method=method,
+                                        backend=backend,
+                                        uncertainty=uncertainty,
+                                        diagnostics=diagnostics)
+                result, variance = combined[:2]
+                if diagnostics:
+                    qa_blocks.append(combined[2])
+            results.append(result)
+            variances.append(variance)
+    result = np.concatenate(results)
+    variance = None if variances[0] is None else np.concatenate(variances)
+    if diagnostics:
+        qa_maps = {name: np.concatenate([block[name] for block in qa_blocks])
+                   for name in qa_blocks[0]}
+        return result, variance, qa_maps
+    return result, variance
+
+
+def normalize_smoothgradient(data, var=None, medsmoothsize=(25, 51)):
+    """
+    Divide one frame by its median-smoothed background gradient.
+
+    The array-level step of `divide_smoothgradient`.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Image data. Values are clipped to ``[1, max + 1]`` first.
+    var : numpy.ndarray or None, optional
+        Variance of `data`, divided by the squared gradient.
+    medsmoothsize : tuple of int, optional
+        Size of the median filter window. Default is (25, 51).
+
+    Returns
+    -------
+    normdata, normvar : numpy.ndarray
+        Normalized data and variance (None if `var` is None).
+    """
+    data = np.clip(data, 1, np.max(data + 1))
+    smoothGrad = filters.median_filter(data, size=medsmoothsize)
+    normvar = None if var is None else var / smoothGrad ** 2
+    return data / smoothGrad, normvar
 
 
 def divide_smoothgradient(filename,
@@ -335,22 +988,22 @@ def divide_smoothgradient(filename,
     hdul = fits.HDUList([primary_hdu])
     for index, ext in enumerate(fluxext):
         inputimgdata = fits.getdata(filename, ext=int(ext))
-        inputimgdata = np.clip(inputimgdata, 1, np.max(inputimgdata+1))
-        print("Smoothing the frame")
-        print('It takes sometime (> 100 sec) to finish. Wait ...')
+        var = None
+        if varext is not None:
+            var = fits.getdata(filename, ext=int(varext[index]))
+        logger.info("Smoothing the frame")
+        logger.info('It takes sometime (> 100 sec) to finish. Wait ...')
         try:
-            smoothGrad = filters.median_filter(inputimgdata,
-                                               size=medsmoothsize)
+            NormContdata, NormCont_var = normalize_smoothgradient(
+                inputimgdata, var, medsmoothsize=medsmoothsize)
 
         except MemoryError:
-            print("*** MEMORY ERROR : Skipping median filter Division ***")
-            print("Try giving a smaller smooth size for medial filtter insted")
+            logger.error("*** MEMORY ERROR : Skipping median filter "
+                         "Division ***")
+            logger.error("Try giving a smaller smooth size for medial "
+                         "filtter insted")
         else:
-            header = fits.getheader(filename, ext=0)
-            NormContdata = inputimgdata / smoothGrad
-            if varext is not None:
-                var = fits.getdata(filename, ext=int(varext[index]))
-                NormCont_var = var / smoothGrad ** 2
+            header = get_header(filename, ext=0)
             header['HISTORY'] = 'Divided median filter size: {}'.format(
                 medsmoothsize)
             if int(ext) == 0:
@@ -362,7 +1015,7 @@ def divide_smoothgradient(filename,
             if varext is not None:
                 hdul.append(
                     fits.ImageHDU(NormCont_var,
-                                  header=fits.getheader(
+                                  header=get_header(
                                       filename, ext=int(varext[index])
                                       ),
                                   name="VARIANCE"
@@ -371,6 +1024,31 @@ def divide_smoothgradient(filename,
             hdul.writeto(opfilename, overwrite=True)
 
 
+def clean_cosmic_rays(data, var=None):
+    """
+    Detect and clean cosmic rays in one frame with astroscrappy.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Image data.
+    var : numpy.ndarray or None, optional
+        Variance of `data`, used by astroscrappy as the noise model
+        instead of its gain/readnoise estimate. Default is None.
+
+    Returns
+    -------
+    crmask : numpy.ndarray of bool
+        Pixels flagged as cosmic rays.
+    cleanarr : numpy.ndarray
+        Cleaned image.
+    """
+    if var is None:
+        return astroscrappy.detect_cosmics(data)
+    return astroscrappy.detect_cosmics(data, invar=np.asarray(
+        var, dtype=np.float32))
+
+
 def remove_cosmic_rays(input_fname,
                        opfilename,
                        fluxext=[0],
@@ -380,12 +1058,11 @@ def remove_cosmic_rays(input_fname,
     for index, ext in enumerate(fluxext):
         inputimgdata = fits.getdata(input_fname, ext=int(ext))
         if varext is None:
-            crmask, cleararr = astroscrappy.detect_cosmics(inputimgdata)
+            inputvardata = None
         else:
             inputvardata = fits.getdata(input_fname, ext=int(varext[index]))
-            crmask, cleararr = astroscrappy.detect_cosmics(inputimgdata,
-                                                           inputvardata)
-        header = fits.getheader(input_fname, ext=0)
+        crmask, cleararr = clean_cosmic_rays(inputimgdata, inputvardata)
+        header = get_header(input_fname, ext=0)
         header['HISTORY'] = "Cosmic Rays removed with astroscrappy"
         if int(ext) == 0:
             hdul[0] = fits.PrimaryHDU(cleararr, header=header)
@@ -395,7 +1072,7 @@ def remove_cosmic_rays(input_fname,
         if varext is not None:
             hdul.append(
                 fits.ImageHDU(inputvardata,
-                              header=fits.getheader(
+                              header=get_header(
                                   input_fname, ext=int(varext[index])
                                   ),
                               name="VARIANCE"
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+
+import numpy as np
+from astropy.table import Table
+
+from .logger import logger
+from .instrument import instrument_dict
+from .utils import extract_allexts
+
+# Bands are (center, width, shape) in vacuum Angstrom, as the NEID
+# wavelengths. The width is the full width of a 'rect' band and the FWHM
+# of a 'triangle' band. Each index is the summed mean flux of its line
+# bands over the summed mean flux of its continuum bands.
+LINE_INDICES = {
+    # Ca II H&K (S index, Duncan et al. 1991; uncalibrated).
+    'CaHK': {'line': [(3934.778, 1.09, 'triangle'),
+                      (3969.593, 1.09, 'triangle')],
+             'continuum': [(3902.105, 20.0, 'rect'),
+                           (4002.131, 20.0, 'rect')]},
+    # H alpha (Gomes da Silva et al. 2011).
+    'Halpha': {'line': [(6564.621, 1.6, 'rect')],
+               'continuum': [(6552.680, 10.75, 'rect'),
+                             (6582.128, 8.75, 'rect')]},
+    # Na I D1 and D2 (Gomes da Silva et al. 2011).
+    'NaD': {'line': [(5897.554, 0.5, 'rect'),
+                     (5891.582, 0.5, 'rect')],
+            'continuum': [(5806.610, 10.0, 'rect'),
+                          (6091.686, 20.0, 'rect')]},
+}
+
+
+def pixel_edges(wl):
+    """Edges of the pixels of a wavelength grid, midway between centers."""
+    wl = np.asarray(wl, dtype=np.float64)
+    mid = 0.5 * (wl[1:] + wl[:-1])
+    return np.concatenate([[2 * wl[0] - mid[0]], mid,
+                           [2 * wl[-1] - mid[-1]]])
+
+
+def _finite_span(wl):
+    """First and last+1 finite pixel of every row of `wl`."""
+    finite = np.isfinite(wl)
+    first = np.argmax(finite, axis=1)
+    last = wl.shape[1] - np.argmax(finite[:, ::-1], axis=1)
+    last[~finite.any(axis=1)] = 0
+    return first, last
+
+
+def _band_order(wl, lo, hi):
+    """Row of `wl` covering ``[lo, hi]`` closest to its center, or None."""
+    first, last = _finite_span(wl)
+    rows = np.flatnonzero(last - first > 1)
+    blue = wl[rows, first[rows]]
+    red = wl[rows, last[rows] - 1]
+    covers = (blue < lo) & (red > hi)
+    if not covers.any():
+        return None, None
+    rows, blue, red = rows[covers], blue[covers], red[covers]
+    best = np.argmin(np.abs(0.5 * (blue + red) - 0.5 * (lo + hi)))
+    row = rows[best]
+    return row, slice(first[row], last[row])
+
+
+def band_weights(wl, bands):
+    """
+    Integration weights of spectral bands on a wavelength grid.
+
+    For every band, the order covering it (closest to the order center
+    when several do) is found, and the pixels overlapping the band are
+    located with `numpy.searchsorted` on the pixel edges. The weight of a
+    pixel is its overlap with the band in Angstrom, times the triangle
+    profile at the pixel center for triangular bands, so that
+    ``sum(weights * flux)`` is the band integral.
+
+    Parameters
+    ----------
+    wl : array_like
+        Wavelengths of shape (orders, pixels), increasing along pixels.
+    bands : list of tuple
+        ``(center, width, shape)`` of every band (see `LINE_INDICES`).
+
+    Returns
+    -------
+    index : numpy.ndarray of int
+        Flat indices into ``(orders, pixels)`` of the pixels of every
+        band, shape (nbands, K), padded with the first pixel of the
+        band.
+    weights : numpy.ndarray
+        Weights of these pixels, shape (nbands, K), zero for the padding
+        and for bands not covered by the grid.
+    """
+    wl = np.atleast_2d(np.asarray(wl, dtype=np.float64))
+    npix = wl.shape[1]
+    pixels = []
+    for center, width, shape in bands:
+        half = width if shape == 'triangle' else 0.5 * width
+        lo, hi = center - half, center + half
+        row, span = _band_order(wl, lo, hi)
+        if row is None:
+            logger.warning("Band {} is not covered by the spectra".format(
+                center))
+            pixels.append((np.zeros(1, dtype=int), np.zeros(1)))
+            continue
+        grid = wl[row, span]
+        edges = pixel_edges(grid)
+        first = np.searchsorted(edges, lo, side='right') - 1
+        last = np.searchsorted(edges, hi, side='left')
+        cols = np.arange(first, last)
+        overlap = np.minimum(edges[cols + 1], hi) \
+            - np.maximum(edges[cols], lo)
+        weights = np.clip(overlap, 0.0, None)
+        if shape == 'triangle':
+            weights *= np.clip(1 - np.abs(grid[cols] - center) / width,
+                               0.0, None)
+        elif shape != 'rect':
+            raise ValueError("Unknown band shape '{}'".format(shape))
+        pixels.append((row * npix + span.start + cols, weights))
+    size = max(len(cols) for cols, _ in pixels)
+    index = np.zeros((len(bands), size), dtype=int)
+    weights = np.zeros((len(bands), size))
+    for nband, (cols, weight) in enumerate(pixels):
+        # The padding repeats a pixel of the band with a zero weight, so
+        # that a NaN elsewhere in the spectrum does not leak in.
+        index[nband] = cols[0]
+        index[nband, :len(cols)] = cols
+        weights[nband, :len(cols)] = weight
+    return index, weights
+
+
+def band_fluxes(flux, var, index, weights):
+    """
+    Mean flux of bands in all epochs, with its variance.
+
+    Parameters
+    ----------
+    flux, var : array_like
+        Spectra of shape (epochs, orders, pixels). `var` may be None.
+    index, weights : numpy.ndarray
+        Band pixels and weights from `band_weights`, shape (nbands, K),
+        or (epochs, nbands, K) for one grid per epoch.
+
+    Returns
+    -------
+    mean : numpy.ndarray
+        Weighted mean flux of every band, shape (epochs, nbands).
+    mean_var : numpy.ndarray or None
+        Its variance.
+
+    Notes
+    -----
+    Pixels of zero weight (padding, or pixels just touching a band edge)
+    are left out, so a NaN there does not make the band NaN.
+    """
+    flux = np.asarray(flux, dtype=np.float64)
+    nepochs = flux.shape[0]
+    flat = flux.reshape(nepochs, -1)
+    norm = weights.sum(axis=-1)
+    if index.ndim == 2:
+        gathered = flat[:, index]
+        subscripts = 'ebk,bk->eb'
+    else:
+        gathered = np.take_along_axis(flat[:, None, :],
+                                      index, axis=2)
+        subscripts = 'ebk,ebk->eb'
+    used = weights > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gathered = np.where(used, gathered, 0.0)
+        mean = np.einsum(subscripts, gathered, weights) / norm
+        if var is None:
+            return mean, None
+        flat = np.asarray(var, dtype=np.float64).reshape(nepochs, -1)
+        gathered = flat[:, index] if index.ndim == 2 \
+            else np.take_along_axis(flat[:, None, :], index, axis=2)
+        gathered = np.where(used, gathered, 0.0)
+        mean_var = np.einsum(subscripts, gathered, weights ** 2) / norm ** 2
+    return mean, mean_var
+
+
+def _stack(datadict, fluxext, varext, wlext):
+    """Flux, variance and wavelength arrays of one or many datadicts."""
+    if isinstance(datadict, dict):
+        datadict = [datadict]
+    arrays = []
+    for ext in (fluxext, varext, wlext):
+        if ext is None:
+            arrays.append(None)
+            continue
+        stack = []
+        for epoch in datadict:
+            data = np.asarray(epoch[list(epoch.keys())[ext]],
+                              dtype=np.float64)
+            stack.append(data.reshape((-1,) + data.shape[-2:]))
+        arrays.append(np.concatenate(stack))
+    return arrays
+
+
+def measure_indices(datadict, lines=None, fluxext=1, varext=4, wlext=7,
+                    epoch_names=None):
+    """
+    Measure activity indices and equivalent widths of spectra.
+
+    The integration weights of all the bands of all the `lines` are
+    computed once from the wavelength grid (once per epoch if the epochs
+    are on different grids) with `band_weights`. All epochs and bands are
+    then evaluated in one gather and contraction (`band_fluxes`), with
+    the variance propagated.
+
+    Parameters
+    ----------
+    datadict : dict or list of dict
+        Spectra as from `combine_spectra` (combined, or its per-epoch
+        stack), `extract_allexts` or `Handle_NEID.process_data`: arrays of
+        shape (orders, pixels) or (epochs, orders, pixels). A list holds
+        one datadict per epoch.
+    lines : list of str or None, optional
+        Names of `LINE_INDICES` to measure. Default is all.
+    fluxext, varext, wlext : int, optional
+        Positions of the flux, variance and wavelength arrays in
+        ``datadict.keys()``. Defaults are the NEID science fiber. `varext`
+        may be None.
+    epoch_names : list of str or None, optional
+        Name of every epoch, written in the ``EPOCH`` column.
+
+    Returns
+    -------
+    astropy.table.Table
+        One row per epoch. For every line, the index ``<line>`` and for
+        every line band the equivalent width ``EW_<line>_<n>`` in
+        Angstrom, with their ``_ERR`` uncertainties. The equivalent width
+        is measured against the mean continuum band flux (weighted by
+        the profile for triangular bands).
+
+    Raises
+    ------
+    ValueError
+        If a line name is unknown.
+    """
+    lines = list(LINE_INDICES) if lines is None else list(lines)
+    unknown = [line for line in lines if line not in LINE_INDICES]
+    if unknown:
+        raise ValueError("Unknown lines {}, choose from {}".format(
+            unknown, list(LINE_INDICES)))
+    flux, var, wl = _stack(datadict, fluxext, varext, wlext)
+    nepochs = flux.shape[0]
+    bands = []
+    for line in lines:
+        bands += LINE_INDICES[line]['line'] + LINE_INDICES[line]['continuum']
+
+    if len(wl) == 1 or all(np.array_equal(wl[0], grid) for grid in wl):
+        index, weights = band_weights(wl[0], bands)
+    else:
+        per_epoch = [band_weights(grid, bands) for grid in wl]
+        size = max(epoch_index.shape[1] for epoch_index, _ in per_epoch)
+        index = np.zeros((nepochs, len(bands), size), dtype=int)
+        weights = np.zeros((nepochs, len(bands), size))
+        for epoch, (epoch_index, epoch_weights) in enumerate(per_epoch):
+            # Padded with the first pixel of the band, as in band_weights.
+            index[epoch] = epoch_index[:, :1]
+            index[epoch, :, :epoch_index.shape[1]] = epoch_index
+            weights[epoch, :, :epoch_index.shape[1]] = epoch_weights
+    mean, mean_var = band_fluxes(flux, var, index, weights)
+    if mean_var is None:
+        mean_var = np.full(mean.shape, np.nan)
+    widths = weights.sum(axis=-1)
+
+    table = Table()
+    table['EPOCH'] = list(epoch_names) if epoch_names is not None \
+        else [str(epoch) for epoch in range(nepochs)]
+    nband = 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for line in lines:
+            nline = len(LINE_INDICES[line]['line'])
+            ncont = len(LINE_INDICES[line]['continuum'])
+            line_bands = slice(nband, nband + nline)
+            cont_bands = slice(nband + nline, nband + nline + ncont)
+            nband += nline + ncont
+            num = mean[:, line_bands].sum(axis=1)
+            num_var = mean_var[:, line_bands].sum(axis=1)
+            den = mean[:, cont_bands].sum(axis=1)
+            den_var = mean_var[:, cont_bands].sum(axis=1)
+            value = num / den
+            table[line] = value
+            table[line + '_ERR'] = np.abs(value) * np.sqrt(
+                num_var / num ** 2 + den_var / den ** 2)
+
+            cont = den / ncont
+            cont_var = den_var / ncont ** 2
+            for n in range(nline):
+                band = line_bands.start + n
+                width = widths[..., band]
+                ratio = mean[:, band] / cont
+                name = 'EW_{}_{}'.format(line, n + 1)
+                table[name] = width * (1 - ratio)
+                table[name + '_ERR'] = width * np.abs(ratio) * np.sqrt(
+                    mean_var[:, band] / mean[:, band] ** 2
+                    + cont_var / cont ** 2)
+    return table
+
+
+def measure_indices_files(files, opfilename=None, instrumentname=None,
+                          lines=None, fluxext=1, varext=4, wlext=7):
+    """
+    Measure `measure_indices` on spectra files and write the table.
+
+    Parameters
+    ----------
+    files : list of str
+        One spectrum (epoch or combined) per file.
+    opfilename : str or None, optional
+        Output table (format from the extension, e.g. ``.ecsv``,
+        ``.fits``, ``.csv``). Default is None (not written).
+    instrumentname : str or None, optional
+        Read the files with the `process_data` of this instrument (e.g.
+        ``'NEID'``, which divides by the blaze). Default is None (raw
+        extensions).
+    lines, fluxext, varext, wlext
+        See `measure_indices`.
+
+    Returns
+    -------
+    astropy.table.Table
+    """
+    if instrumentname is not None:
+        instrument = instrument_dict[instrumentname]()
+        read = instrument.process_data
+    else:
+        read = extract_allexts
+    datadicts = [read(fname)[0] for fname in files]
+    table = measure_indices(datadicts, lines=lines, fluxext=fluxext,
+                            varext=varext, wlext=wlext,
+                            epoch_names=[Path(fname).name
+                                         for fname in files])
+    if opfilename is not None:
+        table.write(opfilename, overwrite=True)
+        logger.info("Wrote indices of {} spectra to {}".format(
+            len(files), opfilename))
+    return table
+
+# End
@@ -46,7 +46,15 @@ class Handle_NEID:
         wlext = [7, 8, 9]
         return fluxext, varext, wlext
 
-    def getfull_data(self, fname):
+    def blaze_extensions(self):
+        blazeext = [15, 16, 17]
+        return blazeext
+
+    def order_numbers(self, n_orders):
+        """Echelle order numbers of the first `n_orders` rows."""
+        return 173 - np.arange(n_orders)
+
+    def getfull_data(self, fname, section=None):
         """
         Extract all extensions from a NEID FITS file.
 
@@ -54,6 +62,9 @@ class Handle_NEID:
         ----------
         fname : str
             Path to the FITS file.
+        section : tuple of slice or None, optional
+            ``(orders, pixels)`` section of the flux, variance, wavelength
+            and blaze extensions to read. Default is None (all).
 
         Returns
         -------
@@ -63,10 +74,13 @@ class Handle_NEID:
         headerdict : dict
             Dictionary mapping extension keywords to FITS headers.
         """
-        datadict, headerdict = extract_allexts(fname)
+        fluxext, varext, wlext = self.fits_extensions()
+        datadict, headerdict = extract_allexts(
+            fname, section=section,
+            section_exts=fluxext + varext + wlext + self.blaze_extensions())
         return datadict, headerdict
 
-    def barycorr(self, wl_array, header):
+    def barycorr(self, wl_array, header, orders=None):
         """
         Apply barycentric correction to the wavelength array.
 
@@ -81,6 +95,9 @@ class Handle_NEID:
             2D array of wavelength values (orders x pixels).
         header : astropy.io.fits.Header
             FITS header containing the barycentric correction keywords.
+        orders : array_like or None, optional
+            Order number of every row of `wl_array`. Default is the
+            orders of the full detector, ``173, 172, ...``.
 
         Returns
         -------
@@ -90,10 +107,10 @@ class Handle_NEID:
             Updated header with ``SSBZxxx`` values reset to zero.
         """
 
-        n_orders = wl_array.shape[0]
+        if orders is None:
+            orders = self.order_numbers(wl_array.shape[0])
         zfacts = []
-        for index in range(n_orders):
-            order = 173 - index
+        for order in orders:
             strnum = str(order)
             while len(strnum) < 3:
                 strnum = '0' + strnum
@@ -105,7 +122,8 @@ class Handle_NEID:
 
         return corr_wl_array, header
 
-    def process_data(self, fname, contnorm=False):
+    def process_data(self, fname, contnorm=False, section=None,
+                     wl_mask=None):
         """
         Process a NEID FITS file: barycentric correction, blaze correction,
         and variance correction.
@@ -130,14 +148,24 @@ class Handle_NEID:
             Dictionary with updated FITS headers.
         contnorm  :  bool
             Do continuum division with the function continuum_normalize.
+        section : tuple of slice or None, optional
+            ``(orders, pixels)`` section to read and process (see
+            `getfull_data`). Default is None (all).
+        wl_mask : WavelengthMask or array_like or str, optional
+            Wavelength intervals left out of the continuum fit with
+            `contnorm` (see `continuum_normalize`). Default is None.
         """
-        datadict, headerdict = self.getfull_data(fname)
+        datadict, headerdict = self.getfull_data(fname, section=section)
+        orders = None
+        if section is not None:
+            start, stop = section[0].start, section[0].stop
+            orders = self.order_numbers(stop)[start:stop]
         # print(datadict)
 
         sci_ext = [1, 2, 3]
         var_ext = [4, 5, 6]
         wl_ext = [7, 8, 9]
-        blaze_ext = [15, 16, 17]
+        blaze_ext = self.blaze_extensions()
         header_kws = list(datadict.keys())
         # print(header_kws)
         for n, ext in enumerate(sci_ext):
@@ -154,7 +182,8 @@ class Handle_NEID:
             blaze = datadict[blaze_kw].astype(np.float64)
             header_ext = headerdict[header_kws[0]]
             # print(header_ext)
-            corr_wl, corr_header = self.barycorr(wl, header_ext)
+            corr_wl, corr_header = self.barycorr(wl, header_ext,
+                                                 orders=orders)
             headerdict[header_kws[0]] = corr_header
             newblaze = np.ones(blaze.shape)
             corr_flux = flux / blaze
@@ -164,7 +193,8 @@ class Handle_NEID:
             datadict[blaze_kw] = newblaze
         if contnorm:
             from .spectral_utils import continuum_normalize
-            datadict = continuum_normalize(datadict, sci_ext, var_ext, wl_ext)
+            datadict = continuum_normalize(datadict, sci_ext, var_ext, wl_ext,
+                                           wl_mask=wl_mask)
         return datadict, headerdict
 
     def req_qtys(self):
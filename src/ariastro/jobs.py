@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import uuid
+import asyncio
+import logging
+import threading
+import contextvars
+from functools import partial
+
+from .logger import logger
+from .logger import formatter
+
+_current_job = contextvars.ContextVar("ariastro_job", default=None)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it is cancelled."""
+
+
+class Job:
+    """
+    Context of one reduction run in a shared process.
+
+    While a job is active in a thread (see `run_job`), the messages of
+    the AriAstro logger emitted by that thread are also sent to the
+    handlers of the job only, and `check_cancelled` raises
+    `JobCancelled` once `cancel` has been called.
+
+    Parameters
+    ----------
+    job_id : str or None, optional
+        Identifier of the job. A random one is drawn if None.
+    log_file : str or None, optional
+        File receiving the messages of this job only. Default is None.
+    level : int, optional
+        Level of the job handlers. Default is ``logging.INFO``.
+
+    Attributes
+    ----------
+    logger : logging.Logger
+        Logger ``AriAstro.job.<job_id>`` for messages of the caller about
+        this job.
+    records : list of logging.LogRecord
+        Messages of the job, kept in memory.
+    """
+
+    def __init__(self, job_id=None, log_file=None, level=logging.INFO):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.logger = logger.getChild("job.{}".format(self.job_id))
+        self.records = []
+        self._cancel = threading.Event()
+        self.handlers = [_RecordHandler(self.records)]
+        if log_file is not None:
+            handler = logging.FileHandler(log_file)
+            handler.setFormatter(formatter)
+            self.handlers.append(handler)
+        for handler in self.handlers:
+            handler.setLevel(level)
+            handler.addFilter(_JobFilter(self))
+
+    def cancel(self):
+        """Ask the job to stop at its next cancellation point."""
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def __enter__(self):
+        for handler in self.handlers:
+            logger.addHandler(handler)
+        return self
+
+    def __exit__(self, *exc):
+        for handler in self.handlers:
+            logger.removeHandler(handler)
+            handler.close()
+        return False
+
+
+class _JobFilter(logging.Filter):
+    """Pass the records emitted while `job` is the current job."""
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+
+    def filter(self, record):
+        return _current_job.get() is self.job \
+            or record.name == self.job.logger.name
+
+
+class _RecordHandler(logging.Handler):
+
+    def __init__(self, records):
+        super().__init__()
+        self._records = records
+
+    def emit(self, record):
+        self._records.append(record)
+
+
+def current_job():
+    """Return the job running in this thread, or None."""
+    return _current_job.get()
+
+
+def check_cancelled():
+    """
+    Cancellation point: raise `JobCancelled` if the current job was
+    cancelled. Does nothing outside a job.
+    """
+    job = _current_job.get()
+    if job is not None and job.cancelled:
+        raise JobCancelled("Job {} cancelled".format(job.job_id))
+
+
+def run_job(job, func, *args, **kwargs):
+    """
+    Run ``func(*args, **kwargs)`` in the current thread as `job`.
+
+    Returns
+    -------
+    The result of `func`.
+    """
+    token = _current_job.set(job)
+    try:
+        with job:
+            job.logger.info("Job {} started: {}".format(job.job_id,
+                                                        func.__name__))
+            try:
+                result = func(*args, **kwargs)
+            except JobCancelled:
+                job.logger.warning("Job {} cancelled".format(job.job_id))
+                raise
+            job.logger.info("Job {} finished".format(job.job_id))
+            return result
+    finally:
+        _current_job.reset(token)
+
+
+async def run_job_async(func, *args, job=None, executor=None, **kwargs):
+    """
+    Run ``func(*args, **kwargs)`` as a job in an executor thread.
+
+    When the awaiting task is cancelled, the job is cancelled too: it
+    stops at its next cancellation point (between blocks of rows, files
+    or extensions) without writing its output, and the
+    `asyncio.CancelledError` is re-raised once the thread is done.
+
+    Parameters
+    ----------
+    func : callable
+        Function to run, e.g. `combine_process`.
+    job : Job or None, optional
+        Job context. A new one is created if None.
+    executor : concurrent.futures.Executor or None, optional
+        Executor of the job thread. Default is the loop default executor.
+
+    Returns
+    -------
+    The result of `func`.
+    """
+    job = job or Job()
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, partial(run_job, job, func,
+                                                    *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        job.cancel()
+        try:
+            await future
+        except (JobCancelled, asyncio.CancelledError):
+            pass
+        raise
+
+
+async def acombine_process(files, opfilename, job=None, executor=None,
+                           **kwargs):
+    """Async `ariastro.handle_frame.combine_process`, run as a job."""
+    from .handle_frame import combine_process
+    return await run_job_async(combine_process, files, opfilename,
+                               job=job, executor=executor, **kwargs)
+
+
+async def aoperate_process(ip1, ip2, opfilename, job=None, executor=None,
+                           **kwargs):
+    """Async `ariastro.handle_frame.operate_process`, run as a job."""
+    from .handle_frame import operate_process
+    return await run_job_async(operate_process, ip1, ip2, opfilename,
+                               job=job, executor=executor, **kwargs)
+
+
+async def acombine_spectra(filesre, opfilename, job=None, executor=None,
+                           **kwargs):
+    """Async `ariastro.spectral_utils.combine_spectra`, run as a job."""
+    from .spectral_utils import combine_spectra
+    return await run_job_async(combine_spectra, filesre,
+                               opfilename=opfilename, job=job,
+                               executor=executor, **kwargs)
+
+# End
@@ -0,0 +1,391 @@
+# Optional compiled kernels for the combine and propagation hot loops.
+import warnings
+
+import numpy as np
+from astropy.stats import biweight_location
+
+from .logger import logger
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAS_NUMBA = numba is not None
+
+'''
+Method and operation codes shared by the compiled kernels.
+'''
+
+METHOD_CODES = {'mean': 0, 'median': 1, 'biweight': 2, 'weightedavg': 3}
+OPERATION_CODES = {'+': 0, '-': 1, '*': 2, '/': 3}
+BIWEIGHT_C = 6.0
+# Columns per parallel task of the numba combine.
+COLUMN_CHUNK = 256
+
+
+def resolve_backend(backend='numpy'):
+    """
+    Decide which kernel backend to use.
+
+    Parameters
+    ----------
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Requested backend. ``'auto'`` selects Numba when it is installed.
+        Requesting ``'numba'`` without Numba installed falls back to the
+        NumPy implementation with a warning. Default is ``'numpy'``.
+
+    Returns
+    -------
+    str
+        Either ``'numba'`` or ``'numpy'``.
+
+    Raises
+    ------
+    ValueError
+        If `backend` is not one of the supported names.
+    """
+    if backend is None:
+        backend = 'numpy'
+    if backend not in ('numpy', 'numba', 'auto'):
+        raise ValueError(
+            f"Unsupported backend '{backend}'. "
+            "Supported: 'numpy', 'numba', 'auto'.")
+    if backend == 'numpy':
+        return 'numpy'
+    if HAS_NUMBA:
+        return 'numba'
+    if backend == 'numba':
+        logger.warning("Numba is not installed. "
+                       "Falling back to the NumPy kernels.")
+    return 'numpy'
+
+
+'''
+Reference (NumPy) kernels
+'''
+
+
+def combine_stack_numpy(dataarr, var=None, method='mean'):
+    """
+    NumPy reference for :func:`combine_stack`.
+
+    See :func:`combine_stack` for the parameters and return values.
+    """
+    dataarr = np.asarray(dataarr, dtype=np.float64)
+    valid = np.isfinite(dataarr)
+    if var is not None:
+        var = np.asarray(var, dtype=np.float64)
+        valid &= np.isfinite(var)
+    count = np.sum(valid, axis=0)
+    masked = np.where(valid, dataarr, np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'), \
+            warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'mean':
+            comb_data = np.nanmean(masked, axis=0)
+        elif method == 'median':
+            comb_data = np.nanmedian(masked, axis=0)
+        elif method == 'biweight':
+            comb_data = biweight_location(masked, c=BIWEIGHT_C, axis=0,
+                                          ignore_nan=True)
+        elif method == 'weightedavg':
+            if var is None:
+                raise TypeError("variances must be an array-like object")
+            weights = np.where(valid, 1.0 / var, 0.0)
+            sum_w = np.sum(weights, axis=0)
+            comb_data = np.sum(weights * np.where(valid, dataarr, 0.0),
+                               axis=0) / sum_w
+            return comb_data, 1.0 / sum_w, count
+        else:
+            raise ValueError(f"Unsupported combine method '{method}'.")
+
+        if var is None:
+            return comb_data, None, count
+        comb_var = np.sum(np.where(valid, var, 0.0), axis=0) / count**2
+    return comb_data, comb_var, count
+
+
+def propagate_numpy(arr1, arr2, var_arr1, var_arr2, operation='+'):
+    """
+    NumPy reference for :func:`propagate`.
+
+    See :func:`propagate` for the parameters and return values.
+    """
+    if operation == '+':
+        answer = np.add(arr1, arr2)
+    elif operation == '-':
+        answer = np.subtract(arr1, arr2)
+    elif operation == '*':
+        answer = np.multiply(arr1, arr2)
+    elif operation == '/':
+        answer = np.divide(arr1, arr2)
+    else:
+        raise ValueError(f"Unsupported operation '{operation}'.")
+
+    if operation in ('+', '-'):
+        var_tot = np.add(var_arr1, var_arr2)
+    elif operation == '*':
+        var_tot = var_arr1 * np.square(arr2) + var_arr2 * np.square(arr1)
+    else:
+        var_tot = (var_arr1 + var_arr2 * np.square(answer)) \
+            / np.square(arr2)
+    return answer, var_tot
+
+
+'''
+Numba kernels
+'''
+
+if HAS_NUMBA:
+
+    @numba.njit(cache=True)
+    def _median_sorted(values, n):
+        half = n // 2
+        if n % 2 == 1:
+            return values[half]
+        return 0.5 * (values[half - 1] + values[half])
+
+    @numba.njit(inline='always', cache=True)
+    def _combine_column(j, data, var, has_var, method, buf, absdev,
+                        comb_out, var_out, count_out):
+        nframe = data.shape[0]
+        n = 0
+        sum_x = 0.0
+        sum_v = 0.0
+        sum_w = 0.0
+        sum_wx = 0.0
+        for i in range(nframe):
+            x = data[i, j]
+            if not np.isfinite(x):
+                continue
+            if has_var:
+                v = var[i, j]
+                if not np.isfinite(v):
+                    continue
+                sum_v += v
+                if method == 3:
+                    sum_w += 1.0 / v
+                    sum_wx += x / v
+            buf[n] = x
+            sum_x += x
+            n += 1
+        count_out[j] = n
+        if n == 0:
+            comb_out[j] = np.nan
+            var_out[j] = np.nan
+            return
+
+        if method == 0:
+            comb_out[j] = sum_x / n
+        elif method == 3:
+            comb_out[j] = sum_wx / sum_w
+        else:
+            vals = buf[:n]
+            vals.sort()
+            med = _median_sorted(vals, n)
+            if method == 1:
+                comb_out[j] = med
+            else:
+                for k in range(n):
+                    absdev[k] = abs(vals[k] - med)
+                devs = absdev[:n]
+                devs.sort()
+                mad = _median_sorted(devs, n)
+                if mad == 0.0:
+                    comb_out[j] = med
+                else:
+                    num = 0.0
+                    den = 0.0
+                    for k in range(n):
+                        d = vals[k] - med
+                        u = d / (6.0 * mad)
+                        if abs(u) < 1.0:
+                            u2 = 1.0 - u * u
+                            num += d * u2 * u2
+                            den += u2 * u2
+                    comb_out[j] = med + num / den
+
+        if method == 3:
+            var_out[j] = 1.0 / sum_w
+        elif has_var:
+            var_out[j] = sum_v / (n * n)
+        else:
+            var_out[j] = np.nan
+
+    @numba.njit(parallel=True, cache=True)
+    def _combine_columns(data, var, has_var, method,
+                         comb_out, var_out, count_out):
+        nframe, npix = data.shape
+        # The scratch buffers are allocated once per chunk of columns,
+        # not once per pixel.
+        nchunk = (npix + COLUMN_CHUNK - 1) // COLUMN_CHUNK
+        for chunk in numba.prange(nchunk):
+            buf = np.empty(nframe)
+            absdev = np.empty(nframe)
+            stop = min((chunk + 1) * COLUMN_CHUNK, npix)
+            for j in range(chunk * COLUMN_CHUNK, stop):
+                _combine_column(j, data, var, has_var, method, buf, absdev,
+                                comb_out, var_out, count_out)
+
+    @numba.guvectorize(
+        ['void(float64, float64, float64, float64, int64, '
+         'float64[:], float64[:])'],
+        '(),(),(),(),()->(),()', nopython=True, cache=True)
+    def _propagate_ufunc(x, y, vx, vy, op, answer, var_tot):
+        if op == 0:
+            answer[0] = x + y
+            var_tot[0] = vx + vy
+        elif op == 1:
+            answer[0] = x - y
+            var_tot[0] = vx + vy
+        elif op == 2:
+            answer[0] = x * y
+            var_tot[0] = vx * y * y + vy * x * x
+        else:
+            a = x / y
+            answer[0] = a
+            var_tot[0] = (vx + vy * a * a) / (y * y)
+
+
+def combine_stack(dataarr, var=None, method='mean', backend='auto', axis=0):
+    """
+    Combine a stack of frames in one fused pass per pixel column.
+
+    The combined value, the propagated variance and the number of
+    contributing frames are computed together, so the stack is traversed
+    only once. Non-finite data (or variance) samples are skipped.
+
+    Parameters
+    ----------
+    dataarr : array_like
+        Stack of shape (N, ...). The combination is along axis 0.
+    var : array_like or None, optional
+        Variance stack with the same shape as `dataarr`. Default is None.
+    method : {'mean', 'median', 'biweight', 'weightedavg'}, optional
+        Combine method. Default is ``'mean'``.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend (see :func:`resolve_backend`). Default is ``'auto'``.
+    axis : int, optional
+        Stack axis. With ``axis=-1`` (pixel-major stack) the compiled
+        kernel reads the samples of a pixel contiguously, through a
+        transposed view instead of a copy. Default is 0.
+
+    Returns
+    -------
+    comb_data : ndarray
+        Combined data with the shape of `dataarr` without `axis`.
+    comb_var : ndarray or None
+        Propagated variance, ``sum(var) / count**2`` over the valid
+        samples (``1 / sum(1/var)`` for ``'weightedavg'``). None when
+        `var` is not given.
+    count : ndarray
+        Number of valid samples per pixel.
+
+    Notes
+    -----
+    For stacks without NaNs the results are identical to
+    :func:`ariastro.operations.combine_data`.
+    """
+    if method not in METHOD_CODES:
+        raise ValueError(f"Unsupported combine method '{method}'.")
+    if method == 'weightedavg' and var is None:
+        raise TypeError("variances must be an array-like object")
+    if resolve_backend(backend) == 'numpy':
+        if axis != 0:
+            dataarr = np.moveaxis(np.asarray(dataarr), axis, 0)
+            var = None if var is None \
+                else np.moveaxis(np.asarray(var), axis, 0)
+        return combine_stack_numpy(dataarr, var, method)
+
+    dataarr = np.asarray(dataarr, dtype=np.float64)
+    if axis % dataarr.ndim == dataarr.ndim - 1 and dataarr.ndim > 1:
+        # (pixels, N) rows, seen by the kernel as (N, pixels) columns.
+        shape = dataarr.shape[:-1]
+        nframe = dataarr.shape[-1]
+        data2d = np.ascontiguousarray(dataarr.reshape(-1, nframe)).T
+        if var is None:
+            var2d = np.empty((0, 0))
+        else:
+            var2d = np.ascontiguousarray(np.asarray(
+                var, dtype=np.float64).reshape(-1, nframe)).T
+    else:
+        dataarr = np.moveaxis(dataarr, axis, 0)
+        shape = dataarr.shape[1:]
+        data2d = np.ascontiguousarray(dataarr.reshape(dataarr.shape[0], -1))
+        if var is None:
+            var2d = np.empty((0, 0))
+        else:
+            var2d = np.ascontiguousarray(np.moveaxis(np.asarray(
+                var, dtype=np.float64), axis, 0).reshape(data2d.shape))
+    npix = data2d.shape[1]
+    comb_out = np.empty(npix)
+    var_out = np.empty(npix)
+    count_out = np.empty(npix, dtype=np.int64)
+    _combine_columns(data2d, var2d, var is not None, METHOD_CODES[method],
+                     comb_out, var_out, count_out)
+    comb_var = var_out.reshape(shape) if var is not None else None
+    return comb_out.reshape(shape), comb_var, count_out.reshape(shape)
+
+
+def propagate(arr1, arr2, var_arr1, var_arr2, operation='+',
+              backend='auto'):
+    """
+    Apply an arithmetic operation and propagate the variance together.
+
+    Parameters
+    ----------
+    arr1, arr2 : array_like or float
+        Operands. They are broadcast against each other.
+    var_arr1, var_arr2 : array_like or float
+        Variances of the operands. Use 0 for an exact operand.
+    operation : {'+', '-', '*', '/'}, optional
+        Arithmetic operation. Default is ``'+'``.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend (see :func:`resolve_backend`). Default is ``'auto'``.
+
+    Returns
+    -------
+    answer : ndarray
+        Result of the operation.
+    var_tot : ndarray
+        Propagated variance.
+
+    Notes
+    -----
+    The product and quotient variances are written without dividing by
+    the operands, ``var1*arr2**2 + var2*arr1**2`` and
+    ``(var1 + var2*answer**2) / arr2**2``. They equal the relative-error
+    form used by :func:`ariastro.operations.ari_operations` wherever that
+    form is defined, and stay finite where an operand is zero.
+    """
+    if operation not in OPERATION_CODES:
+        raise ValueError(f"Unsupported operation '{operation}'.")
+    if resolve_backend(backend) == 'numpy':
+        return propagate_numpy(arr1, arr2, var_arr1, var_arr2, operation)
+    return _propagate_ufunc(arr1, arr2, var_arr1, var_arr2,
+                            OPERATION_CODES[operation])
+
+
+def propagate_into(arr1, arr2, var_arr1, var_arr2, out, var_out,
+                   operation='+'):
+    """
+    Compiled :func:`propagate` writing into caller-provided buffers.
+
+    Every output element is computed from the matching input elements
+    only, so `out` and `var_out` may alias `arr1` and `var_arr1`.
+    Requires Numba and float64 output buffers.
+
+    Returns
+    -------
+    out, var_out : ndarray
+        The filled output buffers.
+    """
+    if not HAS_NUMBA:
+        raise RuntimeError("propagate_into needs Numba.")
+    _propagate_ufunc(arr1, arr2, var_arr1, var_arr2,
+                     OPERATION_CODES[operation], out, var_out)
+    return out, var_out
+
+# End
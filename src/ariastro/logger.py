@@ -3,23 +3,39 @@ import sys
 
 logger = logging.getLogger("AriAstro")
 logger.setLevel(logging.INFO)
+# Importing the package has no side effects: the command line (or the
+# embedding application) decides where the messages go.
+logger.addHandler(logging.NullHandler())
 
-# Console handler
-ch = logging.StreamHandler(sys.stdout)
-ch.setLevel(logging.INFO)
-
-# File handler
 log_filename = "Ariastro_logs.log"
-fh = logging.FileHandler(log_filename)
-fh.setLevel(logging.INFO)
-
 
 # Formatter
 formatter = logging.Formatter(
     "%(asctime) s -%(name)s - %(levelname)s - %(message)s")
-ch.setFormatter(formatter)
-fh.setFormatter(formatter)
 
-if not logger.hasHandlers():
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+
+def configure_logging(filename=log_filename, stream=sys.stdout,
+                      level=logging.INFO):
+    """
+    Send the AriAstro messages to the console and a log file, as the
+    command line does.
+
+    Parameters
+    ----------
+    filename : str or None, optional
+        Log file. None disables it. Default is ``Ariastro_logs.log``.
+    stream : file-like or None, optional
+        Console stream. None disables it. Default is ``sys.stdout``.
+    level : int, optional
+        Logging level of the handlers. Default is ``logging.INFO``.
+    """
+    handlers = []
+    if stream is not None:
+        handlers.append(logging.StreamHandler(stream))
+    if filename is not None:
+        handlers.append(logging.FileHandler(filename))
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return handlers
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.stats import sigma_clip
+
+from .logger import logger
+from .utils import get_header
+from .readers import DEFAULT_BLOCK_ROWS
+from .readers import handle_pool
+from .readers import is_gzipped
+from .readers import iter_row_blocks
+from .readers import read_rows
+
+SCALE_MODES = ('median', 'mode', 'exptime')
+OFFSET_MODES = ('median', 'mode')
+DEFAULT_SAMPLES = 20000
+
+
+def sample_pixels(fname, ext=0, nsamples=DEFAULT_SAMPLES, seed=0):
+    """
+    Draw a pixel subsample of an image extension without reading it all.
+
+    Plain files are sampled at random positions through the memmap, so
+    only the pages holding the samples are read. Tile-compressed files
+    are sampled on evenly spaced rows, decompressing only their tiles.
+    Gzipped files cannot seek and are streamed once, keeping the evenly
+    spaced rows.
+
+    Parameters
+    ----------
+    fname : str
+        Input FITS file.
+    ext : int, optional
+        Image extension. Default is 0.
+    nsamples : int, optional
+        Approximate number of pixels. Default is 20000.
+    seed : int or None, optional
+        Seed of the random positions. Default is 0.
+
+    Returns
+    -------
+    numpy.ndarray
+        Finite sampled values, 1-D.
+    """
+    header = get_header(fname, ext=ext)
+    nrows, ncols = header['NAXIS2'], header['NAXIS1']
+    keep = np.unique(np.linspace(0, nrows - 1,
+                                 min(nrows, -(-nsamples // ncols)))
+                     .astype(int))
+    if is_gzipped(fname):
+        rows = [block[np.isin(np.arange(start, stop), keep)]
+                for start, stop, block
+                in iter_row_blocks(fname, ext, DEFAULT_BLOCK_ROWS)]
+        sample = np.concatenate(rows).ravel()
+    else:
+        with handle_pool.open(fname) as hdul:
+            compressed = isinstance(hdul[ext], fits.CompImageHDU)
+            if not compressed:
+                rng = np.random.default_rng(seed)
+                size = nrows * ncols
+                flat = np.sort(rng.choice(size, min(nsamples, size),
+                                          replace=False))
+                sample = np.asarray(hdul[ext].data.reshape(-1)[flat])
+        if compressed:
+            sample = np.concatenate([read_rows(fname, ext, row, row + 1)
+                                     for row in keep]).ravel()
+    sample = np.asarray(sample, dtype=np.float64)
+    return sample[np.isfinite(sample)]
+
+
+def sample_statistic(sample, stat='median'):
+    """
+    Median or mode of a pixel sample and its standard error.
+
+    The mode is estimated as ``2.5 median - 1.5 mean`` of the 3-sigma
+    clipped sample. The error is the standard error of the median,
+    ``1.253 sigma / sqrt(n)``, with sigma from the median absolute
+    deviation; it is a rough error for the mode.
+
+    Returns
+    -------
+    value, error : float
+    """
+    if sample.size == 0:
+        raise ValueError("No finite pixels to estimate the {}".format(stat))
+    median = np.median(sample)
+    sigma = 1.4826 * np.median(np.abs(sample - median))
+    error = 1.253 * sigma / np.sqrt(sample.size)
+    if stat == 'median':
+        return median, error
+    if stat == 'mode':
+        clipped = sigma_clip(sample, sigma=3, maxiters=5).compressed()
+        return 2.5 * np.median(clipped) - 1.5 * np.mean(clipped), error
+    raise ValueError(f"Unsupported statistic '{stat}'.")
+
+
+def _exptime(fname, ext, keyword):
+    for hext in (ext, 0):
+        header = get_header(fname, ext=hext)
+        if keyword in header:
+            return float(header[keyword])
+    raise ValueError("{} has no {} keyword".format(fname, keyword))
+
+
+def frame_normalization(files, ext=0, scale=None, offset=None,
+                        exptime_key='EXPTIME', nsamples=DEFAULT_SAMPLES,
+                        seed=0, workers=4):
+    """
+    Per-frame scale factors and offsets that bring frames to the level
+    of the first one.
+
+    A frame is normalized as ``data * scale + offset`` (and its variance
+    as ``var * scale**2``). Scales are the ratios of the statistic (or
+    exposure time) of the first frame to the one of each frame; offsets
+    are the differences of the statistic after scaling. The statistics
+    are estimated from pixel subsamples (see `sample_pixels`), in
+    parallel threads.
+
+    Parameters
+    ----------
+    files : list of str
+        Input frames.
+    ext : int, optional
+        Image extension. Default is 0.
+    scale : {'median', 'mode', 'exptime'} or None, optional
+        Statistic for the scale factors. Default is None (no scaling).
+    offset : {'median', 'mode'} or None, optional
+        Statistic for the offsets. Default is None (no offsets).
+    exptime_key : str, optional
+        Exposure time keyword for ``scale='exptime'``. Default is
+        ``'EXPTIME'``.
+    nsamples : int, optional
+        Pixels sampled per frame. Default is 20000.
+    seed : int or None, optional
+        Seed of the pixel sampling. Default is 0.
+    workers : int, optional
+        Number of reader threads. Default is 4.
+
+    Returns
+    -------
+    scales, offsets : numpy.ndarray
+        One value per frame.
+    errors : numpy.ndarray
+        Standard error of every scale (relative) and offset (absolute),
+        shape (nframes, 2); zero where exact.
+    """
+    if scale is not None and scale not in SCALE_MODES:
+        raise ValueError(f"Unsupported scale '{scale}'.")
+    if offset is not None and offset not in OFFSET_MODES:
+        raise ValueError(f"Unsupported offset '{offset}'.")
+    nframes = len(files)
+    scales = np.ones(nframes)
+    offsets = np.zeros(nframes)
+    errors = np.zeros((nframes, 2))
+    stats = {}
+    needed = {stat for stat in (scale, offset)
+              if stat in OFFSET_MODES}
+    if needed:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            samples = list(pool.map(
+                lambda fname: sample_pixels(fname, ext, nsamples, seed),
+                files))
+        for stat in needed:
+            stats[stat] = np.array([sample_statistic(sample, stat)
+                                    for sample in samples])
+
+    if scale == 'exptime':
+        exptimes = np.array([_exptime(fname, ext, exptime_key)
+                             for fname in files])
+        scales = exptimes[0] / exptimes
+    elif scale is not None:
+        values, errs = stats[scale].T
+        scales = values[0] / values
+        errors[1:, 0] = np.hypot(errs[1:] / values[1:], errs[0] / values[0])
+    if offset is not None:
+        values, errs = stats[offset].T
+        offsets = values[0] * scales[0] - values * scales
+        errors[1:, 1] = np.hypot(errs[1:] * scales[1:], errs[0] * scales[0])
+    for fname, factor, zero, (serr, oerr) in zip(files, scales, offsets,
+                                                 errors):
+        logger.info("{}: scale {:.5g} (+- {:.2g}), offset {:.5g} "
+                    "(+- {:.2g})".format(fname, factor, serr * factor,
+                                         zero, oerr))
+    return scales, offsets, errors
+
+# End
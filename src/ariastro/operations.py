@@ -2,13 +2,17 @@
 import numpy as np
 from astropy.stats import biweight_location
 
+from . import kernels
+from .uncertainty import resampled_variance
+
 
 '''
 Mathematical operations
 '''
 
 
-def ari_operations(arr1, arr2, var_arr1=None, var_arr2=None, operation='+'):
+def ari_operations(arr1, arr2, var_arr1=None, var_arr2=None, operation='+',
+                   backend='numpy'):
     """
     Perform element-wise arithmetic operations on two input arrays with
     optional variance propagation.
@@ -30,6 +34,10 @@ def ari_operations(arr1, arr2, var_arr1=None, var_arr2=None, operation='+'):
         - '-' : element-wise subtraction (`arr1 - arr2`)
         - '*' : element-wise multiplication
         - '/'  : element-wise division (`arr1 / arr2`)
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel used when both variances are given. The compiled backend
+        computes the result and the variance in one fused pass (see
+        `ariastro.kernels.propagate`). Default is 'numpy'.
 
     Returns
     -------
@@ -61,6 +69,15 @@ def ari_operations(arr1, arr2, var_arr1=None, var_arr2=None, operation='+'):
     >>> ari_operations(a, b, var_a, var_b, operation='+')
     array([0.3, 0.3, 0.3])
     """
+    if (var_arr1 is not None) & (var_arr2 is not None) \
+            and kernels.resolve_backend(backend) == 'numba':
+        if operation not in kernels.OPERATION_CODES:
+            raise ValueError(
+                f"Unsupported operation '{operation}'. Supported: ",
+                "'+', '-', '*', '/'.")
+        return kernels.propagate(arr1, arr2, var_arr1, var_arr2,
+                                 operation=operation, backend='numba')
+
     if operation == '+':
         answer = arr1 + arr2
     elif operation == '-':
@@ -84,12 +101,260 @@ def ari_operations(arr1, arr2, var_arr1=None, var_arr2=None, operation='+'):
     return answer, None
 
 
+def _is_zero_variance(var):
+    """Return True if `var` is None or the scalar 0."""
+    return var is None or (np.ndim(var) == 0 and var == 0)
+
+
+def _result_dtype(operation, with_var, *operands):
+    """
+    Type of the result of `operation` on `operands`, as the ufunc would
+    give it; integer results are float64 for a division or with variances.
+    """
+    dtype = np.result_type(*operands)
+    if not np.issubdtype(dtype, np.inexact) \
+            and (operation == '/' or with_var):
+        dtype = np.dtype(np.float64)
+    return dtype
+
+
+def _leading_slice(arr, start, stop, ndim, nrows):
+    """Slice the leading axis of `arr` as broadcast to an `ndim` result."""
+    if np.ndim(arr) == ndim and np.shape(arr)[0] == nrows and nrows > 1:
+        return arr[start:stop]
+    return arr
+
+
+def ari_operations_out(arr1, arr2, var_arr1=None, var_arr2=None,
+                       operation='+', out=None, var_out=None,
+                       inplace=False, block_elements=65536,
+                       backend='numpy'):
+    """
+    Arithmetic operation with variance propagation into output buffers.
+
+    This is the allocation-free counterpart of `ari_operations`. The value
+    and the variance are computed together, block by block along the
+    leading axis, so each block of the operands is read while it is
+    still in cache. Only one or two scratch buffers of a single block are
+    allocated. Scalars and smaller operands are broadcast by the ufuncs and
+    are never expanded to full-size arrays.
+
+    Parameters
+    ----------
+    arr1 : numpy.ndarray or float
+        First operand.
+    arr2 : numpy.ndarray or float
+        Second operand, broadcastable against `arr1`.
+    var_arr1, var_arr2 : numpy.ndarray, float or None, optional
+        Variances of the operands. ``None`` (or the scalar 0) marks an
+        exact operand; its variance terms are skipped. If both are
+        ``None`` no variance is computed.
+    operation : {'+', '-', '*', '/'}, optional
+        Arithmetic operation. Default is '+'.
+    out : numpy.ndarray or None, optional
+        Buffer for the result, with the broadcast shape of the operands.
+        Allocated if not given, with the result type of the operands and
+        variances (e.g. float32 for float32 frames, float64 for integer
+        frames divided or with variances).
+    var_out : numpy.ndarray or None, optional
+        Buffer for the variance. Allocated as `out` if not given and a
+        variance is propagated.
+    inplace : bool, optional
+        Write the result into `arr1` and the variance into `var_arr1`.
+        Both must be arrays of the full result shape. Default is False.
+    block_elements : int, optional
+        Approximate number of elements processed per block.
+        Default is 65536 (512 kB of float64).
+    backend : {'numpy', 'numba', 'auto'}, optional
+        With the compiled backend the whole operation runs as one fused
+        loop (`ariastro.kernels.propagate_into`). Default is 'numpy'.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Result of the operation.
+    var_out : numpy.ndarray or None
+        Propagated variance, or None if both variances are None.
+
+    Raises
+    ------
+    ValueError
+        If `operation` is not supported or a buffer has the wrong shape.
+
+    Notes
+    -----
+    The product and quotient variances are computed as
+    ``var1*arr2**2 + var2*arr1**2`` and ``(var1 + var2*answer**2)/arr2**2``,
+    which equal the expressions of `ari_operations` wherever those are
+    defined.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> frame = np.full((4, 4), 10.0)
+    >>> var = np.full((4, 4), 2.0)
+    >>> res, res_var = ari_operations_out(frame, 2.0, var, None,
+    ...                                   operation='/', inplace=True)
+    >>> res is frame, float(frame[0, 0]), float(var[0, 0])
+    (True, 5.0, 0.5)
+    """
+    if operation not in ('+', '-', '*', '/'):
+        raise ValueError(
+            f"Unsupported operation '{operation}'. Supported: "
+            "'+', '-', '*', '/'.")
+    with_var = (var_arr1 is not None) or (var_arr2 is not None)
+    zero1 = _is_zero_variance(var_arr1)
+    zero2 = _is_zero_variance(var_arr2)
+    shape = np.broadcast_shapes(np.shape(arr1), np.shape(arr2))
+    var_shape = np.broadcast_shapes(shape, np.shape(var_arr1)
+                                    if not zero1 else (),
+                                    np.shape(var_arr2)
+                                    if not zero2 else ())
+
+    if inplace:
+        out = arr1
+        if with_var:
+            var_out = var_arr1
+    dtype = _result_dtype(operation, with_var, arr1, arr2,
+                          *[var for var in (var_arr1, var_arr2)
+                            if var is not None])
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    if with_var and var_out is None:
+        var_out = np.empty(var_shape, dtype=dtype)
+    if np.shape(out) != shape or \
+            (with_var and np.shape(var_out) != var_shape):
+        raise ValueError(
+            "Output buffers must have the broadcast shape {}".format(shape))
+
+    if not with_var:
+        {'+': np.add, '-': np.subtract,
+         '*': np.multiply, '/': np.divide}[operation](arr1, arr2, out=out)
+        return out, None
+
+    if kernels.resolve_backend(backend) == 'numba' \
+            and out.dtype == np.float64 and var_out.dtype == np.float64:
+        kernels.propagate_into(arr1, arr2,
+                               0.0 if zero1 else var_arr1,
+                               0.0 if zero2 else var_arr2,
+                               out, var_out, operation=operation)
+        return out, var_out
+
+    if len(shape) == 0:
+        answer, var_tot = kernels.propagate_numpy(
+            arr1, arr2, 0.0 if zero1 else var_arr1,
+            0.0 if zero2 else var_arr2, operation)
+        out[...] = answer
+        var_out[...] = var_tot
+        return out, var_out
+
+    ndim = len(shape)
+    nrows = shape[0]
+    row_size = max(int(np.prod(shape[1:])), 1)
+    step = max(block_elements // row_size, 1)
+    scratch = np.empty((min(step, nrows),) + shape[1:],
+                       dtype=np.result_type(out, var_out))
+    scratch2 = None
+    if operation == '/':
+        scratch2 = np.empty_like(scratch)
+
+    for start in range(0, nrows, step):
+        stop = min(start + step, nrows)
+        x = _leading_slice(arr1, start, stop, ndim, nrows)
+        y = _leading_slice(arr2, start, stop, ndim, nrows)
+        v1 = None if zero1 else \
+            _leading_slice(var_arr1, start, stop, ndim, nrows)
+        v2 = None if zero2 else \
+            _leading_slice(var_arr2, start, stop, ndim, nrows)
+        res = out[start:stop]
+        vres = var_out[start:stop]
+        tmp = scratch[:stop - start]
+
+        if operation in ('+', '-'):
+            if v1 is None and v2 is None:
+                vres[...] = 0.0
+            elif v2 is None:
+                np.copyto(vres, v1)
+            elif v1 is None:
+                np.copyto(vres, v2)
+            else:
+                np.add(v1, v2, out=vres)
+            ufunc = np.add if operation == '+' else np.subtract
+            ufunc(x, y, out=res)
+        elif operation == '*':
+            # The variance is needed before `res` may overwrite `x`.
+            if v1 is None:
+                vres[...] = 0.0
+            else:
+                np.square(y, out=tmp)
+                np.multiply(tmp, v1, out=vres)
+            if v2 is not None:
+                np.square(x, out=tmp)
+                tmp *= v2
+                vres += tmp
+            np.multiply(x, y, out=res)
+        else:
+            tmp2 = scratch2[:stop - start]
+            np.divide(x, y, out=tmp)
+            if v2 is None:
+                vres[...] = 0.0 if v1 is None else v1
+            else:
+                np.square(tmp, out=tmp2)
+                tmp2 *= v2
+                if v1 is None:
+                    np.copyto(vres, tmp2)
+                else:
+                    np.add(tmp2, v1, out=vres)
+            np.square(y, out=tmp2)
+            vres /= tmp2
+            np.copyto(res, tmp)
+    return out, var_out
+
+
 '''
 Combine
 '''
 
 
-def combine_data(dataarr, var=None, method='mean'):
+def combine_diagnostics(dataarr, var=None):
+    """
+    Per-pixel quality maps of a stack, for the QA of a combine.
+
+    Parameters
+    ----------
+    dataarr : array_like
+        Stack of shape (N, ...).
+    var : array_like, optional
+        Variance stack of the same shape. Samples with a non-finite
+        variance count as rejected, as in the combine. Default is None.
+
+    Returns
+    -------
+    diagnostics : dict
+        ``'NCOMBINE'``: number of valid samples of every pixel, in the
+        smallest unsigned integer type holding N. ``'STDDEV'``: sample
+        standard deviation of the valid samples (float32, NaN with less
+        than two). ``'REJFRAC'``: fraction of the N samples that are not
+        valid (float32).
+    """
+    dataarr = np.asarray(dataarr, dtype=np.float64)
+    N = dataarr.shape[0]
+    valid = np.isfinite(dataarr)
+    if var is not None:
+        valid &= np.isfinite(np.asarray(var, dtype=np.float64))
+    count = np.sum(valid, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(np.where(valid, dataarr, 0.0), axis=0) / count
+        sumsq = np.sum(np.where(valid, (dataarr - mean) ** 2, 0.0), axis=0)
+        stddev = np.where(count > 1, np.sqrt(sumsq / (count - 1)), np.nan)
+    return {'NCOMBINE': count.astype(np.min_scalar_type(N)),
+            'STDDEV': stddev.astype(np.float32),
+            'REJFRAC': (1.0 - count / N).astype(np.float32)}
+
+
+def combine_data(dataarr, var=None, method='mean', backend='numpy',
+                 uncertainty='propagate', nsamples=200, seed=None,
+                 diagnostics=False, axis=0):
     """
     Combine multiple arrays along the first axis using a specified method.
 
@@ -111,47 +376,106 @@ def combine_data(dataarr, var=None, method='mean'):
         - 'biweight' : robust biweight location (from `astropy.stats`).
 
         Default is 'mean'.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend. With 'numba' (or 'auto' when Numba is installed)
+        the combined value and variance are computed by
+        `ariastro.kernels.combine_stack` in one pass per pixel column.
+        Default is 'numpy'.
+    uncertainty : {'propagate', 'bootstrap', 'jackknife'}, optional
+        How the variance of the combined data is obtained. 'propagate'
+        propagates `var` (see Notes). 'bootstrap' and 'jackknife' resample
+        the stack and return the empirical variance of the chosen method,
+        even when `var` is None (see
+        `ariastro.uncertainty.resampled_variance`). Default is 'propagate'.
+    nsamples : int, optional
+        Number of bootstrap resamples. Default is 200.
+    seed : int or None, optional
+        Seed of the bootstrap resamples. Default is None.
+    diagnostics : bool, optional
+        Also return the NCOMBINE, STDDEV and REJFRAC maps of the stack
+        (see `combine_diagnostics`), computed from the stack already in
+        memory. Default is False.
+    axis : int, optional
+        Stack axis. Pixel-major stacks (e.g. the blocks of a stack cube)
+        are combined along ``axis=-1`` in place, without a frame-major
+        copy, except for the resampled uncertainties and the diagnostics.
+        Default is 0.
 
     Returns
     -------
     comb_data : ndarray
-        Combined data array, same shape as a single input array
-        (i.e., shape of `dataarr[0]`).
+        Combined data array, the shape of `dataarr` without `axis`
+        (i.e., shape of `dataarr[0]` for ``axis=0``).
     comb_var : ndarray, optional
         Combined variance array of the same shape as `comb_data`.
         Returned only if `var` is provided.
+    diagnostics : dict
+        Quality maps, returned only with ``diagnostics=True``.
 
     Notes
     -----
     - NaN values in `dataarr` are ignored during combination.
     - Variance is propagated as if the combination method were the mean,
       even if `median` or `biweight` are chosen. This provides an
-      approximate uncertainty estimate.
+      approximate uncertainty estimate; use `uncertainty` for an
+      empirical one.
     - The biweight method is less sensitive to outliers than the mean
       or median.
+    - The propagated variance is the sum of the variances of the valid
+      (finite data and variance) samples of every pixel divided by their
+      number squared, so rejected (NaN) samples do not shrink it. Both
+      backends agree; for stacks without NaNs this is ``sum(var) / N**2``.
     """
+    if axis != 0 and (diagnostics or uncertainty != 'propagate'):
+        dataarr = np.moveaxis(np.asarray(dataarr), axis, 0)
+        var = None if var is None else np.moveaxis(np.asarray(var), axis, 0)
+        axis = 0
+    if diagnostics:
+        comb_data, comb_var = combine_data(dataarr, var, method=method,
+                                           backend=backend,
+                                           uncertainty=uncertainty,
+                                           nsamples=nsamples, seed=seed)
+        return comb_data, comb_var, combine_diagnostics(dataarr, var)
+    if uncertainty != 'propagate':
+        comb_data, _ = combine_data(dataarr, var, method=method,
+                                    backend=backend)
+        comb_var = resampled_variance(dataarr, var, method=method,
+                                      mode=uncertainty, nsamples=nsamples,
+                                      seed=seed)
+        return comb_data, comb_var
+    if kernels.resolve_backend(backend) == 'numba':
+        comb_data, comb_var, _ = kernels.combine_stack(dataarr, var,
+                                                       method=method,
+                                                       backend='numba',
+                                                       axis=axis)
+        return comb_data, comb_var
     if method == 'weightedavg':
-        comb_data, comb_var = weighted_mean_and_variance(dataarr, var)
+        comb_data, comb_var = weighted_mean_and_variance(dataarr, var,
+                                                         axis=axis)
         return comb_data, comb_var
-    dataarr = np.array(dataarr)
-    N = dataarr.shape[0]
+    dataarr = np.asarray(dataarr)
     # print(dataarr.shape)
     if method == 'mean':
-        comb_data = np.nanmean(dataarr, axis=0)
+        comb_data = np.nanmean(dataarr, axis=axis)
     elif method == 'median':
-        comb_data = np.nanmedian(dataarr, axis=0)
+        comb_data = np.nanmedian(dataarr, axis=axis)
     elif method == 'biweight':
-        comb_data = biweight_location(dataarr, axis=0)
+        comb_data = biweight_location(dataarr, axis=axis)
     # Propagating error.
     # Treating the error propagation
     # as mean for median also.
     if var is not None:
-        comb_var = np.sum(var, axis=0) / N**2
+        var = np.asarray(var, dtype=np.float64)
+        valid = np.isfinite(dataarr) & np.isfinite(var)
+        count = np.sum(valid, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            comb_var = np.sum(np.where(valid, var, 0.0),
+                              axis=axis) / count**2
         return comb_data, comb_var
     return comb_data, None
 
 
-def weighted_mean_and_variance(values, variances):
+def weighted_mean_and_variance(values, variances, axis=0):
     r"""
     Compute the weighted mean and variance of the mean,
     given measurements and their variances.
@@ -162,6 +486,8 @@ def weighted_mean_and_variance(values, variances):
         Measured values (x_i)
     variances : array-like
         Variances of the measurements.
+    axis : int, optional
+        Axis of the measurements. Default is 0.
 
     Returns
     ----------
@@ -195,16 +521,20 @@ def weighted_mean_and_variance(values, variances):
     if variances is None:
         raise TypeError("variances must be an array-like object")
 
-    weights = 1.0 / variances
-    mean = np.sum(weights * values, axis=0) / np.sum(weights, axis=0)
-    variance_of_mean = 1.0 / np.sum(weights, axis=0)
+    weights = 1.0 / np.asarray(variances, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    mean = np.sum(weights * values, axis=axis) / np.sum(weights, axis=axis)
+    variance_of_mean = 1.0 / np.sum(weights, axis=axis)
 
     return mean, variance_of_mean
 
 
 def combine_data_full(datadict, dataext=[1, 2, 3],
                       varext=[4, 5, 6],
-                      method='mean'):
+                      method='mean',
+                      backend='numpy',
+                      uncertainty='propagate',
+                      diagnostics=False):
     """
     Combine flux and variance data from multiple FITS files into a single
     dictionary.
@@ -233,6 +563,16 @@ def combine_data_full(datadict, dataext=[1, 2, 3],
         - ``'mean'`` : compute the mean across input files
         - ``'median'`` : compute the median across input files
         - ``'biweight'`` : compute the biweight across input files
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend passed to `combine_data`. Default is ``'numpy'``.
+    uncertainty : {'propagate', 'bootstrap', 'jackknife'}, optional
+        Variance estimate passed to `combine_data`. Default is
+        ``'propagate'``.
+    diagnostics : bool, optional
+        Add the quality maps of every flux extension (see
+        `combine_diagnostics`) as ``<flux key>_NCOMBINE``,
+        ``<flux key>_STDDEV`` and ``<flux key>_REJFRAC`` entries after the
+        existing keys. Default is False.
 
     Returns
     -------
@@ -242,6 +582,7 @@ def combine_data_full(datadict, dataext=[1, 2, 3],
         - Keys in ``flux_keys`` and ``var_keys`` contain the combined
           arrays.
         - Other keys are reduced to the first element of their array.
+        - With `diagnostics`, the quality maps.
 
     Notes
     -----
@@ -294,11 +635,17 @@ def combine_data_full(datadict, dataext=[1, 2, 3],
     for index, extk in enumerate(flux_keys):
         fluxes = comb_dicts[flux_keys[index]]
         variances = comb_dicts[var_keys[index]]
-        comb_flux, comb_var = combine_data(fluxes, variances,
-                                           method=method)
-
-        comb_dicts[flux_keys[index]] = comb_flux
-        comb_dicts[var_keys[index]] = comb_var
+        result = combine_data(fluxes, variances,
+                              method=method,
+                              backend=backend,
+                              uncertainty=uncertainty,
+                              diagnostics=diagnostics)
+
+        comb_dicts[flux_keys[index]] = result[0]
+        comb_dicts[var_keys[index]] = result[1]
+        if diagnostics:
+            for name, qa_map in result[2].items():
+                comb_dicts["{}_{}".format(extk, name)] = qa_map
     # print(datadict[flux_keys[0]].shape)
     return comb_dicts
 
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+import json
+import glob
+import fnmatch
+import hashlib
+import tomllib
+import threading
+from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from .logger import logger
+from .checkpoint import _atomic_write_text
+from .handle_frame import operate_process
+from .handle_frame import combine_process
+from .handle_frame import divide_smoothgradient
+from .handle_frame import remove_cosmic_rays
+from .spectral_utils import combine_spectra
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+STEP_KEYS = ('run', 'inputs', 'output')
+STATE_FILE = ".ariastro_pipeline.json"
+
+
+def _run_operation(inputs, output, **params):
+    operand = inputs[1]
+    if isinstance(operand, (int, float)):
+        operand = float(operand)
+    operate_process(inputs[0], operand, output, **params)
+
+
+def _run_combine(inputs, output, **params):
+    combine_process(list(inputs), output, **params)
+
+
+def _run_divide_smoothgradient(inputs, output, **params):
+    if 'medsmoothsize' in params:
+        params['medsmoothsize'] = tuple(params['medsmoothsize'])
+    divide_smoothgradient(inputs[0], output, **params)
+
+
+def _run_remove_cosmic_rays(inputs, output, **params):
+    remove_cosmic_rays(inputs[0], output, **params)
+
+
+def _run_combine_spectra(inputs, output, **params):
+    combine_spectra(filesre=list(inputs), opfilename=output, **params)
+
+
+STEP_FUNCTIONS = {
+    'operation': _run_operation,
+    'combine': _run_combine,
+    'divide_smoothgradient': _run_divide_smoothgradient,
+    'remove_cosmic_rays': _run_remove_cosmic_rays,
+    'combine_spectra': _run_combine_spectra,
+}
+
+
+def _is_pattern(name):
+    return any(char in name for char in '*?[')
+
+
+class Step:
+    """
+    One step of a pipeline: an entry point, its inputs, its output and
+    its keyword parameters.
+
+    Parameters
+    ----------
+    name : str
+        Name of the step.
+    run : str
+        Entry point, a key of `STEP_FUNCTIONS`.
+    inputs : list of str or float
+        Input files or glob patterns (relative to `directory`). A number
+        is a constant operand of ``'operation'``.
+    output : str
+        Output file (relative to `directory`).
+    params : dict, optional
+        Keyword arguments of the entry point.
+    directory : str or Path, optional
+        Base directory of relative paths. Default is ``'.'``.
+    """
+
+    def __init__(self, name, run, inputs, output, params=None,
+                 directory='.'):
+        if run not in STEP_FUNCTIONS:
+            raise ValueError("Step '{}': unknown entry point '{}'. Choose "
+                             "from {}".format(name, run,
+                                              sorted(STEP_FUNCTIONS)))
+        self.name = name
+        self.run = run
+        directory = Path(directory)
+        self.inputs = [item if isinstance(item, (int, float))
+                       else str(directory / item)
+                       for item in inputs]
+        self.output = str(directory / output)
+        self.params = dict(params or {})
+
+    def files(self):
+        """Input file names and patterns (constants excluded)."""
+        return [item for item in self.inputs if isinstance(item, str)]
+
+    def expand(self):
+        """Inputs with the glob patterns expanded."""
+        inputs = []
+        for item in self.inputs:
+            if isinstance(item, str) and _is_pattern(item):
+                matches = sorted(glob.glob(item))
+                if not matches:
+                    raise FileNotFoundError("No file matches {}".format(item))
+                inputs.extend(matches)
+            else:
+                inputs.append(item)
+        return inputs
+
+    def consumes(self, fname):
+        """Return True if the file `fname` is one of the inputs."""
+        return any(fnmatch.fnmatch(fname, item) if _is_pattern(item)
+                   else fname == item for item in self.files())
+
+    def signature(self):
+        """Hash of the entry point, inputs, output and parameters."""
+        text = json.dumps([self.run, self.inputs, self.output, self.params],
+                          sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def __call__(self):
+        STEP_FUNCTIONS[self.run](self.expand(), self.output,
+                                 **dict(self.params))
+
+
+class Pipeline:
+    """
+    Run a set of steps in dependency order, independent steps at the
+    same time.
+
+    A step depends on every step whose output is one of its inputs (or
+    matches one of its glob patterns). Ready steps are run by a pool of
+    `workers` threads, so at most `workers` steps run at once. A step is
+    skipped when its output is newer than all its inputs and its entry
+    point, inputs and parameters are unchanged since it last ran (the
+    signatures are kept in `state_file`). A failed step is reported and
+    only its dependents are not run.
+
+    Parameters
+    ----------
+    steps : list of Step
+        Steps of the pipeline.
+    workers : int, optional
+        Maximum number of steps run at once. Default is 2.
+    state_file : str or Path, optional
+        JSON file with the signature of every step that ran. Default is
+        ``.ariastro_pipeline.json`` in the current directory.
+    """
+
+    def __init__(self, steps, workers=2, state_file=STATE_FILE):
+        self.steps = {step.name: step for step in steps}
+        if len(self.steps) != len(steps):
+            raise ValueError("Step names must be unique")
+        outputs = {}
+        for step in steps:
+            if step.output in outputs:
+                raise ValueError("Steps '{}' and '{}' write the same output "
+                                 "{}".format(outputs[step.output], step.name,
+                                             step.output))
+            outputs[step.output] = step.name
+        self.workers = workers
+        self.state_file = Path(state_file)
+        self.dependencies = {
+            step.name: {other.name for other in steps
+                        if other is not step and step.consumes(other.output)}
+            for step in steps}
+        self.order()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, fname, workers=None):
+        """
+        Read a pipeline from a TOML or YAML file.
+
+        The file has an optional ``workers`` entry and a ``steps`` table
+        with one table per step::
+
+            workers = 2
+
+            [steps.clean_a]
+            run = "remove_cosmic_rays"
+            inputs = ["night1/a.fits"]
+            output = "night1/a_cr.fits"
+            fluxext = [0]
+
+            [steps.combine]
+            run = "combine"
+            inputs = ["night*/*_cr.fits"]
+            output = "combined.fits"
+            method = "median"
+
+        Every key but ``run``, ``inputs`` and ``output`` is passed to the
+        entry point. Relative paths are relative to the directory of the
+        file, where the state file is also kept.
+
+        Parameters
+        ----------
+        fname : str or Path
+            Pipeline file (``.toml``, ``.yaml`` or ``.yml``).
+        workers : int or None, optional
+            Overrides the ``workers`` entry of the file.
+        """
+        fname = Path(fname)
+        if fname.suffix in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ImportError("PyYAML is needed to read {}".format(fname))
+            with open(fname) as fobj:
+                config = yaml.safe_load(fobj)
+        else:
+            with open(fname, 'rb') as fobj:
+                config = tomllib.load(fobj)
+        directory = fname.parent
+        steps = []
+        for name, entry in config.get('steps', {}).items():
+            missing = [key for key in STEP_KEYS if key not in entry]
+            if missing:
+                raise ValueError("Step '{}' misses {}".format(name, missing))
+            params = {key: value for key, value in entry.items()
+                      if key not in STEP_KEYS}
+            steps.append(Step(name, entry['run'], entry['inputs'],
+                              entry['output'], params, directory=directory))
+        if workers is None:
+            workers = config.get('workers', 2)
+        return cls(steps, workers=workers,
+                   state_file=directory / STATE_FILE)
+
+    def order(self):
+        """
+        Step names in a dependency order.
+
+        Raises
+        ------
+        ValueError
+            If the dependencies have a cycle.
+        """
+        done = []
+        remaining = dict(self.dependencies)
+        while remaining:
+            ready = sorted(name for name, deps in remaining.items()
+                           if deps.issubset(done))
+            if not ready:
+                raise ValueError("Pipeline has a dependency cycle among {}"
+                                 .format(sorted(remaining)))
+            done.extend(ready)
+            for name in ready:
+                del remaining[name]
+        return done
+
+    def _load_state(self):
+        if self.state_file.is_file():
+            with open(self.state_file) as fobj:
+                return json.load(fobj)
+        return {}
+
+    def is_current(self, step, state):
+        """Return True if the output of `step` is up to date."""
+        output = Path(step.output)
+        if state.get(step.name) != step.signature() or not output.exists():
+            return False
+        try:
+            inputs = step.expand()
+        except FileNotFoundError:
+            return False
+        mtime = output.stat().st_mtime_ns
+        return all(Path(item).stat().st_mtime_ns <= mtime
+                   for item in inputs if isinstance(item, str))
+
+    def run(self, force=False):
+        """
+        Run the pipeline.
+
+        Parameters
+        ----------
+        force : bool, optional
+            Run every step, even if up to date. Default is False.
+
+        Returns
+        -------
+        dict
+            Status of every step: ``'ran'``, ``'skipped'``, ``'failed'`` or
+            ``'blocked'`` (a dependency failed).
+        """
+        state = self._load_state()
+        status = {}
+        pending = dict(self.dependencies)
+        running = {}
+
+        def finish(name, result):
+            status[name] = result
+            if result == 'ran':
+                with self._lock:
+                    state[name] = self.steps[name].signature()
+                    _atomic_write_text(self.state_file,
+                                       json.dumps(state, indent=1))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for name in sorted(pending):
+                    deps = pending[name]
+                    if any(status.get(dep) in ('failed', 'blocked')
+                           for dep in deps):
+                        logger.warning("Step {} not run: a dependency "
+                                       "failed".format(name))
+                        finish(name, 'blocked')
+                        del pending[name]
+                    elif all(dep in status for dep in deps):
+                        del pending[name]
+                        step = self.steps[name]
+                        if not force and self.is_current(step, state):
+                            logger.info("Step {} is up to date".format(name))
+                            finish(name, 'skipped')
+                            continue
+                        logger.info("Running step {}".format(name))
+                        running[pool.submit(step)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as err:
+                        logger.error("Step {} failed: {}".format(name, err))
+                        finish(name, 'failed')
+                    else:
+                        finish(name, 'ran')
+        return status
+
+# End
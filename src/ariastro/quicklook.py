@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from .logger import logger
+from .operations import ari_operations_out
+from .operations import combine_data
+from .utils import get_header
+from .instrument import instrument_dict
+
+
+def decimate(data, factor, mode='stride'):
+    """
+    Reduce the last two axes of `data` by an integer factor.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Input array (a memmap is read only where needed).
+    factor : int
+        Reduction factor along each of the last two axes.
+    mode : {'stride', 'bin'}, optional
+        ``'stride'`` keeps every `factor`-th pixel; ``'bin'`` averages
+        blocks of ``factor x factor`` pixels (the edges that do not fill a
+        block are dropped). Default is ``'stride'``.
+
+    Returns
+    -------
+    numpy.ndarray
+        Reduced array (float64).
+    """
+    if mode == 'stride':
+        return np.array(data[..., ::factor, ::factor], dtype=np.float64)
+    if mode != 'bin':
+        raise ValueError(f"Unsupported quicklook mode '{mode}'.")
+    ny = (data.shape[-2] // factor) * factor
+    nx = (data.shape[-1] // factor) * factor
+    block = np.array(data[..., :ny, :nx], dtype=np.float64)
+    block = block.reshape(block.shape[:-2] + (ny // factor, factor,
+                                              nx // factor, factor))
+    return block.mean(axis=(-3, -1))
+
+
+def _read_frame(fname, fluxext, varext, factor, mode):
+    datas = []
+    variances = []
+    with fits.open(fname, memmap=True) as hdul:
+        for index, ext in enumerate(fluxext):
+            datas.append(decimate(hdul[int(ext)].data, factor, mode))
+            if varext is not None:
+                var = decimate(hdul[int(varext[index])].data, factor, mode)
+                if mode == 'bin':
+                    # Variance of the mean of factor**2 pixels.
+                    var = var / factor**2
+                variances.append(var)
+    return datas, variances
+
+
+def _flag_header(header, factor, mode):
+    header['QUICKLK'] = (True, 'Quick-look preview product')
+    header['QLFACTOR'] = (factor, 'Quick-look reduction factor')
+    header['QLMODE'] = (mode, 'Quick-look reduction mode')
+    return header
+
+
+def quicklook_process(files, opfilename, factor=4, mode='stride',
+                      method='mean', fluxext=[0], varext=None,
+                      workers=8):
+    """
+    Combine decimated frames into a small preview product.
+
+    Every frame is read through memmap, and only a strided or block-binned
+    subset is read. The subsets are combined with `combine_data`. Files are
+    read in parallel.
+
+    Parameters
+    ----------
+    files : list of str
+        Input FITS files.
+    opfilename : str
+        Output preview file.
+    factor : int, optional
+        Reduction factor along each image axis. Default is 4.
+    mode : {'stride', 'bin'}, optional
+        Decimation mode, see :func:`decimate`. Default is ``'stride'``.
+    method : str, optional
+        Combine method. Default is ``'mean'``.
+    fluxext : list of int, optional
+        Flux extensions. Default is ``[0]``.
+    varext : list of int or None, optional
+        Variance extensions. Default is None.
+    workers : int, optional
+        Number of reader threads. Default is 8.
+
+    Notes
+    -----
+    The headers of all output HDUs carry ``QUICKLK = T`` together with the
+    factor and the mode, so previews are not mistaken for science
+    products.
+    """
+    files = list(files)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(
+            lambda fname: _read_frame(fname, fluxext, varext, factor, mode),
+            files))
+    hdul = fits.HDUList([fits.PrimaryHDU(
+        header=_flag_header(fits.Header(), factor, mode))])
+    for index, ext in enumerate(fluxext):
+        ext = int(ext)
+        data_array = [frame[0][index] for frame in frames]
+        var_array = None
+        if varext is not None:
+            var_array = [frame[1][index] for frame in frames]
+        result, variance = combine_data(data_array, var_array,
+                                        method=method)
+        header = _flag_header(get_header(files[0], ext=ext), factor,
+                              mode)
+        header['HISTORY'] = method + str([Path(i).name for i in files])
+        if ext == 0:
+            hdul[0] = fits.PrimaryHDU(result, header=header)
+        else:
+            hdul.append(fits.ImageHDU(result, header=header, name="FLUX"))
+        if varext is not None:
+            hdul.append(fits.ImageHDU(
+                variance, header=_flag_header(fits.Header(), factor, mode),
+                name="VARIANCE"))
+    hdul.writeto(opfilename, overwrite=True)
+    logger.info("Quick-look of {} frames written to {}".format(
+        len(files), opfilename))
+
+
+def quicklook_operate(ip1, ip2, opfilename, factor=4, mode='stride',
+                      operation='+', fluxext=[0], varext=None,
+                      backend='numpy'):
+    """
+    Apply a binary operation to decimated frames into a preview product.
+
+    Both operands are read through memmap, and only the strided or
+    block-binned subset of :func:`decimate` is read and operated on, with
+    the variance propagated as in `operate_process`.
+
+    Parameters
+    ----------
+    ip1 : str
+        First FITS file.
+    ip2 : str or float
+        Second FITS file, decimated in the same way, or a constant.
+    opfilename : str
+        Output preview file.
+    factor : int, optional
+        Reduction factor along each image axis. Default is 4.
+    mode : {'stride', 'bin'}, optional
+        Decimation mode. Default is ``'stride'``.
+    operation : {'+', '-', '*', '/'}, optional
+        Operation. Default is ``'+'``.
+    fluxext : list of int, optional
+        Flux extensions. Default is ``[0]``.
+    varext : list of int or None, optional
+        Variance extensions. Default is None.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend of the operation. Default is ``'numpy'``.
+
+    Notes
+    -----
+    All output HDUs are flagged as in `quicklook_process`.
+    """
+    datas1, variances1 = _read_frame(ip1, fluxext, varext, factor, mode)
+    if isinstance(ip2, float):
+        label = ip2
+    else:
+        label = Path(ip2).name
+        datas2, variances2 = _read_frame(ip2, fluxext, varext, factor,
+                                         mode)
+    hdul = fits.HDUList([fits.PrimaryHDU(
+        header=_flag_header(fits.Header(), factor, mode))])
+    for index, ext in enumerate(fluxext):
+        ext = int(ext)
+        var1 = None if varext is None else variances1[index]
+        if isinstance(ip2, float):
+            data2, var2 = ip2, None
+        else:
+            data2 = datas2[index]
+            var2 = None if varext is None else variances2[index]
+        result, var = ari_operations_out(datas1[index], data2, var1, var2,
+                                         operation=operation,
+                                         backend=backend)
+        header = _flag_header(get_header(ip1, ext=ext), factor, mode)
+        header['HISTORY'] = '{} {} {}'.format(Path(ip1).name, operation,
+                                              label)
+        if ext == 0:
+            hdul[0] = fits.PrimaryHDU(result, header=header)
+        else:
+            hdul.append(fits.ImageHDU(result, header=header, name="FLUX"))
+        if varext is not None:
+            hdul.append(fits.ImageHDU(
+                var, header=_flag_header(fits.Header(), factor, mode),
+                name="VARIANCE"))
+    hdul.writeto(opfilename, overwrite=True)
+    logger.info("Quick-look of {} {} {} written to {}".format(
+        Path(ip1).name, operation, label, opfilename))
+
+
+def quicklook_spectra(files, opfilename, instrumentname=None,
+                      order_step=4, pixel_step=4, method='mean',
+                      fluxext=(1, 2, 3), varext=(4, 5, 6), wlext=(7, 8, 9),
+                      workers=8):
+    """
+    Combine a subset of orders and pixels of many spectra.
+
+    Only every `order_step`-th order and `pixel_step`-th pixel of the
+    flux, variance and wavelength extensions is read (through memmap).
+    For instruments with a blaze extension the flux is blaze corrected.
+    The spectra are not resampled: the wavelengths of the first file are
+    written, which is adequate for a preview but not for science. All
+    output HDUs are flagged as in `quicklook_process`, with the pixel
+    stride in ``QLPIXSTP``.
+
+    Parameters
+    ----------
+    files : list of str
+        Input spectra.
+    opfilename : str
+        Output preview file.
+    instrumentname : str or None, optional
+        Instrument name (e.g. 'NEID'), used for the extension layout.
+    order_step, pixel_step : int, optional
+        Strides along orders and pixels. Default is 4.
+    method : str, optional
+        Combine method. Default is ``'mean'``.
+    fluxext, varext, wlext : tuple of int, optional
+        Extension layout when no instrument is given.
+    workers : int, optional
+        Number of reader threads. Default is 8.
+    """
+    blazeext = None
+    if instrumentname is not None:
+        instrument = instrument_dict[instrumentname]()
+        fluxext, varext, wlext = instrument.fits_extensions()
+        blazeext = instrument.blaze_extensions()
+    files = list(files)
+    sub = (slice(None, None, order_step), slice(None, None, pixel_step))
+
+    def read(fname):
+        with fits.open(fname, memmap=True) as hdul:
+            fluxes, variances = [], []
+            for index, ext in enumerate(fluxext):
+                flux = np.array(hdul[ext].data[sub], dtype=np.float64)
+                var = np.array(hdul[varext[index]].data[sub],
+                               dtype=np.float64)
+                if blazeext is not None:
+                    blaze = np.array(hdul[blazeext[index]].data[sub],
+                                     dtype=np.float64)
+                    flux = flux / blaze
+                    var = var / blaze**2
+                fluxes.append(flux)
+                variances.append(var)
+        return fluxes, variances
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        spectra = list(pool.map(read, files))
+
+    def flag(header):
+        header = _flag_header(header.copy(), order_step, 'stride')
+        header['QLPIXSTP'] = (pixel_step, 'Quick-look pixel stride')
+        return header
+
+    with fits.open(files[0], memmap=True) as hdul:
+        primary_header = flag(hdul[0].header)
+        primary_header['HISTORY'] = method + str(
+            [Path(i).name for i in files])
+        hdus = [fits.PrimaryHDU(header=primary_header)]
+        combined = []
+        for index, ext in enumerate(fluxext):
+            flux, var = combine_data([spec[0][index] for spec in spectra],
+                                     [spec[1][index] for spec in spectra],
+                                     method=method)
+            combined.append((ext, flux, varext[index], var))
+        for ext, flux, _, _ in combined:
+            hdus.append(fits.ImageHDU(flux, header=flag(hdul[ext].header)))
+        for _, _, vext, var in combined:
+            hdus.append(fits.ImageHDU(var, header=flag(hdul[vext].header)))
+        for wext in wlext:
+            hdus.append(fits.ImageHDU(
+                np.array(hdul[wext].data[sub], dtype=np.float64),
+                header=flag(hdul[wext].header)))
+    fits.HDUList(hdus).writeto(opfilename, overwrite=True)
+    logger.info("Quick-look of {} spectra written to {}".format(
+        len(files), opfilename))
+
+# End
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import math
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+BLOCK = 2880
+DEFAULT_BLOCK_ROWS = 256
+HANDLE_POOL_SIZE = 64
+BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                 -32: '>f4', -64: '>f8'}
+
+
+class HandlePool:
+    """
+    Bounded pool of open FITS files, shared by the readers.
+
+    A file is opened (memmapped, all headers parsed) on first use and kept
+    open for the next reads. When more than `maxsize` files are open, the
+    least recently used ones that are not being read are closed. A file
+    that changed on disk (modification time or size) is opened again,
+    and its old handle is closed as soon as it is not being read.
+
+    A run closes the files it opened when it ends with `scope`.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of idle open files. Default is `HANDLE_POOL_SIZE`.
+
+    Examples
+    --------
+    >>> with handle_pool.open("frame.fits") as hdul:
+    ...     rows = np.array(hdul[1].data[:10])
+    >>> with handle_pool.scope():
+    ...     data = read_image("frame.fits.fz")
+    """
+
+    def __init__(self, maxsize=HANDLE_POOL_SIZE):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    @contextmanager
+    def open(self, fname):
+        """
+        Borrow the open HDUList of `fname`.
+
+        Arrays taken from it are memmaps: copy what must outlive the
+        ``with`` block.
+        """
+        path = str(Path(fname).resolve())
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._handles.pop(key, None)
+            if entry is None:
+                entry = [fits.open(path, memmap=True,
+                                   lazy_load_hdus=False), 0]
+            entry[1] += 1
+            self._handles[key] = entry
+            self._evict()
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                self._evict()
+
+    @contextmanager
+    def scope(self):
+        """
+        Close, on exit, the files opened inside the block that are not
+        being read. Files that were already open are kept.
+
+        Usable as a decorator, so that every call of a function is a
+        scope.
+        """
+        with self._lock:
+            before = set(self._handles)
+        try:
+            yield self
+        finally:
+            with self._lock:
+                for key in [key for key, entry in self._handles.items()
+                            if entry[1] == 0 and key not in before]:
+                    self._handles.pop(key)[0].close()
+
+    def _evict(self):
+        # The last key of a path is its current version on disk: the
+        # handles of older versions are closed once idle.
+        latest = {key[0]: key for key in self._handles}
+        for key in [key for key, entry in self._handles.items()
+                    if entry[1] == 0 and latest[key[0]] != key]:
+            self._handles.pop(key)[0].close()
+        excess = len(self._handles) - self.maxsize
+        if excess <= 0:
+            return
+        idle = [key for key, entry in self._handles.items()
+                if entry[1] == 0]
+        for key in idle[:excess]:
+            self._handles.pop(key)[0].close()
+
+    def close(self):
+        """Close every file that is not being read."""
+        with self._lock:
+            for key in [key for key, entry in self._handles.items()
+                        if entry[1] == 0]:
+                self._handles.pop(key)[0].close()
+
+
+handle_pool = HandlePool()
+
+
+def is_gzipped(fname):
+    """Return True if `fname` starts with the gzip magic bytes."""
+    with open(fname, 'rb') as fobj:
+        return fobj.read(2) == b'\x1f\x8b'
+
+
+def is_compressed(fname):
+    """
+    Return True if `fname` is gzipped or has tile-compressed HDUs.
+
+    Only the first bytes and the headers are read.
+    """
+    if is_gzipped(fname):
+        return True
+    with handle_pool.open(fname) as hdul:
+        return any(isinstance(hdu, fits.CompImageHDU) for hdu in hdul)
+
+
+'''
+Gzip streaming
+'''
+
+
+def _read_header(stream):
+    """Read one header from a stream positioned at its start."""
+    blocks = []
+    while True:
+        block = stream.read(BLOCK)
+        if len(block) < BLOCK:
+            raise EOFError("Unexpected end of file while reading a header")
+        blocks.append(block)
+        cards = block.decode('ascii', errors='replace')
+        if any(cards[i:i + 8].rstrip() == 'END'
+               for i in range(0, BLOCK, 80)):
+            break
+    return fits.Header.fromstring(b''.join(blocks).decode('ascii'))
+
+
+def _data_size(header):
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    npix = int(np.prod([header['NAXIS{}'.format(i + 1)]
+                        for i in range(naxis)]))
+    size = abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) \
+        * (header.get('PCOUNT', 0) + npix)
+    return ((size + BLOCK - 1) // BLOCK) * BLOCK
+
+
+def _gzip_seek_to_data(stream, ext):
+    """
+    Advance a decompressing stream to the data of extension `ext`.
+
+    The preceding data units are decompressed and discarded, never kept
+    in memory.
+    """
+    index = 0
+    while True:
+        header = _read_header(stream)
+        if index == ext or header.get('EXTNAME') == ext:
+            return header
+        stream.seek(stream.tell() + _data_size(header))
+        index += 1
+
+
+def _scale(block, header):
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale != 1 or bzero != 0:
+        return block * bscale + bzero
+    return block
+
+
+def _image_layout(header):
+    """Numpy shape, dtype and bytes per row of an image data unit."""
+    naxis = header['NAXIS']
+    shape = tuple(header['NAXIS{}'.format(i)]
+                  for i in range(naxis, 0, -1))
+    dtype = np.dtype(BITPIX_DTYPES[header['BITPIX']])
+    return shape, dtype, int(np.prod(shape[1:])) * dtype.itemsize
+
+
+def _iter_gzip_rows(fname, ext, block_rows, first=0, last=None):
+    with gzip.open(fname, 'rb') as stream:
+        header = _gzip_seek_to_data(stream, ext)
+        shape, dtype, rowbytes = _image_layout(header)
+        last = shape[0] if last is None else min(last, shape[0])
+        if first:
+            stream.seek(stream.tell() + first * rowbytes)
+        for start in range(first, last, block_rows):
+            nrows = min(block_rows, last - start)
+            buf = stream.read(nrows * rowbytes)
+            block = np.frombuffer(buf, dtype=dtype).reshape(
+                (nrows,) + shape[1:])
+            yield start, start + nrows, _scale(block, header)
+
+
+class GzipRowReader:
+    """
+    Forward reader of row ranges of a gzipped image extension.
+
+    The decompressing stream is kept open between reads and only moves
+    forward, and the rows of the last read are kept, so that a sequence of
+    increasing (possibly overlapping) ranges decompresses the file once.
+    A range that starts before the last one restarts the stream.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Gzipped FITS file.
+    ext : int or str, optional
+        Extension number or name. Default is 0.
+
+    Examples
+    --------
+    >>> with GzipRowReader("frame.fits.gz", 1) as rows:
+    ...     for start in range(0, 1000, 100):
+    ...         block = rows.read(max(start - 2, 0), start + 102)
+    """
+
+    def __init__(self, fname, ext=0):
+        self._stream = gzip.open(fname, 'rb')
+        self.header = _gzip_seek_to_data(self._stream, ext)
+        self.shape, self._dtype, self._rowbytes = \
+            _image_layout(self.header)
+        self._data_start = self._stream.tell()
+        self._rewind()
+
+    def _rewind(self):
+        self._stream.seek(self._data_start)
+        self._position = 0
+        self._kept_start = 0
+        self._kept = np.empty((0,) + self.shape[1:], dtype=self._dtype)
+
+    def read(self, start, stop):
+        """Read rows ``start:stop``, as `read_rows`."""
+        stop = min(stop, self.shape[0])
+        if start >= stop:
+            raise ValueError("Row {} is out of range".format(start))
+        if start < self._kept_start:
+            self._rewind()
+        parts = []
+        if start < self._position:
+            parts.append(self._kept[start - self._kept_start:
+                                    stop - self._kept_start])
+        if stop > self._position:
+            first = max(start, self._position)
+            self._stream.seek(self._stream.tell()
+                              + (first - self._position) * self._rowbytes)
+            buf = self._stream.read((stop - first) * self._rowbytes)
+            parts.append(np.frombuffer(buf, dtype=self._dtype).reshape(
+                (stop - first,) + self.shape[1:]))
+            self._position = stop
+            self._kept = parts[0] if len(parts) == 1 \
+                else np.concatenate(parts)
+            self._kept.flags.writeable = False
+            self._kept_start = start
+            parts = [self._kept]
+        return _scale(parts[0], self.header)
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+'''
+Row-block readers
+'''
+
+
+def tile_rows(hdu):
+    """Number of rows in one compression tile of `hdu` (1 if none)."""
+    if isinstance(hdu, fits.CompImageHDU):
+        return int(hdu.tile_shape[0])
+    return 1
+
+
+def aligned_block_rows(files, ext=0, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Round `block_rows` to a multiple of the tile height of every file, so
+    that the blocks of all files cover the same rows.
+    """
+    step = 1
+    for fname in files:
+        if is_gzipped(fname):
+            continue
+        with handle_pool.open(fname) as hdul:
+            step = math.lcm(step, tile_rows(hdul[ext]))
+    return max(step, (block_rows // step) * step)
+
+
+def iter_row_blocks(fname, ext=0, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Read an image extension block of rows by block of rows.
+
+    - Plain FITS files are read through memmap.
+    - Plain and tile-compressed files are borrowed from `handle_pool`
+      only while a block is read.
+    - Tile-compressed HDUs (``.fits.fz``) are decompressed one block at a
+      time through ``CompImageHDU.section``. Blocks are aligned to the
+      tile height so that no tile is decompressed twice.
+    - Gzipped files (``.fits.gz``) are decompressed as a stream; the file
+      is never fully inflated in memory.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Input FITS file.
+    ext : int or str, optional
+        Extension number or name. Default is 0.
+    block_rows : int, optional
+        Rows per block (along the first numpy axis). Default is 256.
+
+    Yields
+    ------
+    start, stop : int
+        Row range of the block.
+    block : numpy.ndarray
+        Data of rows ``start:stop``.
+    """
+    if is_gzipped(fname):
+        yield from _iter_gzip_rows(fname, ext, block_rows)
+        return
+    with handle_pool.open(fname) as hdul:
+        hdu = hdul[ext]
+        step = tile_rows(hdu)
+        nrows = hdu.shape[0]
+    block_rows = max(step, (block_rows // step) * step)
+    for start in range(0, nrows, block_rows):
+        stop = min(start + block_rows, nrows)
+        # The handle is only borrowed while a block is read, so that a
+        # lockstep read of many files keeps at most the pool size open.
+        yield start, stop, read_rows(fname, ext, start, stop)
+
+
+def read_rows(fname, ext, start, stop):
+    """
+    Read rows ``start:stop`` of an image extension.
+
+    A gzipped file is decompressed from its start up to `stop`; sequential
+    reads of one gzipped file should go through `GzipRowReader`.
+    """
+    if is_gzipped(fname):
+        # A single range: use GzipRowReader to read many ranges of a file.
+        with GzipRowReader(fname, ext) as rows:
+            return rows.read(start, stop)
+    with handle_pool.open(fname) as hdul:
+        hdu = hdul[ext]
+        if isinstance(hdu, fits.CompImageHDU):
+            return np.array(hdu.section[start:stop])
+        return np.array(hdu.data[start:stop])
+
+
+def read_image(fname, ext=0, workers=4):
+    """
+    Read a full image extension, decompressing tiles in parallel.
+
+    Tile-compressed images are split into `workers` row ranges, aligned
+    to the tiles, and each range is decompressed by a separate thread.
+    Gzipped files are streamed, plain files are copied from the memmap.
+    The file is opened through `handle_pool`.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Input FITS file.
+    ext : int or str, optional
+        Extension number or name. Default is 0.
+    workers : int, optional
+        Number of decompression threads. Default is 4.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if is_gzipped(fname):
+        return np.concatenate([block for _, _, block
+                               in _iter_gzip_rows(fname, ext,
+                                                  DEFAULT_BLOCK_ROWS)])
+    with handle_pool.open(fname) as hdul:
+        hdu = hdul[ext]
+        if not isinstance(hdu, fits.CompImageHDU) or workers <= 1:
+            return np.array(hdu.data)
+        nrows = hdu.shape[0]
+        step = tile_rows(hdu)
+    ntiles = (nrows + step - 1) // step
+    per_worker = max(1, (ntiles + workers - 1) // workers) * step
+    ranges = [(start, min(start + per_worker, nrows))
+              for start in range(0, nrows, per_worker)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(lambda rng: read_rows(fname, ext, *rng),
+                              ranges))
+    return np.concatenate(parts)
+
+
+def read_images(files, ext=0, workers=4):
+    """Read the same extension of many files in parallel."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda fname: read_image(fname, ext, 1),
+                             files))
+
+# End
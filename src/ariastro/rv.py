@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from scipy import fft as sp_fft
+from scipy.signal.windows import tukey
+
+from .logger import logger
+from .utils import extract_allexts
+from .operations import combine_data
+from .wlmask import MIN_WAVELENGTH
+
+C_KMS = 299792.458
+
+
+'''
+Log-lambda grids
+'''
+
+
+def _valid_wavelengths(wl):
+    wl = np.array(wl, dtype=np.float64)
+    wl[~np.isfinite(wl) | (wl < MIN_WAVELENGTH)] = np.nan
+    return wl
+
+
+def loglambda_grid(wl, oversample=1.0):
+    """
+    Build a common log-lambda grid for every order.
+
+    All orders share the same step in ln(wavelength), so a Doppler shift
+    is the same constant pixel offset everywhere. For each order the grid
+    covers the wavelength range common to all epochs.
+
+    Parameters
+    ----------
+    wl : ndarray
+        Wavelengths of shape (orders, pixels) or (epochs, orders, pixels).
+        Values below `ariastro.wlmask.MIN_WAVELENGTH` or non-finite are
+        ignored.
+    oversample : float, optional
+        Number of grid points per median input pixel. Default is 1.
+
+    Returns
+    -------
+    lnwl_grid : ndarray
+        Grid of ln(wavelength), shape (orders, npix). Points beyond the
+        range of an order are NaN.
+    dlnl : float
+        Step of the grid in ln(wavelength).
+    """
+    lnwl = np.log(_valid_wavelengths(wl))
+    if lnwl.ndim == 2:
+        lnwl = lnwl[np.newaxis]
+    with np.errstate(invalid='ignore'):
+        dlnl = np.nanmedian(np.diff(lnwl, axis=-1)) / oversample
+    start = np.nanmax(np.nanmin(lnwl, axis=-1), axis=0)
+    stop = np.nanmin(np.nanmax(lnwl, axis=-1), axis=0)
+    npix = np.floor((stop - start) / dlnl).astype(int) + 1
+    npix[~np.isfinite(start) | ~np.isfinite(stop)] = 0
+    steps = np.arange(max(int(np.max(npix)), 1))
+    lnwl_grid = start[:, np.newaxis] + steps * dlnl
+    lnwl_grid[steps >= npix[:, np.newaxis]] = np.nan
+    return lnwl_grid, dlnl
+
+
+def resample_loglambda(wl, data, lnwl_grid):
+    """
+    Linearly interpolate many spectra onto a log-lambda grid at once.
+
+    All rows (epochs x orders) are handled by a single ``searchsorted``:
+    each row is offset by a multiple of the total ln-wavelength span, so
+    the concatenation of the rows is globally sorted.
+
+    Parameters
+    ----------
+    wl : ndarray
+        Input wavelengths, shape (..., orders, pixels), increasing along
+        the last axis.
+    data : ndarray
+        Values to interpolate, same shape as `wl`.
+    lnwl_grid : ndarray
+        Output grid from :func:`loglambda_grid`, shape (orders, npix).
+
+    Returns
+    -------
+    ndarray
+        Interpolated values of shape (..., orders, npix). Points outside
+        the valid input range are NaN.
+    """
+    lnwl = np.log(_valid_wavelengths(wl))
+    data = np.asarray(data, dtype=np.float64)
+    lead = lnwl.shape[:-2]
+    norders, npix_in = lnwl.shape[-2:]
+    lnwl = lnwl.reshape(-1, npix_in)
+    data = data.reshape(-1, npix_in)
+    nrows = lnwl.shape[0]
+    grid = np.broadcast_to(lnwl_grid, lead + lnwl_grid.shape).reshape(
+        nrows, -1)
+
+    # Invalid samples are pushed out of the way, keeping rows sorted.
+    lo = np.nanmin([np.nanmin(lnwl), np.nanmin(grid)])
+    hi = np.nanmax([np.nanmax(lnwl), np.nanmax(grid)])
+    span = hi - lo + 1.0
+    bad = ~np.isfinite(lnwl) | ~np.isfinite(data)
+    offsets = (np.arange(nrows) * span)[:, np.newaxis]
+    keys = np.where(bad, np.nan, lnwl - lo) + offsets
+    # Fill invalid samples with the previous valid key of the row.
+    keys = np.fmax.accumulate(np.where(bad, -np.inf, keys), axis=1)
+    keys = np.where(np.isinf(keys), offsets, keys)
+    targets = np.where(np.isfinite(grid), grid - lo, -1.0) + offsets
+
+    flat_keys = keys.ravel()
+    flat_data = data.ravel()
+    flat_bad = bad.ravel()
+    right = np.searchsorted(flat_keys, targets.ravel(), side='right')
+    right = right.reshape(targets.shape)
+    row_start = (np.arange(nrows) * npix_in)[:, np.newaxis]
+    row_stop = row_start + npix_in
+    inside = (right > row_start) & (right < row_stop)
+    right = np.clip(right, row_start + 1, row_stop - 1)
+    left = right - 1
+    x0 = flat_keys[left]
+    x1 = flat_keys[right]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = (targets - x0) / (x1 - x0)
+        result = flat_data[left] + frac * (flat_data[right]
+                                           - flat_data[left])
+    result[~inside | ~np.isfinite(grid) | flat_bad[left]
+           | flat_bad[right]] = np.nan
+    return result.reshape(lead + (norders, -1))
+
+
+def mask_template(lnwl_grid, dlnl, line_wl, line_weights=None,
+                  width_kms=None):
+    """
+    Build a template from a line mask on a log-lambda grid.
+
+    Every line is a Gaussian absorption of depth ``weight``.
+
+    Parameters
+    ----------
+    lnwl_grid : ndarray
+        Grid from :func:`loglambda_grid`, shape (orders, npix).
+    dlnl : float
+        Step of the grid.
+    line_wl : array_like
+        Line centres in Angstrom.
+    line_weights : array_like or None, optional
+        Line depths. Default is 1 for every line.
+    width_kms : float or None, optional
+        Gaussian sigma of the lines in km/s. Default is one grid pixel.
+
+    Returns
+    -------
+    ndarray
+        Template of shape (orders, npix), 1 in the continuum.
+    """
+    line_wl = np.asarray(line_wl, dtype=np.float64)
+    if line_weights is None:
+        line_weights = np.ones_like(line_wl)
+    line_weights = np.asarray(line_weights, dtype=np.float64)
+    sigma = dlnl if width_kms is None else width_kms / C_KMS
+    halfwidth = int(np.ceil(4 * sigma / dlnl))
+    lnline = np.log(line_wl)
+    template = np.zeros(lnwl_grid.shape)
+    npix = lnwl_grid.shape[1]
+    kernel_steps = np.arange(-halfwidth, halfwidth + 1)
+    for order in range(lnwl_grid.shape[0]):
+        start = lnwl_grid[order, 0]
+        if not np.isfinite(start):
+            continue
+        pos = (lnline - start) / dlnl
+        sel = (pos > -halfwidth) & (pos < npix + halfwidth)
+        if not np.any(sel):
+            continue
+        pos = pos[sel]
+        idx = np.floor(pos).astype(int)[:, np.newaxis] + kernel_steps
+        profile = line_weights[sel][:, np.newaxis] * np.exp(
+            -0.5 * ((idx - pos[:, np.newaxis]) * dlnl / sigma) ** 2)
+        keep = (idx >= 0) & (idx < npix)
+        np.add.at(template[order], idx[keep], profile[keep])
+    template = 1.0 - template
+    template[~np.isfinite(lnwl_grid)] = np.nan
+    return template
+
+
+'''
+Cross-correlation
+'''
+
+
+def _normalize_orders(flux):
+    """Continuum-level normalize each row and remove the mean level."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        level = np.nanmedian(flux, axis=-1, keepdims=True)
+        norm = flux / level - 1.0
+    norm[~np.isfinite(norm)] = 0.0
+    return norm
+
+
+def _refine_peak(ccf, index):
+    """
+    Sub-pixel peak position from the three samples around `index`.
+
+    A Gaussian (parabola in the log) is fitted where the three samples are
+    positive, a parabola otherwise.
+    """
+    n = ccf.shape[-1]
+    im = np.clip(index - 1, 0, n - 1)
+    ip = np.clip(index + 1, 0, n - 1)
+    y0 = np.take_along_axis(ccf, im[..., np.newaxis], -1)[..., 0]
+    y1 = np.take_along_axis(ccf, index[..., np.newaxis], -1)[..., 0]
+    y2 = np.take_along_axis(ccf, ip[..., np.newaxis], -1)[..., 0]
+    positive = (y0 > 0) & (y1 > 0) & (y2 > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        l0, l1, l2 = (np.log(np.where(positive, y, 1.0))
+                      for y in (y0, y1, y2))
+        y0 = np.where(positive, l0, y0)
+        y1 = np.where(positive, l1, y1)
+        y2 = np.where(positive, l2, y2)
+        denom = y0 - 2 * y1 + y2
+        delta = np.where(denom != 0, 0.5 * (y0 - y2) / denom, 0.0)
+    return index + np.clip(delta, -1, 1)
+
+
+def cross_correlate(flux, template, max_lag, taper=0.1):
+    """
+    FFT cross-correlation of many spectra with their order templates.
+
+    Parameters
+    ----------
+    flux : ndarray
+        Spectra on a log-lambda grid, shape (epochs, orders, npix).
+    template : ndarray
+        Templates on the same grid, shape (orders, npix).
+    max_lag : int
+        Largest lag (in grid pixels) returned.
+    taper : float, optional
+        Tukey window fraction applied to every order. Default is 0.1.
+
+    Returns
+    -------
+    lags : ndarray
+        Lags from ``-max_lag`` to ``max_lag``.
+    ccf : ndarray
+        Cross-correlation of shape (epochs, orders, 2*max_lag+1). A
+        spectrum shifted to larger wavelength peaks at a positive lag.
+    """
+    npix = flux.shape[-1]
+    window = tukey(npix, taper)
+    fnorm = _normalize_orders(flux) * window
+    tnorm = _normalize_orders(template) * window
+    nfft = sp_fft.next_fast_len(npix + max_lag + 1, real=True)
+    ffl = sp_fft.rfft(fnorm, n=nfft, axis=-1)
+    ftm = sp_fft.rfft(tnorm, n=nfft, axis=-1)
+    cc = sp_fft.irfft(ffl * np.conj(ftm), n=nfft, axis=-1)
+    lags = np.arange(-max_lag, max_lag + 1)
+    ccf = cc[..., lags % nfft]
+    norm = np.sqrt(np.sum(fnorm**2, axis=-1, keepdims=True)
+                   * np.sum(tnorm**2, axis=-1, keepdims=True))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ccf = ccf / norm
+    return lags, ccf
+
+
+def measure_rv(flux, wl, var=None, template_wl=None, template_flux=None,
+               line_wl=None, line_weights=None, line_width_kms=None,
+               max_velocity=100.0, oversample=1.0, batch_size=32):
+    """
+    Measure radial velocities of all epochs and orders in one batch.
+
+    The spectra are resampled onto a common log-lambda grid, where a
+    Doppler shift is a constant pixel offset, and cross-correlated with
+    the template using FFTs along the pixel axis for all epochs and
+    orders together (in batches of `batch_size` epochs to bound memory).
+    The CCF peak is located with a three-point Gaussian fit.
+
+    Parameters
+    ----------
+    flux : ndarray
+        Flux of shape (orders, pixels) or (epochs, orders, pixels), e.g.
+        the ``SCIFLUX`` of ``combine_spectra`` outputs or of
+        ``Handle_NEID.process_data``.
+    wl : ndarray
+        Wavelengths in Angstrom, same shape as `flux` (or (orders, pixels)
+        if all epochs share the grid).
+    var : ndarray or None, optional
+        Variance of `flux`. Used for the uncertainties; photon noise
+        (``var = flux``) is assumed if not given.
+    template_wl, template_flux : array_like, optional
+        Template spectrum (1D, Angstrom, rest frame).
+    line_wl, line_weights : array_like, optional
+        Line mask used instead of a template spectrum.
+    line_width_kms : float or None, optional
+        Gaussian sigma of the mask lines in km/s.
+    max_velocity : float, optional
+        Largest |RV| searched, in km/s. Default is 100.
+    oversample : float, optional
+        Grid points per input pixel. Default is 1.
+    batch_size : int, optional
+        Epochs per FFT batch. Default is 32.
+
+    Returns
+    -------
+    dict
+        - ``'rv'`` : per-order RVs in km/s, shape (epochs, orders).
+        - ``'rv_err'`` : per-order uncertainties in km/s.
+        - ``'rv_comb'`` : inverse-variance weighted RV per epoch.
+        - ``'rv_comb_err'`` : its uncertainty.
+        - ``'velocities'`` : velocity of every CCF lag.
+        - ``'ccf'`` : CCFs of shape (epochs, orders, lags).
+
+    Notes
+    -----
+    The per-order uncertainty is the photon-noise limit of Bouchy et al.
+    (2001), ``c / sqrt(sum((dF/dlnl)**2 / var))``, computed on the
+    resampled spectrum. Orders without valid data get NaN.
+    """
+    flux = np.asarray(flux, dtype=np.float64)
+    single = flux.ndim == 2
+    if single:
+        flux = flux[np.newaxis]
+    wl = np.asarray(wl, dtype=np.float64)
+    if wl.ndim == 2:
+        wl = np.broadcast_to(wl, flux.shape)
+    if var is None:
+        var = np.abs(flux)
+    var = np.broadcast_to(np.asarray(var, dtype=np.float64), flux.shape)
+
+    lnwl_grid, dlnl = loglambda_grid(wl, oversample=oversample)
+    if template_flux is not None:
+        twl = np.asarray(template_wl, dtype=np.float64)
+        tfl = np.asarray(template_flux, dtype=np.float64)
+        template = resample_loglambda(
+            np.broadcast_to(twl, (lnwl_grid.shape[0],) + twl.shape),
+            np.broadcast_to(tfl, (lnwl_grid.shape[0],) + tfl.shape),
+            lnwl_grid)
+    elif line_wl is not None:
+        template = mask_template(lnwl_grid, dlnl, line_wl, line_weights,
+                                 width_kms=line_width_kms)
+    else:
+        raise ValueError("Give either a template spectrum or a line mask.")
+
+    max_lag = int(np.ceil(np.log1p(max_velocity / C_KMS) / dlnl))
+    nepochs, norders = flux.shape[:2]
+    ccf = np.empty((nepochs, norders, 2 * max_lag + 1))
+    rv = np.empty((nepochs, norders))
+    rv_err = np.empty((nepochs, norders))
+    for start in range(0, nepochs, batch_size):
+        stop = min(start + batch_size, nepochs)
+        flux_grid = resample_loglambda(wl[start:stop], flux[start:stop],
+                                       lnwl_grid)
+        var_grid = resample_loglambda(wl[start:stop], var[start:stop],
+                                      lnwl_grid)
+        lags, ccf_batch = cross_correlate(flux_grid, template, max_lag)
+        ccf[start:stop] = ccf_batch
+
+        filled = np.where(np.isfinite(ccf_batch), ccf_batch, -np.inf)
+        peak = np.argmax(filled, axis=-1)
+        shift = _refine_peak(ccf_batch, peak) - max_lag
+        rv[start:stop] = C_KMS * np.expm1(shift * dlnl)
+
+        gradient = np.gradient(flux_grid, axis=-1) / dlnl
+        with np.errstate(invalid='ignore', divide='ignore'):
+            quality = np.nansum(gradient**2 / var_grid, axis=-1)
+            rv_err[start:stop] = C_KMS / np.sqrt(quality)
+        logger.info("RV for epochs {} to {}".format(start, stop - 1))
+
+    rv_err[~np.isfinite(rv_err) | (rv_err == 0)] = np.nan
+    rv[~np.isfinite(rv_err) | ~np.isfinite(rv)] = np.nan
+    weights = np.where(np.isfinite(rv), 1.0 / rv_err**2, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sum_w = np.sum(weights, axis=-1)
+        rv_comb = np.nansum(weights * np.nan_to_num(rv), axis=-1) / sum_w
+        rv_comb_err = 1.0 / np.sqrt(sum_w)
+
+    result = {'rv': rv, 'rv_err': rv_err,
+              'rv_comb': rv_comb, 'rv_comb_err': rv_comb_err,
+              'velocities': C_KMS * np.expm1(lags * dlnl),
+              'ccf': ccf}
+    if single:
+        for key in ('rv', 'rv_err', 'rv_comb', 'rv_comb_err', 'ccf'):
+            result[key] = result[key][0]
+    return result
+
+
+def doppler_resample(wl, flux, velocities, var=None, oversample=1.0,
+                     batch_size=32):
+    """
+    Shift epochs to their rest frame and resample them onto one common
+    log-lambda grid.
+
+    A Doppler shift by ``v`` is the constant offset ``ln(1 + v/c)`` in
+    ln(wavelength), so every epoch is shifted by offsetting its
+    ln-wavelengths and all epochs and orders are interpolated together
+    by `resample_loglambda` (one ``searchsorted`` per batch of
+    `batch_size` epochs), without per-order spline fits.
+
+    Parameters
+    ----------
+    wl : ndarray
+        Observed wavelengths, shape (epochs, orders, pixels), or
+        (orders, pixels) if shared by all epochs.
+    flux : ndarray
+        Flux, shape (epochs, orders, pixels).
+    velocities : array_like
+        Velocity of every epoch in km/s (e.g. ``CCFRVMOD``).
+    var : ndarray or None, optional
+        Variance of `flux`, resampled the same way.
+    oversample : float, optional
+        Grid points per input pixel. Default is 1.
+    batch_size : int, optional
+        Epochs resampled at once. Default is 32.
+
+    Returns
+    -------
+    lnwl_grid : ndarray
+        Rest-frame ln(wavelength) grid, shape (orders, npix), covering
+        the range common to all shifted epochs (NaN beyond).
+    flux_grid, var_grid : ndarray
+        Resampled flux and variance (None if `var` is None), shape
+        (epochs, orders, npix).
+    """
+    flux = np.asarray(flux, dtype=np.float64)
+    wl = np.asarray(wl, dtype=np.float64)
+    if wl.ndim == 2:
+        wl = np.broadcast_to(wl, flux.shape)
+    factors = 1.0 + np.asarray(velocities, dtype=np.float64) / C_KMS
+    if factors.shape != flux.shape[:1]:
+        raise ValueError("Need one velocity per epoch, got {} for {} "
+                         "epochs".format(factors.shape, flux.shape[0]))
+    rest_wl = wl / factors[:, np.newaxis, np.newaxis]
+    lnwl_grid, _ = loglambda_grid(rest_wl, oversample=oversample)
+    shape = flux.shape[:2] + lnwl_grid.shape[-1:]
+    flux_grid = np.empty(shape)
+    var_grid = None if var is None else np.empty(shape)
+    for start in range(0, flux.shape[0], batch_size):
+        stop = min(start + batch_size, flux.shape[0])
+        flux_grid[start:stop] = resample_loglambda(
+            rest_wl[start:stop], flux[start:stop], lnwl_grid)
+        if var is not None:
+            var_grid[start:stop] = resample_loglambda(
+                rest_wl[start:stop], np.asarray(var)[start:stop],
+                lnwl_grid)
+    return lnwl_grid, flux_grid, var_grid
+
+
+def shift_and_stack(wl, flux, velocities, var=None, method='mean',
+                    oversample=1.0, batch_size=32, backend='numpy'):
+    """
+    Combine epochs in their rest frame, e.g. to build a stellar template.
+
+    The epochs are shifted by their velocities and resampled with
+    `doppler_resample`, then combined with
+    `ariastro.operations.combine_data`.
+
+    Parameters
+    ----------
+    wl, flux, velocities, var, oversample, batch_size
+        See `doppler_resample`.
+    method : {'mean', 'median', 'biweight', 'weightedavg'}, optional
+        Combine method. Default is ``'mean'``.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend of the combine.
+
+    Returns
+    -------
+    wl_rest : ndarray
+        Rest-frame wavelengths of the grid, shape (orders, npix).
+    comb_flux, comb_var : ndarray
+        Combined flux and variance (None if `var` is None).
+    """
+    lnwl_grid, flux_grid, var_grid = doppler_resample(
+        wl, flux, velocities, var=var, oversample=oversample,
+        batch_size=batch_size)
+    comb_flux, comb_var = combine_data(flux_grid, var_grid, method=method,
+                                       backend=backend)
+    return np.exp(lnwl_grid), comb_flux, comb_var
+
+
+def rv_from_files(files, fluxext=1, varext=4, wlext=7, orders=None,
+                  **kwargs):
+    """
+    Measure RVs on FITS spectra such as ``combine_spectra`` outputs.
+
+    Parameters
+    ----------
+    files : list of str
+        FITS files, one per epoch.
+    fluxext, varext, wlext : int, optional
+        Extension numbers of flux, variance and wavelength.
+        Defaults are the NEID science fiber (1, 4, 7).
+    orders : slice or array_like or None, optional
+        Orders (row indices) to use. Default is all.
+    **kwargs
+        Template or mask and options passed to :func:`measure_rv`.
+
+    Returns
+    -------
+    dict
+        See :func:`measure_rv`.
+    """
+    fluxes, variances, wavelengths = [], [], []
+    for fname in files:
+        datadict, _ = extract_allexts(fname)
+        keys = list(datadict.keys())
+        fluxes.append(np.array(datadict[keys[fluxext]], dtype=np.float64))
+        variances.append(np.array(datadict[keys[varext]], dtype=np.float64))
+        wavelengths.append(np.array(datadict[keys[wlext]], dtype=np.float64))
+    fluxes = np.array(fluxes)
+    variances = np.array(variances)
+    wavelengths = np.array(wavelengths)
+    if orders is not None:
+        fluxes = fluxes[:, orders]
+        variances = variances[:, orders]
+        wavelengths = wavelengths[:, orders]
+    return measure_rv(fluxes, wavelengths, var=variances, **kwargs)
+
+# End
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from .logger import logger
+from .operations import ari_operations_out
+from .operations import combine_data
+from .handle_frame import clean_cosmic_rays
+
+# Suffixes dropped from the input names for the product names.
+FITS_SUFFIXES = ('.fits', '.fit', '.fts', '.fz', '.gz')
+
+
+class ReferenceCache:
+    """
+    Keep reference frames in memory between jobs.
+
+    A reference is re-read only when its modification time changes. Each
+    reference has its own lock, so a reference being read does not block
+    the jobs using another one.
+
+    Parameters
+    ----------
+    fluxext : list of int
+        Extensions holding the flux data.
+    varext : list of int or None
+        Extensions holding the variance data.
+    """
+
+    def __init__(self, fluxext, varext=None):
+        self.fluxext = [int(ext) for ext in fluxext]
+        self.varext = None if varext is None else [int(ext) for ext in varext]
+        self._frames = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, fname):
+        """
+        Return ``(datas, vars)`` of `fname`, one entry per flux extension.
+        ``vars`` is None if no variance extensions are configured.
+        """
+        fname = str(Path(fname).resolve())
+        mtime = os.stat(fname).st_mtime_ns
+        with self._lock:
+            lock = self._locks.setdefault(fname, threading.Lock())
+        with lock:
+            cached = self._frames.get(fname)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            with fits.open(fname) as hdul:
+                datas = [np.array(hdul[ext].data, dtype=np.float64)
+                         for ext in self.fluxext]
+                variances = None
+                if self.varext is not None:
+                    variances = [np.array(hdul[ext].data, dtype=np.float64)
+                                 for ext in self.varext]
+            for arr in datas + (variances or []):
+                arr.setflags(write=False)
+            self._frames[fname] = (mtime, (datas, variances))
+            logger.info("Loaded reference {}".format(fname))
+            return datas, variances
+
+
+class WatchService:
+    """
+    Watch a directory and run a pipeline on every newly arrived frame.
+
+    New files matching `pattern` are detected by polling. A file is
+    queued once its size and modification time are unchanged between two
+    scans, i.e. once it is completely written. Each queued frame goes
+    through the configured steps, in this order:
+
+    1. ``operation`` with a reference frame or a constant,
+    2. cosmic-ray removal with astroscrappy,
+    3. writing ``<stem>_proc.fits`` to `outdir`.
+
+    If `combine` is set, every `combine_every` processed frames are
+    combined into ``combined_<n>.fits``; the frames left over are combined
+    by :meth:`stop`. Reference frames are read once
+    and kept in memory; frames are processed by a pool of worker threads.
+    A JSON status file reports the queue depth, the throughput and the
+    latency from arrival to product.
+
+    Parameters
+    ----------
+    watchdir : str
+        Directory to watch.
+    outdir : str or None, optional
+        Directory for the products. Default is ``<watchdir>/products``.
+    pattern : str, optional
+        Glob pattern of the input frames. Default is ``'*.fits'``.
+    operation : {'+', '-', '*', '/'} or None, optional
+        Operation applied to every frame. Default is None (skipped).
+    operand : str or float or None, optional
+        Reference frame path or constant for `operation`.
+    cosmic : bool, optional
+        Remove cosmic rays. Default is False.
+    combine : str or None, optional
+        Combine method ('mean', 'median', 'biweight', 'weightedavg').
+        Default is None (no combine).
+    combine_every : int, optional
+        Number of processed frames per combined product. Default is 10.
+    fluxext : list of int, optional
+        Flux extensions. Default is ``[0]``.
+    varext : list of int or None, optional
+        Variance extensions. Default is None.
+    workers : int, optional
+        Number of worker threads. Default is 4.
+    poll_interval : float, optional
+        Seconds between directory scans. Default is 0.5.
+    status_file : str or None, optional
+        Path of the JSON status file. Default is
+        ``<outdir>/ariastro_status.json``.
+    backend : {'numpy', 'numba', 'auto'}, optional
+        Kernel backend for the operation and the combine.
+    """
+
+    def __init__(self, watchdir, outdir=None, pattern='*.fits',
+                 operation=None, operand=None, cosmic=False,
+                 combine=None, combine_every=10,
+                 fluxext=[0], varext=None,
+                 workers=4, poll_interval=0.5, status_file=None,
+                 backend='numpy'):
+        self.watchdir = Path(watchdir)
+        self.outdir = Path(outdir) if outdir is not None \
+            else self.watchdir / "products"
+        if self.outdir.resolve() == self.watchdir.resolve():
+            raise ValueError("outdir must differ from the watched directory")
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        self.pattern = pattern
+        self.operation = operation
+        self.operand = operand
+        self.cosmic = cosmic
+        self.combine = combine
+        self.combine_every = int(combine_every)
+        self.fluxext = [int(ext) for ext in fluxext]
+        self.varext = None if varext is None else [int(ext) for ext in varext]
+        self.poll_interval = poll_interval
+        self.status_file = Path(status_file) if status_file is not None \
+            else self.outdir / "ariastro_status.json"
+        self.backend = backend
+
+        self.references = ReferenceCache(self.fluxext, self.varext)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._candidates = {}
+        self._seen = set()
+        self._pending = 0
+        self._combine_buffer = []
+        self._ncombined = 0
+        self._done_times = deque(maxlen=200)
+        self._latencies = deque(maxlen=200)
+        self.stats = {'processed': 0, 'failed': 0, 'combined': 0}
+        self._started = time.time()
+
+    def product_name(self, fname):
+        """
+        Return the product path of the input frame `fname`: its name
+        without the FITS (and compression) suffixes, so that
+        ``obs.001.fits`` gives ``obs.001_proc.fits``.
+        """
+        name = Path(fname).name
+        stem, suffix = os.path.splitext(name)
+        while suffix.lower() in FITS_SUFFIXES and stem:
+            name = stem
+            stem, suffix = os.path.splitext(name)
+        return self.outdir / "{}_proc.fits".format(name)
+
+    def scan(self):
+        """
+        Scan the watch directory once and queue the frames that are
+        completely written.
+
+        Returns
+        -------
+        list of Path
+            Frames queued by this scan.
+        """
+        queued = []
+        now = time.time()
+        for fname in sorted(self.watchdir.glob(self.pattern)):
+            if fname in self._seen or not fname.is_file():
+                continue
+            try:
+                stat = fname.stat()
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self._candidates.get(fname)
+            if previous is None or previous[0] != signature:
+                first_seen = now if previous is None else previous[1]
+                self._candidates[fname] = (signature, first_seen)
+                continue
+            del self._candidates[fname]
+            self._seen.add(fname)
+            product = self.product_name(fname)
+            if product.exists() and \
+                    product.stat().st_mtime_ns >= stat.st_mtime_ns:
+                continue
+            self.submit(fname, previous[1])
+            queued.append(fname)
+        return queued
+
+    def submit(self, fname, arrival=None):
+        """Queue `fname` for processing."""
+        with self._lock:
+            self._pending += 1
+        self.executor.submit(self._run_job, Path(fname),
+                             arrival if arrival is not None else time.time())
+
+    def _run_job(self, fname, arrival):
+        try:
+            datas, variances, header = self.process_frame(fname)
+        except Exception as err:
+            logger.error("Failed to process {}: {}".format(fname, err))
+            with self._lock:
+                self._pending -= 1
+                self.stats['failed'] += 1
+            return
+        done = time.time()
+        logger.info("Processed {} in {:.2f} s".format(fname, done - arrival))
+        batch = None
+        with self._lock:
+            self._pending -= 1
+            self.stats['processed'] += 1
+            self._done_times.append(done)
+            self._latencies.append(done - arrival)
+            if self.combine is not None:
+                self._combine_buffer.append((fname, datas, variances,
+                                             header))
+                if len(self._combine_buffer) >= self.combine_every:
+                    batch = self._combine_buffer
+                    self._combine_buffer = []
+                    self._ncombined += 1
+                    index = self._ncombined
+        if batch is not None:
+            self.combine_frames(batch, index)
+
+    def process_frame(self, fname):
+        """
+        Run the operation and cosmic-ray steps on one frame and write
+        its product.
+
+        Returns
+        -------
+        datas, variances : list of numpy.ndarray
+            Processed flux (and variance, or None) per flux extension.
+        header : astropy.io.fits.Header
+            Header of the first flux extension.
+        """
+        with fits.open(fname) as hdul:
+            datas = [np.array(hdul[ext].data, dtype=np.float64)
+                     for ext in self.fluxext]
+            variances = None
+            if self.varext is not None:
+                variances = [np.array(hdul[ext].data, dtype=np.float64)
+                             for ext in self.varext]
+            header = hdul[self.fluxext[0]].header.copy()
+
+        if self.operation is not None:
+            if isinstance(self.operand, (int, float)):
+                refs = [float(self.operand)] * len(datas)
+                refvars = None
+            else:
+                refs, refvars = self.references.get(self.operand)
+                header['HISTORY'] = '{} {}'.format(self.operation,
+                                                   Path(self.operand).name)
+            for index in range(len(datas)):
+                var1 = None if variances is None else variances[index]
+                var2 = None if refvars is None else refvars[index]
+                ari_operations_out(datas[index], refs[index], var1, var2,
+                                   operation=self.operation, inplace=True,
+                                   backend=self.backend)
+
+        if self.cosmic:
+            for index in range(len(datas)):
+                var = None if variances is None else variances[index]
+                crmask, datas[index] = clean_cosmic_rays(datas[index], var)
+            header['HISTORY'] = "Cosmic Rays removed with astroscrappy"
+
+        self._write(self.product_name(fname), datas, variances, header)
+        return datas, variances, header
+
+    def combine_frames(self, batch, index):
+        """Combine a batch of processed frames and write the product."""
+        names = [Path(item[0]).name for item in batch]
+        datas = []
+        variances = None if batch[0][2] is None else []
+        for ext_index in range(len(self.fluxext)):
+            stack = [item[1][ext_index] for item in batch]
+            var_stack = None
+            if variances is not None:
+                var_stack = [item[2][ext_index] for item in batch]
+            result, variance = combine_data(stack, var_stack,
+                                            method=self.combine,
+                                            backend=self.backend)
+            datas.append(result)
+            if variances is not None:
+                variances.append(variance)
+        header = batch[0][3].copy()
+        header['HISTORY'] = self.combine + str(names)
+        opfilename = self.outdir / "combined_{:04d}.fits".format(index)
+        self._write(opfilename, datas, variances, header)
+        with self._lock:
+            self.stats['combined'] += 1
+        logger.info("Combined {} frames into {}".format(len(batch),
+                                                        opfilename))
+
+    def flush(self):
+        """Combine the frames left in the combine buffer, if any."""
+        with self._lock:
+            batch = self._combine_buffer
+            self._combine_buffer = []
+            if not batch:
+                return
+            self._ncombined += 1
+            index = self._ncombined
+        self.combine_frames(batch, index)
+
+    def _write(self, opfilename, datas, variances, header):
+        hdul = fits.HDUList([fits.PrimaryHDU()])
+        for index, ext in enumerate(self.fluxext):
+            if ext == 0:
+                hdul[0] = fits.PrimaryHDU(datas[index], header=header)
+            else:
+                hdul.append(fits.ImageHDU(datas[index], header=header,
+                                          name="FLUX"))
+            if variances is not None:
+                hdul.append(fits.ImageHDU(variances[index],
+                                          name="VARIANCE"))
+        tmpname = Path(opfilename).with_suffix('.tmp')
+        hdul.writeto(tmpname, overwrite=True)
+        os.replace(tmpname, opfilename)
+
+    def status(self):
+        """Return the current queue depth, throughput and latency."""
+        now = time.time()
+        with self._lock:
+            recent = [t for t in self._done_times if now - t < 60.0]
+            latencies = list(self._latencies)
+            status = {
+                'time': now,
+                'uptime': now - self._started,
+                'queue_depth': self._pending,
+                'waiting_to_settle': len(self._candidates),
+                'throughput_per_min': len(recent),
+                'mean_latency': float(np.mean(latencies))
+                if latencies else None,
+                'pending_combine': len(self._combine_buffer),
+            }
+            status.update(self.stats)
+        return status
+
+    def write_status(self):
+        """Write :meth:`status` to the status file."""
+        tmpname = self.status_file.with_suffix('.tmp')
+        with open(tmpname, 'w') as fobj:
+            json.dump(self.status(), fobj, indent=1)
+        os.replace(tmpname, self.status_file)
+
+    def run(self, max_scans=None):
+        """
+        Poll the watch directory until :meth:`stop` is called (or for
+        `max_scans` scans).
+        """
+        logger.info("Watching {} for {}".format(self.watchdir, self.pattern))
+        nscans = 0
+        while not self._stop.is_set():
+            self.scan()
+            self.write_status()
+            nscans += 1
+            if max_scans is not None and nscans >= max_scans:
+                break
+            self._stop.wait(self.poll_interval)
+
+    def stop(self, wait=True):
+        """
+        Stop polling, shut the worker pool down and combine the frames
+        left in the combine buffer (those of the jobs still running are
+        lost without `wait`).
+        """
+        self._stop.set()
+        self.executor.shutdown(wait=wait)
+        self.flush()
+        self.write_status()
+
+# End
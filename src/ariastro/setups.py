@@ -16,6 +16,9 @@ def read_args():
                         help="Extensions of variance")
     parent.add_argument("--wl", nargs="+", default=None,
                         help="Extensions of wavelength")
+    parent.add_argument("--backend", default="numpy",
+                        choices=["numpy", "numba", "auto"],
+                        help="Kernel backend for combine and propagation")
 
     parser = argparse.ArgumentParser(description="Input data to combine")
 
@@ -26,6 +29,21 @@ def read_args():
     binary_parser.add_argument("operator",
                                choices=["+", "-", "*", "/"],
                                help="Binary operation (+,-,*,/)")
+    binary_parser.add_argument(
+        '--template',
+        type=str, default=None,
+        help="Batch mode: apply the last of --fnames to all the others and "
+        "name the outputs with this template, e.g. '{stem}_sub.fits' "
+        "(--output is the output directory)"
+    )
+    binary_parser.add_argument("--workers", type=int, default=4,
+                               help="Number of worker threads (batch mode)")
+    binary_parser.add_argument("--quicklook", type=int, default=None,
+                               help="Write a decimated preview, reduced by "
+                               "this factor (single operation)")
+    binary_parser.add_argument("--quicklook-mode", default="stride",
+                               choices=["stride", "bin"],
+                               help="Decimation in quick-look mode")
 
 
     # For combining
@@ -41,6 +59,199 @@ def read_args():
         type=str, default=None,
         help="If the data is from any specific instrument (eg:NEID)"
     )
+    combine_parser.add_argument(
+        '--checkpoint-dir',
+        type=str, default=None,
+        help="Scratch directory to checkpoint and resume instrument runs"
+    )
+    combine_parser.add_argument(
+        '--output-format',
+        choices=["fits", "hdf5", "zarr"], default="fits",
+        help="Format of the combined spectrum (with --instrument)"
+    )
+    combine_parser.add_argument(
+        '--quicklook',
+        type=int, default=None,
+        help="Write a decimated preview, reduced by this factor"
+    )
+    combine_parser.add_argument(
+        '--quicklook-mode',
+        choices=["stride", "bin"], default="stride",
+        help="Decimation of image frames in quick-look mode"
+    )
+    combine_parser.add_argument(
+        '--chunk-rows',
+        type=int, default=None,
+        help="Combine image frames in blocks of this many rows "
+        "(automatic for compressed inputs)"
+    )
+
+    combine_parser.add_argument(
+        '--subset',
+        nargs="+", default=None,
+        help="Frames (names or positions) of a stack cube to combine"
+    )
+
+    combine_parser.add_argument(
+        '--uncertainty',
+        choices=["propagate", "bootstrap", "jackknife"],
+        default="propagate",
+        help="Propagate the variance or estimate it by resampling"
+    )
+
+    combine_parser.add_argument(
+        '--align',
+        action='store_true',
+        help="Register the frames onto the first one before combining"
+    )
+
+    combine_parser.add_argument(
+        '--scale',
+        choices=["median", "mode", "exptime"], default=None,
+        help="Scale the frames to the first one before combining"
+    )
+
+    combine_parser.add_argument(
+        '--offset',
+        choices=["median", "mode"], default=None,
+        help="Offset the frames to the first one before combining"
+    )
+
+    combine_parser.add_argument(
+        '--exptime-key',
+        type=str, default="EXPTIME",
+        help="Exposure time keyword for --scale exptime"
+    )
+
+    combine_parser.add_argument(
+        '--orders',
+        nargs=2, type=int, default=None,
+        help="First and last echelle order to combine (with --instrument)"
+    )
+
+    combine_parser.add_argument(
+        '--wl-range',
+        nargs=2, type=float, default=None,
+        help="Wavelength range to combine (with --instrument)"
+    )
+
+    combine_parser.add_argument(
+        '--velocity',
+        type=str, default=None,
+        help="Header keyword of the epoch RVs in km/s (e.g. CCFRVMOD): "
+        "combine in the stellar rest frame (with --instrument)"
+    )
+
+    combine_parser.add_argument(
+        '--diagnostics',
+        action='store_true',
+        help="Also write the NCOMBINE, STDDEV and REJFRAC maps"
+    )
+
+    combine_parser.add_argument(
+        '--crreject',
+        action='store_true',
+        help="Reject cosmic rays from the stack of aligned frames"
+    )
+
+    combine_parser.add_argument(
+        '--cr-threshold',
+        type=float, default=5.0,
+        help="Cosmic-ray threshold in sigma for --crreject"
+    )
+
+    combine_parser.add_argument(
+        '--cr-grow',
+        type=int, default=1,
+        help="Growth of the cosmic-ray flags in pixels for --crreject"
+    )
+
+    combine_parser.add_argument(
+        '--crmask-dir',
+        type=str, default=None,
+        help="Directory of the per-frame cosmic-ray masks for --crreject"
+    )
+
+    combine_parser.add_argument(
+        '--wl-mask',
+        type=str, default=None,
+        help="Text file of wavelength intervals (lo hi) to mask, e.g. "
+        "tellurics (with --instrument)"
+    )
+
+    # Pixel-major stack cube
+    subparsers.add_parser(
+        "stack", parents=[parent],
+        help="Transpose frames into a stack cube for repeated combines")
+
+    # Calibration with master frames
+    calib_parser = subparsers.add_parser(
+        "calibrate", parents=[parent],
+        help="Build master bias/dark/flat and calibrate frames "
+        "(--output is the output directory)")
+    calib_parser.add_argument("--library", required=True,
+                              help="Directory of the master library")
+    calib_parser.add_argument("--calib-frames", nargs="+", default=None,
+                              help="Raw bias, dark and flat frames to "
+                              "build masters from")
+    calib_parser.add_argument("--method", default="median",
+                              choices=["mean", "median", "biweight"],
+                              help="Method to combine the raw frames")
+
+    # Spectral indices and equivalent widths
+    indices_parser = subparsers.add_parser(
+        "indices", parents=[parent],
+        help="Measure activity indices and equivalent widths of spectra "
+        "(--output is the table)")
+    indices_parser.add_argument("--instrument", type=str, default=None,
+                                help="Read the spectra with the "
+                                "instrument (eg:NEID)")
+    indices_parser.add_argument("--lines", nargs="+", default=None,
+                                help="Lines to measure (default all)")
+
+    # Pipeline of steps from a config file
+    pipeline_parser = subparsers.add_parser(
+        "pipeline", help="Run the steps of a TOML/YAML pipeline file")
+    pipeline_parser.add_argument("config", help="Pipeline file")
+    pipeline_parser.add_argument("--workers", type=int, default=None,
+                                 help="Maximum number of steps run at once")
+    pipeline_parser.add_argument("--force", action="store_true",
+                                 help="Run every step, even if up to date")
+
+    # Long running service
+    watch_parser = subparsers.add_parser(
+        "watch", help="Watch a directory and process new frames")
+    watch_parser.add_argument("directory", help="Directory to watch")
+    watch_parser.add_argument("--outdir", default=None,
+                              help="Directory for the products")
+    watch_parser.add_argument("--pattern", default="*.fits",
+                              help="Glob pattern of the input frames")
+    watch_parser.add_argument("--operator", default=None,
+                              choices=["+", "-", "*", "/"],
+                              help="Binary operation applied to each frame")
+    watch_parser.add_argument("--operand", default=None,
+                              help="Reference frame or constant operand")
+    watch_parser.add_argument("--cosmic", action="store_true",
+                              help="Remove cosmic rays from each frame")
+    watch_parser.add_argument("--combine", default=None,
+                              choices=["mean", "median", "biweight",
+                                       "weightedavg"],
+                              help="Combine processed frames")
+    watch_parser.add_argument("--combine-every", type=int, default=10,
+                              help="Frames per combined product")
+    watch_parser.add_argument("--flux", nargs="+", default=[0],
+                              help="Extensions of flux")
+    watch_parser.add_argument("--var", nargs="+", default=None,
+                              help="Extensions of variance")
+    watch_parser.add_argument("--workers", type=int, default=4,
+                              help="Number of worker threads")
+    watch_parser.add_argument("--poll", type=float, default=0.5,
+                              help="Seconds between directory scans")
+    watch_parser.add_argument("--status-file", default=None,
+                              help="JSON file with queue and throughput")
+    watch_parser.add_argument("--backend", default="numpy",
+                              choices=["numpy", "numba", "auto"],
+                              help="Kernel backend")
 
     return parser
 
@@ -6,9 +6,16 @@ import astropy.units as u
 from scipy.interpolate import CubicSpline
 from collections import defaultdict
 from .logger import logger
+from .jobs import check_cancelled
 from .utils import create_fits
+from .checkpoint import CombineCheckpoint
+from .export import export_spectra
 from .instrument import instrument_dict
 from .utils import extract_allexts
+from .readers import handle_pool
+from .rv import doppler_resample
+from .wlmask import as_wavelength_mask
+from .wlmask import MIN_WAVELENGTH
 from .operations import combine_data_full
 from .operations import combine_data
 
@@ -32,6 +39,63 @@ def interpolate_data(data, wl_new, wl_corr):
     return corr_data
 
 
+def resample_orders(epoch_flux, epoch_wl, epoch_var, ref_wl):
+    '''
+    Resample all orders of one epoch onto the reference wavelengths.
+    The arrays are modified in place.
+    epoch_flux, epoch_wl, epoch_var: (orders x pixels) arrays of the epoch.
+    ref_wl: (orders x pixels) reference wavelength array.
+    Pixels below MIN_WAVELENGTH (padding of the wavelength solution) are
+    not resampled.
+    '''
+    for order, wl_order in enumerate(epoch_wl):
+        # Goint through each order of the epoch
+        fl_order = epoch_flux[order]
+        var_order = epoch_var[order]
+        data_nanmask = np.isnan(fl_order) | np.isnan(var_order) \
+            | np.isinf(fl_order) | np.isinf(var_order)
+        wl_zeros = wl_order < MIN_WAVELENGTH
+        data_mask = data_nanmask | wl_zeros
+        if np.sum(data_mask) == np.size(fl_order):
+            continue
+        interp_flux = interpolate_data(fl_order[~data_mask],
+                                       wl_order[~data_mask],
+                                       ref_wl[order][~data_mask])
+        interp_var = interpolate_data(var_order[~data_mask],
+                                      wl_order[~data_mask],
+                                      ref_wl[order][~data_mask])
+
+        fl_order[~data_mask] = interp_flux
+        var_order[~data_mask] = interp_var
+
+        epoch_flux[order] = fl_order
+        epoch_var[order] = var_order
+        epoch_wl[order] = ref_wl[order]
+    return epoch_flux, epoch_wl, epoch_var
+
+
+def resample_epoch(datadict, ref_wl, fluxext, wlext, varext):
+    '''
+    Resample the spectra of a single file onto reference wavelengths.
+    datadict: dictionary of one file (eg. from process_data).
+    ref_wl: list of reference wavelength arrays, one for each
+            entry of wlext.
+    '''
+    keys = list(datadict.keys())
+    for index, wext in enumerate(wlext):
+        header_wl = keys[wext]
+        header_fl = keys[fluxext[index]]
+        header_va = keys[varext[index]]
+        epoch_flux = np.array(datadict[header_fl])
+        epoch_wl = np.array(datadict[header_wl])
+        epoch_var = np.array(datadict[header_va])
+        resample_orders(epoch_flux, epoch_wl, epoch_var, ref_wl[index])
+        datadict[header_fl] = epoch_flux
+        datadict[header_wl] = epoch_wl
+        datadict[header_va] = epoch_var
+    return datadict
+
+
 def interpolation_spectra(fulldata, fluxext, wlext, varext):
     '''
     fulldata: dictionary.
@@ -44,7 +108,6 @@ def interpolation_spectra(fulldata, fluxext, wlext, varext):
         header_wl = keys[wext]
         header_fl = keys[fext]
         header_va = keys[vext]
-        # print(header_wl, header_fl, header_va)
 
         flux_data = np.array(fulldata[header_fl])
         wl_data = np.array(fulldata[header_wl])
@@ -55,50 +118,10 @@ def interpolation_spectra(fulldata, fluxext, wlext, varext):
             header_wl, header_fl, header_va))
 
         ref_wl = wl_data[0]
-        # print(np.size(wl_data))
-        for epoin, epodata in enumerate(wl_data):
+        for epoin in range(len(wl_data)):
             # Goint through each epoch
-            # print("Epoch", epoin)
-            # logger.info("Epoch {}".format(epoin))
-            epoch_flux = flux_data[epoin]
-            epoch_wl = wl_data[epoin]
-            epoch_var = var_data[epoin]
-
-            for order, wl_order in enumerate(epoch_wl):
-                # Goint through each order of the epoch
-                # print(order, '==========================')
-                # logger.info("order {}".format(order))
-                fl_order = epoch_flux[order]
-                var_order = epoch_var[order]
-                # plt.figure()
-                # plt.plot(wl_order, fl_order, 'o-')
-                # plt.show()
-                data_nanmask = np.isnan(fl_order) | np.isnan(var_order) \
-                    | np.isinf(fl_order) | np.isinf(var_order)
-                wl_zeros = wl_order < 3000
-                data_mask = data_nanmask | wl_zeros
-                if np.sum(data_mask) == np.size(fl_order):
-                    interp_flux = fl_order
-                    interp_var = var_order
-                    continue
-                else:
-                    interp_flux = interpolate_data(fl_order[~data_mask],
-                                                   wl_order[~data_mask],
-                                                   ref_wl[order][~data_mask])
-                    interp_var = interpolate_data(var_order[~data_mask],
-                                                  wl_order[~data_mask],
-                                                  ref_wl[order][~data_mask])
-
-                    fl_order[~data_mask] = interp_flux
-                    var_order[~data_mask] = interp_var
-
-                epoch_flux[order] = fl_order
-                epoch_var[order] = var_order
-                # print("Ref wl", ref_wl[order
-                epoch_wl[order] = ref_wl[order]
-            flux_data[epoin] = epoch_flux
-            wl_data[epoin] = epoch_wl
-            var_data[epoin] = epoch_var
+            resample_orders(flux_data[epoin], wl_data[epoin],
+                            var_data[epoin], ref_wl)
 
         fulldata[header_fl] = flux_data
         fulldata[header_wl] = wl_data
@@ -107,7 +130,7 @@ def interpolation_spectra(fulldata, fluxext, wlext, varext):
 
 
 def continuum_normalize(datadict, flux_exts=[1],
-                        var_exts=[4], wl_exts=[7]):
+                        var_exts=[4], wl_exts=[7], wl_mask=None):
     """
     Perform continuum normalization on flux and variance arrays in
     a FITS-like data dictionary.
@@ -131,6 +154,10 @@ def continuum_normalize(datadict, flux_exts=[1],
         Indices of extensions containing variance arrays. Default is [4].
     wl_exts : list of int, optional
         Indices of extensions containing wavelength arrays. Default is [7].
+    wl_mask : WavelengthMask or array_like or str, optional
+        Wavelength intervals (e.g. strong lines or tellurics) left out of
+        the continuum fit; the whole spectrum is still normalized. See
+        `ariastro.wlmask.WavelengthMask`. Default is None.
 
     Returns
     -------
@@ -159,6 +186,7 @@ def continuum_normalize(datadict, flux_exts=[1],
     >>> norm_flux = norm_datadict['SCI_FLUX_EXT1']
     """
     dict_keys = list(datadict.keys())
+    wl_mask = as_wavelength_mask(wl_mask)
 
     for n, ext in enumerate(flux_exts):
         # n = 0
@@ -169,6 +197,9 @@ def continuum_normalize(datadict, flux_exts=[1],
         flux_array = datadict[flux_key]
         var_array = datadict[var_key]
         wl_array = datadict[wl_key]
+        linemask = None
+        if wl_mask is not None:
+            linemask = wl_mask.mask(wl_array)
 
         for index in range(np.shape(flux_array)[0]):
 
@@ -179,11 +210,15 @@ def continuum_normalize(datadict, flux_exts=[1],
             nanmask = np.isnan(flux) | np.isinf(flux)
             if np.sum(nanmask) == np.shape(flux)[0]:
                 continue
+            fitmask = ~nanmask
+            if linemask is not None and np.any(fitmask & ~linemask[index]):
+                fitmask = fitmask & ~linemask[index]
             flux = flux[~nanmask]
             var = var[~nanmask]
             wl = wl[~nanmask]
 
-            spectrum = Spectrum(flux=flux*u.ph, spectral_axis=wl*u.AA)
+            spectrum = Spectrum(flux=flux_array[index, fitmask]*u.ph,
+                                spectral_axis=wl_array[index, fitmask]*u.AA)
             g1_fit = fit_generic_continuum(spectrum, median_window=15)
             y_continuum_fitted = g1_fit(wl*u.AA)
             corr_flux = flux / y_continuum_fitted
@@ -196,6 +231,91 @@ def continuum_normalize(datadict, flux_exts=[1],
     return datadict
 
 
+def spectral_section(wl_arrays, order_numbers=None, orders=None,
+                     wl_range=None, margin=4):
+    """
+    Order and pixel slices of echelle spectra that cover the requested
+    orders and wavelength range.
+
+    Parameters
+    ----------
+    wl_arrays : list of numpy.ndarray
+        (orders x pixels) wavelength arrays, e.g. one per fiber. The
+        section covers the range in all of them.
+    order_numbers : array_like or None, optional
+        Order number of every row. Default is the row index.
+    orders : tuple of int or None, optional
+        First and last order number to keep (in any order, inclusive).
+    wl_range : tuple of float or None, optional
+        Minimum and maximum wavelength to keep.
+    margin : int, optional
+        Extra pixels kept on both sides of the wavelength range, for the
+        interpolation at the edges. Default is 4.
+
+    Returns
+    -------
+    tuple of slice or None
+        ``(orders, pixels)`` slices with explicit bounds, or None if
+        `orders` and `wl_range` are both None (no subsetting).
+
+    Raises
+    ------
+    ValueError
+        If no pixel is left.
+    """
+    if orders is None and wl_range is None:
+        return None
+    n_orders, n_pix = np.shape(wl_arrays[0])
+    if order_numbers is None:
+        order_numbers = np.arange(n_orders)
+    keep = np.ones(n_orders, dtype=bool)
+    if orders is not None:
+        keep &= (order_numbers >= min(orders)) \
+            & (order_numbers <= max(orders))
+    pixels = np.ones(n_pix, dtype=bool)
+    if wl_range is not None:
+        inside = np.zeros((n_orders, n_pix), dtype=bool)
+        for wl in wl_arrays:
+            inside |= (wl >= min(wl_range)) & (wl <= max(wl_range))
+        keep &= inside.any(axis=1)
+        pixels = inside[keep].any(axis=0)
+    rows = np.flatnonzero(keep)
+    columns = np.flatnonzero(pixels)
+    if rows.size == 0 or columns.size == 0:
+        raise ValueError("No data in orders {} and wavelength range {}"
+                         .format(orders, wl_range))
+    first = max(columns[0] - margin, 0)
+    last = min(columns[-1] + 1 + margin, n_pix)
+    return (slice(int(rows[0]), int(rows[-1]) + 1),
+            slice(int(first), int(last)))
+
+
+def _header_value(headerdict, key):
+    """Value of `key` in the first extension header that has it."""
+    for header in headerdict.values():
+        if header is not None and key in header:
+            return float(header[key])
+    raise KeyError("No header has the keyword {}".format(key))
+
+
+def _read_section(files_list, wlext, order_numbers, orders, wl_range):
+    """`spectral_section` from the wavelengths of the first readable file."""
+    for specfile in files_list:
+        try:
+            with handle_pool.open(specfile) as hdul:
+                wl_arrays = [np.asarray(hdul[int(wext)].data)
+                             for wext in wlext]
+        except Exception as err:
+            logger.warning("Cannot read wavelengths of {}: {}".format(
+                specfile, err))
+            continue
+        numbers = None if order_numbers is None \
+            else order_numbers(wl_arrays[0].shape[0])
+        return spectral_section(wl_arrays, numbers, orders, wl_range)
+    raise ValueError("No readable file to select orders and wavelengths")
+
+
+@handle_pool.scope()
 def combine_spectra(filesre="*.fits", directory=".",
                     opfilename="Comb_spectra.fits",
                     instrumentname=None,
@@ -203,7 +323,17 @@ def combine_spectra(filesre="*.fits", directory=".",
                     fluxext=(1, 2, 3),
                     varext=(4, 5, 6),
                     wlext=(7, 8, 9),
-                    orders=(173, 52)):
+                    orders=None,
+                    wl_range=None,
+                    backend='numpy',
+                    checkpoint_dir=None,
+                    keep_checkpoint=False,
+                    output_format='fits',
+                    epochs_output=None,
+                    uncertainty='propagate',
+                    velocity=None,
+                    diagnostics=False,
+                    wl_mask=None):
     '''
     Function to combine spectra.
     Input
@@ -211,76 +341,259 @@ def combine_spectra(filesre="*.fits", directory=".",
     filesre: Regular expression for the files.
     directory: data directory.
     fluxext: extension for flux array.
+    backend: kernel backend for the combine ('numpy', 'numba', 'auto').
+    checkpoint_dir: scratch directory for checkpoints. If given, every
+        preprocessed and resampled file is saved there, and a rerun with
+        the same files and parameters resumes from the saved epochs.
+    keep_checkpoint: keep the checkpoint after a successful run.
+    output_format: 'fits' (default), 'hdf5' or 'zarr' for the combined
+        product. See ariastro.export.export_spectra.
+    epochs_output: if given, the resampled per-epoch spectra are also
+        written to this HDF5 (.h5) or Zarr (.zarr) file before combining.
+    uncertainty: 'propagate' (default), 'bootstrap' or 'jackknife'. With
+        resampling, the variance extensions hold the empirical variance of
+        the combined flux. See ariastro.uncertainty.
+    orders: (first, last) echelle order numbers to combine (row indices
+        without an instrument). Default is all orders.
+    wl_range: (min, max) wavelength range to combine. Only the orders and
+        pixel columns covering it are kept.
+    velocity: combine in the rest frame of the star. Either a header
+        keyword holding the RV of each epoch in km/s (e.g. 'CCFRVMOD',
+        looked up in all extension headers) or one velocity per input
+        file. The epochs are not resampled one by one onto the first
+        epoch; instead all of them are Doppler shifted and resampled onto
+        a common log-lambda grid in one batched step
+        (ariastro.rv.doppler_resample). The output wavelengths are the
+        rest-frame grid.
+    diagnostics: also write the NCOMBINE, STDDEV and REJFRAC maps of every
+        flux extension as '<flux>_NCOMBINE', ... extensions (FITS output
+        only). See ariastro.operations.combine_diagnostics.
+    wl_mask: wavelength intervals to mask (e.g. a telluric line list), as a
+        WavelengthMask, an array of (lo, hi) or a text file of them. The
+        flux and variance of every epoch inside them are set to NaN, so
+        they are left out of the combine. They are masked once on the
+        reference grid, after resampling; with `velocity`, on the
+        wavelengths of every epoch as read, before the rest-frame shift.
+        See ariastro.wlmask.
+
+    With `orders` or `wl_range`, the section is resolved once from the
+    wavelengths of the first file (see spectral_section). Only that
+    section of the flux, variance, wavelength (and blaze) extensions is
+    read from every file, and only it goes through the barycentric
+    correction, resampling and combine.
+
+    Files that fail to read or preprocess are quarantined: the error is
+    logged, the file is skipped and (with checkpointing) recorded in the
+    checkpoint manifest.
     '''
-    # print(filesre)
     if isinstance(filesre, list):
         files_list = filesre
     elif isinstance(filesre, str):
         files_path = Path(directory)
-        files_list = files_path.glob(filesre)
+        files_list = sorted(files_path.glob(filesre))
     else:
-        print("Enter either files list or the regular expression")
-        return
+        raise TypeError("Enter either files list or the regular expression")
 
     data_dict = defaultdict(list)
     headerdict_main = None
     file_list = []
+    quarantined = []
+    epoch_headers = []
+    epoch_velocities = []
     if instrumentname is not None:
         instrument = instrument_dict[instrumentname]()
         fluxext, varext, wlext = instrument.fits_extensions()
     req_qtys = None
-    req_qtys_dict = defaultdict(list)
-    req_qtys_dict_fullext = {}
+    if instrumentname is not None:
+        req_qtys = instrument.req_qtys()
+    req_qtys_dict_fullext = defaultdict(lambda: defaultdict(list))
+
+    section = None
+    if orders is not None or wl_range is not None:
+        section = _read_section(
+            files_list, wlext,
+            None if instrumentname is None else instrument.order_numbers,
+            orders, wl_range)
+    section_exts = list(fluxext) + list(varext) + list(wlext)
+    if section is not None:
+        logger.info("Combining rows {}:{} and pixels {}:{}".format(
+            section[0].start, section[0].stop,
+            section[1].start, section[1].stop))
+
+    wl_mask = as_wavelength_mask(wl_mask)
+    checkpoint = None
+    if checkpoint_dir is not None:
+        params = {'instrument': instrumentname,
+                  'fluxext': list(fluxext), 'varext': list(varext),
+                  'wlext': list(wlext)}
+        if section is not None:
+            params['section'] = [section[0].start, section[0].stop,
+                                 section[1].start, section[1].stop]
+        if velocity is not None:
+            params['velocity'] = velocity if isinstance(velocity, str) \
+                else [float(value) for value in velocity]
+        if wl_mask is not None:
+            params['wl_mask'] = wl_mask.intervals.tolist()
+        checkpoint = CombineCheckpoint(checkpoint_dir, files_list, params)
+
+    # On resume, the epochs still to process go onto the grid of the
+    # saved ones.
+    ref_wl = None if checkpoint is None else checkpoint.load_reference()
     for cro, specfile in enumerate(files_list):
+        check_cancelled()
         specfile = Path(specfile)
-        # print(specfile)
         logger.info("{} {}".format(cro, specfile))
-        file_list.append(specfile.name)
-        if instrumentname is not None:
-            datadict, headerdict = instrument.process_data(fname=specfile,
-                                                           contnorm=False)
-            req_qtys = instrument.req_qtys()
-
+        if checkpoint is not None and checkpoint.is_quarantined(specfile):
+            logger.warning("Skipping quarantined file {}".format(specfile))
+            quarantined.append(specfile.name)
+            continue
+        saved = None
+        if checkpoint is not None:
+            saved = checkpoint.load(specfile)
+        if saved is not None:
+            datadict, headerdict, qtys = saved
+            keys = list(datadict.keys())
         else:
-            datadict, headerdict = extract_allexts(fname=specfile)
-        if req_qtys is not None:
-            for extname, qtys in req_qtys.items():
-                for qty in qtys:
-                    req_qtys_dict[qty].append(headerdict[extname][qty])
-                req_qtys_dict_fullext[extname] = req_qtys_dict
-        # print(req_qtys_dict)
+            try:
+                if instrumentname is not None:
+                    datadict, headerdict = instrument.process_data(
+                        fname=specfile, contnorm=False, section=section)
+                else:
+                    datadict, headerdict = extract_allexts(
+                        fname=specfile, section=section,
+                        section_exts=section_exts)
+                if wl_mask is not None and velocity is not None:
+                    # Each epoch is shifted to the rest frame on its own
+                    # grid: the intervals are masked on the wavelengths as
+                    # read, and the cache of ranges does not help.
+                    datadict = wl_mask.apply_datadict(datadict, fluxext,
+                                                      varext, wlext)
+                qtys = {}
+                if req_qtys is not None:
+                    for extname, names in req_qtys.items():
+                        qtys[extname] = {qty: headerdict[extname][qty]
+                                         for qty in names}
+                keys = list(datadict.keys())
+                if isinstance(velocity, str):
+                    # Fails early, so that the file is quarantined.
+                    _header_value(headerdict, velocity)
+                elif velocity is None:
+                    if ref_wl is None:
+                        ref_wl = [np.array(datadict[keys[wext]])
+                                  for wext in wlext]
+                        if checkpoint is not None:
+                            checkpoint.save_reference(ref_wl)
+                    datadict = resample_epoch(datadict, ref_wl,
+                                              fluxext, wlext, varext)
+            except Exception as err:
+                logger.error("Quarantining {}: {}".format(specfile, err))
+                quarantined.append(specfile.name)
+                if checkpoint is not None:
+                    checkpoint.quarantine(specfile, err)
+                continue
+            if checkpoint is not None:
+                checkpoint.save(specfile, datadict, headerdict, qtys)
+
+        file_list.append(specfile.name)
+        if velocity is not None:
+            epoch_velocities.append(
+                _header_value(headerdict, velocity)
+                if isinstance(velocity, str) else float(velocity[cro]))
+        for extname, values in qtys.items():
+            for qty, value in values.items():
+                req_qtys_dict_fullext[extname][qty].append(value)
         if headerdict_main is None:
             headerdict_main = headerdict
+        if epochs_output is not None:
+            epoch_headers.append(headerdict)
 
         for hduname, data in datadict.items():
-            # print(hduname)
             data_dict[hduname].append(data)
-    # print("data_dict", np.array(data_dict["SCIWAVE"])[:, 50])
-    interp_data_dict = interpolation_spectra(data_dict, fluxext, wlext, varext)
-    # print(req_qtys_dict_fullext)
-    if req_qtys is not None:
-        for extname, qtys in req_qtys_dict_fullext.items():
-            # print(extname, qtys)
-            for qty, value in qtys.items():
-                if method == 'weightedavg':
-                    qty_method = 'mean'
-                else:
-                    qty_method = method
-                comb_qty = combine_data(value, method=qty_method)
-                headerdict_main[extname][qty] = comb_qty[0]
-    combined_dict = combine_data_full(interp_data_dict, method=method)
-    # # print(combined_dict)
+
+    if headerdict_main is None:
+        logger.error("No spectra could be read. Nothing to combine.")
+        return
+    if len(quarantined) > 0:
+        logger.warning("Quarantined {} file(s): {}".format(
+            len(quarantined), quarantined))
+
+    dict_keys = list(data_dict.keys())
+    for ext in list(fluxext) + list(varext) + list(wlext):
+        data_dict[dict_keys[ext]] = np.array(data_dict[dict_keys[ext]])
+    if wl_mask is not None and velocity is None:
+        # Every epoch is resampled onto the reference grid: the ranges of
+        # the intervals are computed once and masked in all epochs.
+        for index, wext in enumerate(wlext):
+            inside = wl_mask.mask(data_dict[dict_keys[wext]][0])
+            for ext in (fluxext[index], varext[index]):
+                data_dict[dict_keys[ext]] = np.where(
+                    inside, np.nan, data_dict[dict_keys[ext]])
+    if velocity is not None:
+        check_cancelled()
+        logger.info("Shifting {} epochs to the rest frame".format(
+            len(epoch_velocities)))
+        for index, wext in enumerate(wlext):
+            wl_key = dict_keys[wext]
+            fl_key = dict_keys[fluxext[index]]
+            va_key = dict_keys[varext[index]]
+            lnwl_grid, flux_grid, var_grid = doppler_resample(
+                data_dict[wl_key], data_dict[fl_key], epoch_velocities,
+                var=data_dict[va_key])
+            data_dict[fl_key] = flux_grid
+            data_dict[va_key] = var_grid
+            data_dict[wl_key] = np.broadcast_to(np.exp(lnwl_grid),
+                                                flux_grid.shape)
+
+    if epochs_output is not None:
+        export_spectra(data_dict, epoch_headers,
+                       Path(directory) / epochs_output,
+                       fluxext=fluxext, varext=varext, wlext=wlext,
+                       epoch_names=file_list)
+
+    for extname, qtys in req_qtys_dict_fullext.items():
+        for qty, value in qtys.items():
+            if method == 'weightedavg':
+                qty_method = 'mean'
+            else:
+                qty_method = method
+            comb_qty = combine_data(value, method=qty_method)
+            headerdict_main[extname][qty] = comb_qty[0]
+    check_cancelled()
+    combined_dict = combine_data_full(data_dict, method=method,
+                                      backend=backend,
+                                      uncertainty=uncertainty,
+                                      diagnostics=diagnostics)
     dict_keys = list(headerdict_main.keys())
+    for key in combined_dict:
+        if key not in headerdict_main:
+            headerdict_main[key] = {}
 
     headerdict_main[dict_keys[0]]['HISTORY'] = "{} {}".format(method,
                                                               list(file_list))
+    if velocity is not None:
+        headerdict_main[dict_keys[0]]['HISTORY'] = \
+            "rest frame, velocities (km/s) {}".format(
+                [round(value, 4) for value in epoch_velocities])
+    if section is not None:
+        headerdict_main[dict_keys[0]]['HISTORY'] = \
+            "section rows {}:{} pixels {}:{}".format(
+                section[0].start, section[0].stop,
+                section[1].start, section[1].stop)
+    if wl_mask is not None:
+        headerdict_main[dict_keys[0]]['HISTORY'] = \
+            "masked {} wavelength intervals".format(len(wl_mask))
 
     logger.info("Combining spectra")
-    create_fits(combined_dict, headerdict_main,
-                filename=Path(directory) / opfilename)
+    if output_format == 'fits':
+        create_fits(combined_dict, headerdict_main,
+                    filename=Path(directory) / opfilename)
+    else:
+        export_spectra(combined_dict, headerdict_main,
+                       Path(directory) / opfilename, fmt=output_format,
+                       fluxext=fluxext, varext=varext, wlext=wlext)
     logger.info("Combined spectra")
-    # print(header_dict)
+    if checkpoint is not None and not keep_checkpoint:
+        checkpoint.remove()
     del data_dict
-    # print(np.array(flux).shape)
 
 # End
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.stats import biweight_location
+
+UNCERTAINTY_MODES = ('propagate', 'bootstrap', 'jackknife')
+
+
+def resample_indices(nframes, mode='bootstrap', nsamples=200, seed=None):
+    """
+    Frame indices of every resample of a stack.
+
+    Parameters
+    ----------
+    nframes : int
+        Number of frames in the stack.
+    mode : {'bootstrap', 'jackknife'}, optional
+        ``'bootstrap'`` draws `nsamples` resamples of `nframes` frames with
+        replacement; ``'jackknife'`` leaves one frame out in turn.
+    nsamples : int, optional
+        Number of bootstrap resamples. Default is 200.
+    seed : int or None, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    numpy.ndarray
+        Integer array of shape (nsamples, nframes) for the bootstrap, or
+        (nframes, nframes - 1) for the jackknife.
+    """
+    if nframes < 2:
+        raise ValueError("Resampling needs at least two frames")
+    if mode == 'bootstrap':
+        rng = np.random.default_rng(seed)
+        return rng.integers(0, nframes, size=(nsamples, nframes))
+    if mode == 'jackknife':
+        frames = np.arange(nframes)
+        return np.array([np.delete(frames, left) for left in frames])
+    raise ValueError(f"Unsupported uncertainty mode '{mode}'.")
+
+
+def _multiplicity(indices, nframes):
+    counts = np.zeros((indices.shape[0], nframes))
+    np.add.at(counts, (np.arange(indices.shape[0])[:, None], indices), 1)
+    return counts
+
+
+def _resampled_median(chunk, counts, size):
+    """
+    Median of every resample of a (nframes, npix) chunk without NaNs.
+
+    Every pixel is sorted once; the median of a resample is then read
+    from the cumulative multiplicity of the sorted samples, which is much
+    cheaper than gathering and partitioning every resample.
+    """
+    samples = np.ascontiguousarray(chunk.T)
+    order = np.argsort(samples, axis=1)
+    ordered = np.take_along_axis(samples, order, axis=1)
+    cumulative = np.cumsum(counts.astype(np.int32)[:, order], axis=-1)
+    low = (cumulative <= (size - 1) // 2).sum(axis=-1)
+    high = (cumulative <= size // 2).sum(axis=-1)
+    pixels = np.arange(ordered.shape[0])
+    return 0.5 * (ordered[pixels, low] + ordered[pixels, high])
+
+
+def _resampled_statistic(chunk, varchunk, method, indices, counts):
+    """
+    Statistic of every resample of a (nframes, npix) chunk, shape
+    (nresamples, npix).
+    """
+    if method in ('mean', 'weightedavg'):
+        # Linear statistics: a resample is a weighted sum of the frames,
+        # so all of them are one matrix product, without gathering.
+        valid = np.isfinite(chunk)
+        values = np.where(valid, chunk, 0.0)
+        if method == 'weightedavg':
+            weights = np.where(valid, 1.0 / varchunk, 0.0)
+            return (counts @ (values * weights)) / (counts @ weights)
+        return (counts @ values) / (counts @ valid)
+    if method == 'median' and not np.isnan(chunk).any():
+        return _resampled_median(chunk, counts, indices.shape[1])
+    gathered = chunk[indices]
+    if method == 'median':
+        return np.nanmedian(gathered, axis=1)
+    if method == 'biweight':
+        return biweight_location(gathered, axis=1)
+    raise ValueError(f"Unsupported combine method '{method}'.")
+
+
+def resampled_variance(dataarr, var=None, method='median',
+                       mode='bootstrap', nsamples=200, seed=None,
+                       chunk_bytes=2**25, workers=4):
+    r"""
+    Empirical variance of a combined stack by bootstrap or jackknife.
+
+    The stack axis is resampled with one set of index vectors shared by
+    all pixels. Pixels are processed in chunks, in parallel threads, and
+    each chunk holds at most `chunk_bytes` of resampled data, so the full
+    stack is never copied once per resample. For ``'mean'`` and
+    ``'weightedavg'`` every resample is a weighted sum of the frames and
+    all of them are computed with one matrix product per chunk. For
+    ``'median'`` every pixel is sorted once and the median of each
+    resample is read from the multiplicities of the sorted samples.
+
+    Parameters
+    ----------
+    dataarr : array_like
+        Stack of shape (N, ...). The combination is along axis 0.
+    var : array_like or None, optional
+        Variance stack, only needed for ``'weightedavg'``.
+    method : {'mean', 'median', 'biweight', 'weightedavg'}, optional
+        Combine method whose uncertainty is estimated. Default is
+        ``'median'``.
+    mode : {'bootstrap', 'jackknife'}, optional
+        Resampling scheme. Default is ``'bootstrap'``.
+    nsamples : int, optional
+        Number of bootstrap resamples. Default is 200.
+    seed : int or None, optional
+        Seed of the bootstrap resamples.
+    chunk_bytes : int, optional
+        Memory budget of the resampled data of one chunk. Default is
+        32 MiB.
+    workers : int, optional
+        Number of threads. Default is 4.
+
+    Returns
+    -------
+    numpy.ndarray
+        Variance of the combined value, shape of ``dataarr[0]``.
+
+    Notes
+    -----
+    The bootstrap variance is the sample variance of the resampled
+    statistics. The jackknife variance is
+    :math:`\frac{N-1}{N}\sum_i (\theta_{(i)} - \bar\theta)^2`.
+    """
+    data = np.asarray(dataarr, dtype=np.float64)
+    nframes = data.shape[0]
+    flat = data.reshape(nframes, -1)
+    varflat = None
+    if var is not None:
+        varflat = np.asarray(var, dtype=np.float64).reshape(nframes, -1)
+    elif method == 'weightedavg':
+        raise TypeError("variances must be an array-like object")
+    indices = resample_indices(nframes, mode, nsamples, seed)
+    counts = _multiplicity(indices, nframes)
+    npix = flat.shape[1]
+    step = max(1, chunk_bytes // (8 * indices.size))
+    variance = np.empty(npix)
+
+    def work(start):
+        stop = min(start + step, npix)
+        chunk = np.ascontiguousarray(flat[:, start:stop])
+        varchunk = None if varflat is None \
+            else np.ascontiguousarray(varflat[:, start:stop])
+        stats = _resampled_statistic(chunk, varchunk, method, indices,
+                                     counts)
+        if mode == 'jackknife':
+            variance[start:stop] = (nframes - 1) * np.var(stats, axis=0)
+        else:
+            variance[start:stop] = np.var(stats, axis=0, ddof=1)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(work, range(0, npix, step)))
+    return variance.reshape(data.shape[1:])
+
+# End
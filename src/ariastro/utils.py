@@ -1,5 +1,62 @@
+import os
+from functools import lru_cache
+
+import numpy as np
 from astropy.io import fits
 
+from .readers import handle_pool
+from .readers import read_image
+
+HEADER_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _cached_header(path, mtime_ns, size, ext):
+    # mtime_ns and size are part of the key only, so that a file that
+    # changed on disk is parsed again.
+    with fits.open(path, memmap=True) as hdul:
+        return hdul[ext].header.copy()
+
+
+def get_header(fname, ext=0):
+    """
+    Read a FITS header through a shared LRU cache.
+
+    The cache is keyed by the resolved path, the modification time, the
+    size and the extension, so repeated reads of the same header do not
+    re-open the file or re-parse its cards, and a modified file is read
+    again. At most ``HEADER_CACHE_SIZE`` headers are kept; the least
+    recently used are evicted first.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Path to the FITS file.
+    ext : int or str, optional
+        Extension number or name. Default is 0.
+
+    Returns
+    -------
+    astropy.io.fits.Header
+        A copy of the header, safe to modify.
+    """
+    path = os.path.realpath(fname)
+    stat = os.stat(path)
+    if isinstance(ext, str) and ext.lstrip('-').isdigit():
+        ext = int(ext)
+    return _cached_header(path, stat.st_mtime_ns, stat.st_size,
+                          ext).copy()
+
+
+def clear_header_cache():
+    """Empty the header cache used by `get_header`."""
+    _cached_header.cache_clear()
+
+
+def header_cache_info():
+    """Return hits, misses, maxsize and current size of the cache."""
+    return _cached_header.cache_info()
+
 
 def extract_data_header(hdu, ext=0):
     """
@@ -13,7 +70,7 @@ def extract_data_header(hdu, ext=0):
     return data, header, extname
 
 
-def extract_allexts(fname):
+def extract_allexts(fname, section=None, section_exts=()):
     """
     Extract all extensions from a FITS file.
 
@@ -21,6 +78,11 @@ def extract_allexts(fname):
     ----------
     fname : str
         Path to the FITS file.
+    section : tuple of slice or None, optional
+        If given, only this section (e.g. ``(orders, pixels)``) of the
+        extensions `section_exts` is read. Default is None.
+    section_exts : list of int, optional
+        Extensions read through `section`.
 
     Returns
     -------
@@ -29,15 +91,37 @@ def extract_allexts(fname):
         containing the data.
     headerdict : dict
         Dictionary mapping extension keywords to FITS headers.
+
+    Notes
+    -----
+    The file is borrowed from `ariastro.readers.handle_pool`, which bounds
+    the number of open files, and the arrays and headers are copied out,
+    so nothing returned keeps the file open. Tile-compressed extensions
+    are decompressed with `read_image`, which splits the tiles over
+    several threads. Sections are sliced from the memmap (or decompress
+    only their tiles), so the rest of those extensions is not read.
         """
 
-    hdu = fits.open(fname)
     datadict = {}
     headerdict = {}
-    for ext in range(len(hdu)):
-        data, header, extname = extract_data_header(hdu, ext=ext)
-        datadict[extname] = data
-        headerdict[extname] = header
+    with handle_pool.open(fname) as hdu:
+        for ext in range(len(hdu)):
+            window = section if section is not None \
+                and ext in section_exts else None
+            if isinstance(hdu[ext], fits.CompImageHDU):
+                header = hdu[ext].header
+                extname = header.get("EXTNAME")
+                if window is None:
+                    data = read_image(fname, ext=ext)
+                else:
+                    data = np.array(hdu[ext].section[window])
+            else:
+                data, header, extname = extract_data_header(hdu, ext=ext)
+                if data is not None:
+                    data = data.copy() if window is None \
+                        else np.array(data[window])
+            datadict[extname] = data
+            headerdict[extname] = header.copy()
     return datadict, headerdict
 
 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+
+# Wavelengths below this value (Angstrom) are padding of the wavelength
+# solution, not data.
+MIN_WAVELENGTH = 3000.0
+
+
+def grid_fingerprint(wl):
+    """Key of a wavelength grid: shape, dtype and digest of its values."""
+    wl = np.ascontiguousarray(wl)
+    digest = hashlib.blake2b(wl.view(np.uint8).ravel(),
+                             digest_size=16).hexdigest()
+    return wl.shape, wl.dtype.str, digest
+
+
+class WavelengthMask:
+    """
+    Mask of wavelength intervals on echelle wavelength grids.
+
+    The intervals (e.g. a telluric or sky line list) are turned into
+    ``(start, stop)`` pixel ranges of every order with `numpy.searchsorted`
+    on the wavelengths of the order, instead of comparing every pixel with
+    every interval. The ranges of a grid are cached by its fingerprint, so
+    all the spectra on one grid (e.g. resampled epochs) share them, and
+    they are applied as slices.
+
+    Parameters
+    ----------
+    intervals : array_like
+        ``(lo, hi)`` wavelength intervals, half open ``[lo, hi)``. They
+        are sorted and overlapping ones merged. ``-inf``/``inf`` bounds
+        are allowed.
+    cache_size : int, optional
+        Number of grids whose ranges are kept. Default is 16.
+
+    Raises
+    ------
+    ValueError
+        If the intervals are not ``(lo, hi)`` pairs with ``lo <= hi``.
+
+    Notes
+    -----
+    Orders whose wavelengths are not finite and increasing fall back to
+    the pixel by pixel comparison, converted to ranges and cached in the
+    same way. The intervals are in the frame of the wavelengths they are
+    applied to.
+    """
+
+    def __init__(self, intervals, cache_size=16):
+        intervals = np.asarray(intervals, dtype=np.float64)
+        if intervals.size % 2:
+            raise ValueError("Intervals must be (lo, hi) pairs")
+        intervals = intervals.reshape(-1, 2)
+        if np.any(intervals[:, 0] > intervals[:, 1]):
+            raise ValueError("Intervals must have lo <= hi")
+        intervals = intervals[np.argsort(intervals[:, 0])]
+        merged = []
+        for lo, hi in intervals:
+            if merged and lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        self.intervals = np.array(merged).reshape(-1, 2)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, fname, **kwargs):
+        """Read the intervals from the first two columns of a text file."""
+        return cls(np.loadtxt(fname, usecols=(0, 1), ndmin=2), **kwargs)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def _row_ranges(self, row):
+        lo, hi = self.intervals[:, 0], self.intervals[:, 1]
+        with np.errstate(invalid='ignore'):
+            increasing = np.isfinite(row).all() and np.all(np.diff(row) >= 0)
+        if increasing:
+            starts = np.searchsorted(row, lo, side='left')
+            stops = np.searchsorted(row, hi, side='left')
+            keep = stops > starts
+            return starts[keep], stops[keep]
+        with np.errstate(invalid='ignore'):
+            inside = np.zeros(row.shape, dtype=bool)
+            for low, high in self.intervals:
+                inside |= (row >= low) & (row < high)
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], inside, [0]])))
+        return edges[::2], edges[1::2]
+
+    def ranges(self, wl):
+        """
+        Pixel ranges of the intervals on a wavelength grid.
+
+        Parameters
+        ----------
+        wl : array_like
+            Wavelengths of shape (pixels,) or (orders, pixels).
+
+        Returns
+        -------
+        list of tuple
+            ``(starts, stops)`` arrays of every order.
+        """
+        wl = np.atleast_2d(np.asarray(wl, dtype=np.float64))
+        key = grid_fingerprint(wl)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        ranges = [self._row_ranges(row) for row in wl]
+        with self._lock:
+            self._cache[key] = ranges
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return ranges
+
+    def mask(self, wl):
+        """Boolean mask of the pixels of `wl` inside the intervals."""
+        wl = np.asarray(wl)
+        mask = np.zeros(np.atleast_2d(wl).shape, dtype=bool)
+        for row, (starts, stops) in zip(mask, self.ranges(wl)):
+            for start, stop in zip(starts, stops):
+                row[start:stop] = True
+        return mask.reshape(wl.shape)
+
+    def apply(self, data, wl, fill=np.nan):
+        """
+        Set the pixels inside the intervals to `fill`, in place.
+
+        Parameters
+        ----------
+        data : numpy.ndarray or list of numpy.ndarray
+            Arrays of the shape of `wl` (e.g. flux and variance).
+        wl : array_like
+            Wavelengths of shape (pixels,) or (orders, pixels).
+        fill : float, optional
+            Value of the masked pixels. Default is NaN.
+
+        Returns
+        -------
+        The arrays of `data`.
+        """
+        arrays = data if isinstance(data, (list, tuple)) else [data]
+        for order, (starts, stops) in enumerate(self.ranges(wl)):
+            for array in arrays:
+                row = np.atleast_2d(array)[order]
+                for start, stop in zip(starts, stops):
+                    row[start:stop] = fill
+        return data
+
+    def apply_datadict(self, datadict, fluxext, varext, wlext):
+        """
+        Mask the flux and variance of a datadict (as from
+        `extract_allexts`) on its own wavelengths, in place.
+        """
+        keys = list(datadict.keys())
+        for fext, vext, wext in zip(fluxext, varext, wlext):
+            flux = np.array(datadict[keys[fext]], dtype=np.float64)
+            var = np.array(datadict[keys[vext]], dtype=np.float64)
+            self.apply([flux, var], datadict[keys[wext]])
+            datadict[keys[fext]] = flux
+            datadict[keys[vext]] = var
+        return datadict
+
+
+def as_wavelength_mask(wl_mask):
+    """
+    `WavelengthMask` from a mask, an array of intervals or a text file of
+    intervals (see `WavelengthMask.from_file`). None is returned as is.
+    """
+    if wl_mask is None or isinstance(wl_mask, WavelengthMask):
+        return wl_mask
+    if isinstance(wl_mask, (str, Path)):
+        return WavelengthMask.from_file(wl_mask)
+    return WavelengthMask(wl_mask)
+
+# End
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+
+def write_spectrum(fname, shift=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    n_orders, n_pix = 3, 50
+    wl = np.linspace(5000, 5100, n_orders * n_pix).reshape(n_orders, n_pix)
+    wl = wl + shift
+    hdus = [fits.PrimaryHDU()]
+    for name in ['SCIFLUX', 'SKYFLUX', 'CALFLUX']:
+        hdus.append(fits.ImageHDU(rng.normal(100, 1, wl.shape), name=name))
+    for name in ['SCIVAR', 'SKYVAR', 'CALVAR']:
+        hdus.append(fits.ImageHDU(np.ones(wl.shape), name=name))
+    for name in ['SCIWAVE', 'SKYWAVE', 'CALWAVE']:
+        hdus.append(fits.ImageHDU(wl, name=name))
+    fits.HDUList(hdus).writeto(fname, overwrite=True)
+
+
+@pytest.fixture
+def make_spectrum():
+    """Writer of small three-fiber, three-order NEID-like spectra."""
+    return write_spectrum
@@ -0,0 +1,38 @@
+import numpy as np
+from astropy.io import fits
+from scipy import ndimage
+
+from ariastro.align import estimate_shifts
+from ariastro.handle_frame import combine_process
+
+
+def star_field(shape, rng, nstars=60):
+    yy, xx = np.indices(shape)
+    image = np.zeros(shape)
+    for y, x, flux in zip(rng.uniform(0, shape[0], nstars),
+                          rng.uniform(0, shape[1], nstars),
+                          rng.uniform(50, 500, nstars)):
+        image += flux * np.exp(-((yy - y)**2 + (xx - x)**2) / (2 * 1.8**2))
+    return image
+
+
+def test_estimate_and_apply_shifts(tmp_path):
+    rng = np.random.default_rng(12)
+    field = star_field((160, 144), rng)
+    offsets = [(0.0, 0.0), (3.4, -5.7), (-7.25, 2.5), (10.6, 8.1)]
+    files = []
+    for index, offset in enumerate(offsets):
+        frame = ndimage.shift(field, offset, order=3, mode='constant')
+        fname = tmp_path / "dither{}.fits".format(index)
+        fits.writeto(fname, frame + rng.normal(0, 0.05, field.shape))
+        files.append(fname)
+
+    shifts = estimate_shifts(files, factor=2, cutout=96, batch=3)
+    assert np.allclose(shifts, -np.array(offsets), atol=0.15)
+
+    combine_process(files, tmp_path / "aligned.fits", method='median',
+                    fluxext=[0], align=True, chunk_rows=32)
+    combined = fits.getdata(tmp_path / "aligned.fits")
+    inner = (slice(20, -20), slice(20, -20))
+    assert np.abs(combined[inner] - field[inner]).max() < 0.1 * field.max()
+    assert np.isnan(combined).sum() == 0
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.calibration import CalibrationLibrary
+
+
+def write_raw(fname, data, imagetyp, exptime, date='2025-03-01'):
+    header = fits.Header({'IMAGETYP': imagetyp, 'EXPTIME': exptime,
+                          'DATE-OBS': date + 'T01:00:00',
+                          'DETECTOR': 'CCD1'})
+    fits.HDUList([fits.PrimaryHDU(header=header),
+                  fits.ImageHDU(data),
+                  fits.ImageHDU(np.ones_like(data))]).writeto(fname)
+    return fname
+
+
+@pytest.mark.parametrize("memmap", [False, True])
+def test_build_and_apply_masters(tmp_path, memmap):
+    rng = np.random.default_rng(11)
+    shape = (40, 30)
+    bias, rate = 100.0, 2.0
+    flat = 1 + 0.1 * rng.uniform(-1, 1, size=shape)
+    raw = []
+    for index in range(3):
+        raw.append(write_raw(tmp_path / "bias{}.fits".format(index),
+                             np.full(shape, bias), 'BIAS', 0))
+        raw.append(write_raw(tmp_path / "dark{}.fits".format(index),
+                             np.full(shape, bias + rate * 10), 'DARK', 10))
+        raw.append(write_raw(tmp_path / "flat{}.fits".format(index),
+                             bias + rate * 5 + 500 * flat, 'FLAT', 5))
+    sky = rng.uniform(10, 20, size=shape)
+    science = write_raw(tmp_path / "sci.fits",
+                        bias + rate * 30 + sky * flat, 'OBJECT', 30,
+                        date='2025-03-02')
+
+    library = CalibrationLibrary(tmp_path / "calib", fluxext=[1],
+                                 varext=[2], block_rows=16)
+    masters = library.build(raw, method='median')
+    assert [path.name.split('_')[0] for path in masters] == \
+        ['bias', 'dark', 'flat']
+
+    # A new library instance finds the masters through the index.
+    library = CalibrationLibrary(tmp_path / "calib", fluxext=[1],
+                                 varext=[2], block_rows=16, memmap=memmap)
+    output, = library.calibrate([science], tmp_path / "out")
+    handles = [hdul for hdul, _ in library._masters.values()]
+    assert len(handles) == 3
+    if memmap:
+        assert all(not hdul._file.closed for hdul in handles)
+        # Rebuilding the bias closes the file of the memmapped one.
+        library.build([raw[0], raw[3]], method='median')
+        assert handles[0]._file.closed
+    else:
+        assert handles == [None] * 3
+    library.close()
+    assert library._masters == {}
+    assert not memmap or all(hdul._file.closed for hdul in handles)
+    with fits.open(output) as hdul:
+        expected = sky * np.median(flat)
+        assert np.allclose(hdul[1].data, expected)
+        assert np.all(hdul[2].data > 1 / np.median(flat) ** 2 / flat ** 2)
+        assert 'flat_2025-03-01' in str(hdul[1].header['HISTORY'])
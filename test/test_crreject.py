@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.crreject import StackCosmicRays
+from ariastro.crreject import grow_flags
+from ariastro.crreject import stack_outliers
+from ariastro.handle_frame import combine_process
+from ariastro.kernels import HAS_NUMBA
+
+
+def make_stack(nframes=6, shape=(40, 30), seed=11):
+    rng = np.random.default_rng(seed)
+    clean = rng.normal(100, 2, size=(nframes,) + shape)
+    data = clean.copy()
+    hits = [(0, 5, 7), (2, 19, 3), (2, 20, 3), (4, 31, 29), (5, 0, 0)]
+    for frame, row, col in hits:
+        data[frame, row, col] += 500
+    return clean, data, hits
+
+
+def test_stack_outliers_flags_hits():
+    clean, data, hits = make_stack()
+    flags = stack_outliers(data, threshold=5.0)
+    for hit in hits:
+        assert flags[hit]
+    assert flags.sum() == len(hits)
+    flags = stack_outliers(data, np.full(data.shape, 4.0), threshold=5.0)
+    assert flags.sum() == len(hits)
+
+
+def test_blocks_match_full_frames():
+    _, data, hits = make_stack()
+    full = StackCosmicRays(grow=2, keep_masks=True)
+    (_, _, out, _), = full(iter([(0, 40, list(data), None)]))
+    expected = grow_flags(stack_outliers(data), 2)
+    assert np.array_equal(full.frame_masks(), expected)
+    assert np.array_equal(np.isnan(out), expected)
+
+    # Hits on rows 19-20 grow across the block boundary at row 20.
+    blocked = StackCosmicRays(grow=2, keep_masks=True)
+    blocks = [(start, min(start + 10, 40),
+               list(data[:, start:start + 10]), None)
+              for start in range(0, 40, 10)]
+    out = [block for block in blocked(iter(blocks))]
+    assert [block[0] for block in out] == [0, 10, 20, 30]
+    assert np.array_equal(blocked.frame_masks(), expected)
+    assert np.array_equal(blocked.counts, expected.sum(axis=(1, 2)))
+
+
+def test_combine_process_crreject(tmp_path):
+    clean, data, hits = make_stack()
+    files = []
+    for index, frame in enumerate(data):
+        fname = tmp_path / "f{}.fits".format(index)
+        fits.writeto(fname, frame)
+        files.append(fname)
+    for chunk_rows in (None, 7):
+        opfilename = tmp_path / "comb.fits"
+        combine_process(files, opfilename, chunk_rows=chunk_rows,
+                        crreject=True, crmask_dir=tmp_path / "masks")
+        result = fits.getdata(opfilename)
+        assert np.abs(result - clean.mean(axis=0)).max() < 5
+        assert 'crreject' in str(fits.getheader(opfilename)['HISTORY'])
+        masks = np.array([fits.getdata(tmp_path / "masks" /
+                                       "f{}_crmask.fits".format(index),
+                                       'CRMASK')
+                          for index in range(len(files))])
+        assert masks.dtype == np.uint8
+        assert np.array_equal(masks.astype(bool),
+                              grow_flags(stack_outliers(data), 1))
+
+
+@pytest.mark.parametrize("backend", ['numpy', 'numba'])
+def test_combine_process_crreject_variance(tmp_path, backend):
+    if backend == 'numba' and not HAS_NUMBA:
+        pytest.skip("numba is not installed")
+    _, data, _ = make_stack()
+    files = []
+    for index, frame in enumerate(data):
+        fname = tmp_path / "f{}.fits".format(index)
+        fits.HDUList([fits.PrimaryHDU(frame),
+                      fits.ImageHDU(np.full_like(frame, 4.0))]).writeto(fname)
+        files.append(fname)
+    for chunk_rows in (None, 7):
+        opfilename = tmp_path / "comb.fits"
+        combine_process(files, opfilename, varext=[1], chunk_rows=chunk_rows,
+                        crreject=True, cr_grow=0, backend=backend)
+        with fits.open(opfilename) as hdul:
+            variance = hdul['VARIANCE'].data
+        # Five of the six samples survive at the pixel hit in frame 0.
+        assert variance[5, 7] == pytest.approx(4 / 5)
+        assert variance[10, 10] == pytest.approx(4 / 6)
+
+# End
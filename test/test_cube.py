@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.cube import FrameCube
+from ariastro.cube import build_cube
+from ariastro.handle_frame import combine_process
+
+
+def test_cube_combine_matches_files(tmp_path):
+    rng = np.random.default_rng(5)
+    files = []
+    for index in range(4):
+        fname = tmp_path / "frame{}.fits".format(index)
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(rng.normal(size=(30, 12))),
+                      fits.ImageHDU(rng.uniform(1, 2, size=(30, 12)))]
+                     ).writeto(fname)
+        files.append(fname)
+
+    cube = build_cube(files, tmp_path / "frames.stack", fluxext=[1],
+                      varext=[2], block_rows=7)
+    assert cube.data(1).shape == (30, 12, 4)
+    assert cube.data(1)[3, 4].flags['C_CONTIGUOUS']
+    assert cube.stale() == []
+
+    for method, subset, backend in (
+            ('median', None, 'numpy'), ('mean', ['frame3.fits', 1], 'numpy'),
+            ('biweight', None, 'numba'), ('weightedavg', [0, 2], 'numba'),
+            ('weightedavg', None, 'numpy')):
+        chosen = [files[i] for i in FrameCube(cube.cubedir).indices(subset)]
+        combine_process(chosen, tmp_path / "direct.fits", method=method,
+                        fluxext=[1], varext=[2])
+        combine_process([str(cube.cubedir)], tmp_path / "cube.fits",
+                        method=method, subset=subset, backend=backend)
+        with fits.open(tmp_path / "direct.fits") as direct, \
+                fits.open(tmp_path / "cube.fits") as fromcube:
+            assert np.allclose(direct[1].data, fromcube[1].data)
+            assert np.allclose(direct[2].data, fromcube[2].data)
+            assert direct[1].header['HISTORY'][-1] == \
+                fromcube[1].header['HISTORY'][-1]
+
+    for option in ({'diagnostics': True}, {'crreject': True},
+                   {'scale': 'median'}, {'align': True}):
+        with pytest.raises(ValueError, match=list(option)[0]):
+            combine_process([str(cube.cubedir)], tmp_path / "cube.fits",
+                            **option)
+
+# End
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.export import export_spectra
+from ariastro.export import read_spectra
+from ariastro.export import wavelength_slices
+from ariastro.utils import extract_allexts
+
+N_ORDERS, N_PIX = 4, 60
+
+
+def write_epoch(fname, index):
+    rng = np.random.default_rng(index)
+    wl = np.linspace(5000, 5240, N_ORDERS * N_PIX).reshape(N_ORDERS, N_PIX)
+    primary = fits.PrimaryHDU()
+    primary.header['OBJECT'] = 'HD 1'
+    primary.header['MJD-OBS'] = 60000.0 + index
+    primary.header['HISTORY'] = 'epoch {}'.format(index)
+    hdus = [primary]
+    for name in ['SCIFLUX', 'SKYFLUX', 'CALFLUX']:
+        hdus.append(fits.ImageHDU(rng.normal(100, 1, wl.shape), name=name))
+    for name in ['SCIVAR', 'SKYVAR', 'CALVAR']:
+        hdus.append(fits.ImageHDU(rng.uniform(1, 2, wl.shape), name=name))
+    for name in ['SCIWAVE', 'SKYWAVE', 'CALWAVE']:
+        hdus.append(fits.ImageHDU(wl + 0.01 * index, name=name))
+    fits.HDUList(hdus).writeto(fname)
+
+
+def export_epochs(tmp_path, fmt, nepochs=3):
+    names, stacked, headers = [], {}, []
+    for index in range(nepochs):
+        fname = tmp_path / "spec{}.fits".format(index)
+        write_epoch(fname, index)
+        datadict, headerdict = extract_allexts(fname)
+        for key, data in datadict.items():
+            stacked.setdefault(key, []).append(data)
+        headers.append(headerdict)
+        names.append(fname.name)
+    for key in list(stacked)[1:]:
+        stacked[key] = np.array(stacked[key])
+    suffix = '.h5' if fmt == 'hdf5' else '.zarr'
+    filename = tmp_path / ("epochs" + suffix)
+    export_spectra(stacked, headers, filename, epoch_names=names,
+                   chunk_epochs=2, chunk_pixels=16)
+    return filename, stacked
+
+
+@pytest.mark.parametrize("fmt", ['hdf5', 'zarr'])
+def test_export_round_trip(tmp_path, fmt):
+    filename, stacked = export_epochs(tmp_path, fmt)
+    for name in ['SCIFLUX', 'SKYVAR', 'CALWAVE']:
+        data = read_spectra(filename, name)
+        assert data.shape == (3, N_ORDERS, N_PIX)
+        assert np.array_equal(data, stacked[name])
+    if fmt == 'hdf5':
+        import h5py
+        with h5py.File(filename, 'r') as hfile:
+            assert hfile['SCIFLUX'].chunks == (2, 1, 16)
+            attrs = dict(hfile.attrs)
+            assert hfile['SCIFLUX'].attrs['EXTNAME'] == 'SCIFLUX'
+    else:
+        import zarr
+        root = zarr.open_group(str(filename), mode='r')
+        attrs = dict(root.attrs)
+        assert root['SCIFLUX'].attrs['EXTNAME'] == 'SCIFLUX'
+    assert attrs['NEPOCHS'] == 3
+    assert list(attrs['EPOCHS']) == ['spec0.fits', 'spec1.fits',
+                                     'spec2.fits']
+    assert list(attrs['WLEXT']) == ['SCIWAVE', 'SKYWAVE', 'CALWAVE']
+    assert list(attrs['EPOCH_MJD-OBS']) == [60000.0, 60001.0, 60002.0]
+    assert attrs['OBJECT'] == 'HD 1'
+    assert 'epoch 0' in attrs['HISTORY']
+
+
+@pytest.mark.parametrize("fmt", ['hdf5', 'zarr'])
+def test_read_spectra_slices(tmp_path, fmt):
+    filename, stacked = export_epochs(tmp_path, fmt)
+    flux = stacked['SCIFLUX']
+    assert np.array_equal(
+        read_spectra(filename, 'SCIFLUX', epochs=slice(1, 3)), flux[1:3])
+    assert np.array_equal(
+        read_spectra(filename, 'SCIFLUX', orders=2), flux[:, 2])
+    assert np.array_equal(
+        read_spectra(filename, 'SCIFLUX', pixels=slice(10, 37)),
+        flux[:, :, 10:37])
+    assert np.array_equal(
+        read_spectra(filename, 'SCIFLUX', epochs=0, orders=slice(1, 3),
+                     pixels=slice(5, 20)),
+        flux[0, 1:3, 5:20])
+
+
+@pytest.mark.parametrize("fmt", ['hdf5', 'zarr'])
+def test_wavelength_slices(tmp_path, fmt):
+    filename, stacked = export_epochs(tmp_path, fmt)
+    wl = fits.getdata(tmp_path / "spec0.fits", 'SCIWAVE')
+    wl_range = (wl[1, 50], wl[2, 20])
+    orders, pixels = wavelength_slices(filename, wl_range)
+    assert (orders, pixels) == (slice(1, 3), slice(0, N_PIX))
+    assert np.array_equal(
+        read_spectra(filename, 'SCIWAVE', orders=orders, pixels=pixels),
+        stacked['SCIWAVE'][:, 1:3])
+
+    wl_range = (wl[0, 10], wl[0, 30])
+    orders, pixels = wavelength_slices(filename, wl_range,
+                                       wlname='CALWAVE')
+    assert (orders, pixels) == (slice(0, 1), slice(10, 31))
+    section = read_spectra(filename, 'SCIWAVE', epochs=0, orders=orders,
+                           pixels=pixels)
+    assert np.array_equal(section, wl[0:1, 10:31])
+
+    with pytest.raises(ValueError):
+        wavelength_slices(filename, (4000, 4100))
+
+
+@pytest.mark.parametrize("fmt", ['hdf5', 'zarr'])
+def test_export_combined_spectrum(tmp_path, fmt):
+    fname = tmp_path / "spec.fits"
+    write_epoch(fname, 0)
+    datadict, headerdict = extract_allexts(fname)
+    filename = tmp_path / "combined.out"
+    export_spectra(datadict, headerdict, filename, fmt=fmt)
+    data = read_spectra(filename, 'SCIFLUX', fmt=fmt)
+    assert data.shape == (1, N_ORDERS, N_PIX)
+    assert np.array_equal(data[0], datadict['SCIFLUX'])
+
+
+def test_export_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        read_spectra(tmp_path / "spectra.txt", 'SCIFLUX')
@@ -0,0 +1,42 @@
+import numpy as np
+from astropy.io import fits
+
+from ariastro.frame import Frame
+from ariastro.frame import combine_frames
+
+
+def test_frame_chain(tmp_path):
+    rng = np.random.default_rng(5)
+    sci = rng.normal(100, 1, size=(30, 40))
+    bias = rng.normal(10, 1, size=sci.shape)
+    for name, data in (("sci.fits", sci), ("bias.fits", bias)):
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data),
+                      fits.ImageHDU(np.ones_like(data))]
+                     ).writeto(tmp_path / name)
+
+    bias_frame = Frame.read(tmp_path / "bias.fits", ext=1, varext=2)
+    frame = Frame.read(tmp_path / "sci.fits", ext=1, varext=2) \
+        .operate(bias_frame, '-').operate(2.0, '/') \
+        .checkpoint(tmp_path / "step.fits")
+    assert np.allclose(frame.data, (sci - bias) / 2)
+    assert np.allclose(frame.var, 0.5)
+    assert np.allclose(fits.getdata(tmp_path / "step.fits"), frame.data)
+
+    frame.mask = np.zeros(sci.shape, dtype=bool)
+    frame.mask[0, 0] = True
+    other = frame.copy().operate(1.0, '+')
+    other.mask = None
+    combined = combine_frames([frame, other])
+    assert np.isclose(combined.data[0, 0], other.data[0, 0])
+    assert np.allclose(combined.data[1:], frame.data[1:] + 0.5)
+    assert not combined.mask.any()
+
+    combined.write(tmp_path / "out.fits")
+    with fits.open(tmp_path / "out.fits") as hdul:
+        history = str(hdul[0].header['HISTORY'])
+        assert 'read sci.fits[1]' in history
+        assert '- read bias.fits[1]' in history
+        assert np.allclose(hdul['VARIANCE'].data, combined.var)
+        assert hdul['MASK'].data.sum() == 0
+
+# End
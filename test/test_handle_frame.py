@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.handle_frame import combine_process
+from ariastro.handle_frame import operate_batch
+from ariastro.handle_frame import operate_process
+
+
+def test_operate_batch(tmp_path):
+    rng = np.random.default_rng(6)
+    bias = rng.normal(10, 1, size=(20, 30))
+    fits.writeto(tmp_path / "bias.fits", bias)
+    frames = []
+    for index in range(5):
+        data = rng.normal(100, 1, size=bias.shape)
+        fits.writeto(tmp_path / "sci_{}.fits".format(index), data)
+        frames.append(data)
+    # A broken input does not stop the batch.
+    (tmp_path / "sci_9.fits").write_text("not a FITS file")
+
+    written, failed = operate_batch("sci_*.fits", str(tmp_path / "bias.fits"),
+                                    "{stem}_bsub.fits", operation='-',
+                                    path=tmp_path, outdir=tmp_path / "out",
+                                    workers=3)
+    assert list(failed) == [str(tmp_path / "sci_9.fits")]
+    assert len(written) == 5
+    for index, data in enumerate(frames):
+        with fits.open(tmp_path / "out" / "sci_{}_bsub.fits".format(index)) \
+                as hdul:
+            assert np.allclose(hdul[0].data, data - bias)
+            assert 'bias.fits' in str(hdul[0].header['HISTORY'])
+
+    written, failed = operate_batch(
+        [tmp_path / "sci_0.fits", tmp_path / "sci_1.fits"], 2.0,
+        "scaled_{index}.fits", operation='*', outdir=tmp_path)
+    assert not failed
+    assert np.allclose(fits.getdata(tmp_path / "scaled_1.fits"),
+                       frames[1] * 2)
+
+
+def test_operate_process_keeps_float32(tmp_path):
+    frame = np.full((6, 5), 4.0, dtype=np.float32)
+    for name in ("a.fits", "b.fits"):
+        fits.HDUList([fits.PrimaryHDU(frame),
+                      fits.ImageHDU(frame)]).writeto(tmp_path / name)
+    operate_process(str(tmp_path / "a.fits"), str(tmp_path / "b.fits"),
+                    tmp_path / "sum.fits", fluxext=[0], varext=[1])
+    with fits.open(tmp_path / "sum.fits") as hdul:
+        assert hdul[0].header['BITPIX'] == -32
+        assert hdul['VARIANCE'].header['BITPIX'] == -32
+        assert np.all(hdul[0].data == 8)
+
+
+def test_combine_process_diagnostics(tmp_path):
+    rng = np.random.default_rng(10)
+    files = []
+    for index in range(4):
+        data = rng.normal(100, 1, size=(12, 7))
+        data[index, :] = np.nan
+        fname = tmp_path / "f{}.fits".format(index)
+        fits.writeto(fname, data)
+        files.append(fname)
+    stack = np.array([fits.getdata(fname) for fname in files])
+    for chunk_rows, name in ((None, "full.fits"), (5, "blocks.fits")):
+        combine_process(files, tmp_path / name, chunk_rows=chunk_rows,
+                        diagnostics=True)
+        with fits.open(tmp_path / name) as hdul:
+            assert [hdu.name for hdu in hdul[1:]] == ['NCOMBINE', 'STDDEV',
+                                                      'REJFRAC']
+            ncombine = hdul['NCOMBINE'].data
+            assert ncombine.dtype == np.uint8
+            assert np.array_equal(ncombine,
+                                  np.isfinite(stack).sum(axis=0))
+            assert np.allclose(hdul['REJFRAC'].data, 1 - ncombine / 4)
+            assert np.allclose(hdul['STDDEV'].data,
+                               np.nanstd(stack, axis=0, ddof=1))
+            assert hdul['STDDEV'].header['FLUXEXT'] == 0
+
+
+@pytest.mark.parametrize("uncertainty", ['bootstrap', 'jackknife'])
+@pytest.mark.parametrize("chunk_rows", [None, 4])
+def test_combine_process_single_file_resampling(tmp_path, uncertainty,
+                                                chunk_rows):
+    data = np.arange(48.0).reshape(8, 6)
+    fits.writeto(tmp_path / "f0.fits", data)
+    combine_process([tmp_path / "f0.fits"], tmp_path / "o.fits",
+                    fluxext=[0], uncertainty=uncertainty,
+                    chunk_rows=chunk_rows)
+    with fits.open(tmp_path / "o.fits") as hdul:
+        assert np.array_equal(hdul[0].data, data)
+        assert np.isnan(hdul['VARIANCE'].data).all()
+        assert hdul['VARIANCE'].data.shape == data.shape
+        assert hdul['VARIANCE'].header['VARMODE'] == uncertainty
+
+# End
@@ -0,0 +1,90 @@
+
+import numpy as np
+import pytest
+
+from ariastro.indices import LINE_INDICES
+from ariastro.indices import band_weights
+from ariastro.indices import measure_indices
+
+
+def gaussian_line(wl, center, depth, sigma):
+    return 1 - depth * np.exp(-0.5 * ((wl - center) / sigma) ** 2)
+
+
+def make_datadict(nepochs, depths, seed=0):
+    rng = np.random.default_rng(seed)
+    # Overlapping orders around the H alpha and Na D bands.
+    starts = [5790.0, 5880.0, 6040.0, 6530.0, 6560.0]
+    wl = np.array([np.linspace(start, start + 70.0, 7000)
+                   for start in starts])
+    flux = np.ones((nepochs,) + wl.shape)
+    for epoch, depth in enumerate(depths):
+        for center in (6564.621, 5897.554, 5891.582):
+            flux[epoch] *= gaussian_line(wl, center, depth, 0.1)
+    var = np.full(flux.shape, 1e-6)
+    flux = flux + rng.normal(0, 1e-3, flux.shape)
+    keys = ['PRIMARY', 'SCIFLUX', 'SKYFLUX', 'CALFLUX', 'SCIVAR', 'SKYVAR',
+            'CALVAR', 'SCIWAVE', 'SKYWAVE', 'CALWAVE']
+    datadict = dict.fromkeys(keys, np.zeros(1))
+    datadict.update(SCIFLUX=flux, SCIVAR=var, SCIWAVE=np.broadcast_to(
+        wl, flux.shape))
+    return datadict, wl
+
+
+def test_band_weights_integrate_bands():
+    wl = np.array([np.linspace(3890, 3950, 601),
+                   np.linspace(3955, 4015, 601)])
+    bands = LINE_INDICES['CaHK']['line'] + LINE_INDICES['CaHK']['continuum']
+    index, weights = band_weights(wl, bands)
+    # K at 3934.8 is only in the first order, H at 3969.6 in the second.
+    assert np.all(index[0, weights[0] > 0] < 601)
+    assert np.all(index[1, weights[1] > 0] >= 601)
+    # The triangle of FWHM 1.09 has an area of 1.09, the rect its width.
+    assert np.isclose(weights[0].sum(), 1.09, rtol=1e-3)
+    assert np.isclose(weights[3].sum(), 20.0)
+    flat = wl.ravel()
+    inside = np.abs(flat[index[3][weights[3] > 0]] - 4002.131) <= 10.05
+    assert inside.all()
+
+
+def test_measure_indices_equivalent_widths():
+    depths = np.linspace(0.2, 0.6, 40)
+    datadict, wl = make_datadict(len(depths), depths)
+    table = measure_indices(datadict, lines=['Halpha', 'NaD'])
+    assert len(table) == len(depths)
+    # Equivalent width of a Gaussian line: depth * sigma * sqrt(2 pi),
+    # a 1.6 A band holds 99.99 % of it.
+    expected = depths * 0.1 * np.sqrt(2 * np.pi)
+    assert np.allclose(table['EW_Halpha_1'], expected, atol=3e-3)
+    assert np.all(table['EW_Halpha_1_ERR'] < 3e-3)
+    assert np.all(np.diff(table['Halpha']) < 0)
+    assert np.all(table['NaD_ERR'] > 0)
+
+    # Same result on per-epoch grids, as from process_data.
+    epochs = [{key: value[epoch] if value.ndim == 3 else value
+               for key, value in datadict.items()}
+              for epoch in range(3)]
+    per_epoch = measure_indices(epochs, lines=['Halpha'])
+    assert np.allclose(per_epoch['Halpha'], table['Halpha'][:3])
+
+    with pytest.raises(ValueError):
+        measure_indices(datadict, lines=['CaIRT'])
+
+
+def test_measure_indices_per_epoch_grids_with_nan():
+    datadict, wl = make_datadict(2, [0.5, 0.3])
+    # NaN at the order edges, as in NEID spectra.
+    datadict['SCIFLUX'][:, :, 0] = np.nan
+    # The second grid holds one pixel less in the bands: the bands of the
+    # first epoch are padded.
+    datadict['SCIWAVE'] = np.array([wl, wl + 0.007])
+    per_epoch = measure_indices(datadict, lines=['Halpha'])
+    for epoch in range(2):
+        alone = measure_indices(
+            {key: value[epoch:epoch + 1] if value.ndim == 3 else value
+             for key, value in datadict.items()}, lines=['Halpha'])
+        for name in ['Halpha', 'Halpha_ERR', 'EW_Halpha_1']:
+            assert np.isfinite(per_epoch[name][epoch])
+            assert np.isclose(per_epoch[name][epoch], alone[name][0])
+
+# End
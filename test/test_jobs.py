@@ -0,0 +1,78 @@
+import time
+import asyncio
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.logger import logger
+from ariastro.jobs import Job
+from ariastro.jobs import JobCancelled
+from ariastro.jobs import acombine_process
+from ariastro.jobs import check_cancelled
+from ariastro.jobs import run_job_async
+
+
+def chatty(name, steps):
+    for step in range(steps):
+        check_cancelled()
+        logger.info("{} step {}".format(name, step))
+        time.sleep(0.01)
+    return name
+
+
+def test_jobs_have_separate_logs():
+    async def main():
+        jobs = [Job("a"), Job("b")]
+        results = await asyncio.gather(
+            *[run_job_async(chatty, job.job_id, 5, job=job) for job in jobs])
+        return jobs, results
+
+    jobs, results = asyncio.run(main())
+    assert results == ["a", "b"]
+    for job in jobs:
+        messages = [record.getMessage() for record in job.records]
+        steps = [message for message in messages if 'step' in message]
+        assert len(steps) == 5
+        assert all(message.startswith(job.job_id) for message in steps)
+
+
+def test_job_cancellation(tmp_path):
+    job = Job()
+
+    async def main():
+        task = asyncio.ensure_future(run_job_async(chatty, "long", 1000,
+                                                   job=job))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert job.cancelled
+    assert 'cancelled' in job.records[-1].getMessage()
+    steps = [record for record in job.records
+             if 'step' in record.getMessage()]
+    assert 0 < len(steps) < 1000
+
+    with pytest.raises(JobCancelled):
+        from ariastro.jobs import run_job
+        job = Job()
+        job.cancel()
+        run_job(job, chatty, "never", 3)
+
+
+def test_acombine_process(tmp_path, capsys):
+    files = []
+    for index in range(3):
+        fname = tmp_path / "f{}.fits".format(index)
+        fits.writeto(fname, np.full((8, 8), float(index)))
+        files.append(fname)
+    opfilename = tmp_path / "comb.fits"
+    asyncio.run(acombine_process(files, opfilename, method='median',
+                                 chunk_rows=2))
+    assert np.allclose(fits.getdata(opfilename), 1.0)
+    # The library does not print.
+    assert capsys.readouterr().out == ''
+
+# End
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from ariastro import kernels
+from ariastro.operations import ari_operations
+from ariastro.operations import combine_data
+
+backends = ['numpy']
+if kernels.HAS_NUMBA:
+    backends.append('numba')
+
+
+@pytest.mark.parametrize("backend", backends)
+@pytest.mark.parametrize("method", ['mean', 'median', 'biweight',
+                                    'weightedavg'])
+def test_combine_stack_matches_reference(backend, method):
+    rng = np.random.default_rng(42)
+    dataarr = rng.normal(100.0, 5.0, size=(7, 12, 9))
+    var = rng.uniform(1.0, 4.0, size=dataarr.shape)
+
+    expected, expected_var = combine_data(dataarr, var, method=method)
+    comb, comb_var, count = kernels.combine_stack(dataarr, var,
+                                                  method=method,
+                                                  backend=backend)
+    assert np.allclose(comb, expected)
+    assert np.allclose(comb_var, expected_var)
+    assert np.all(count == 7)
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_combine_stack_skips_nans(backend):
+    dataarr = np.array([[1.0, np.nan], [3.0, 4.0], [5.0, np.nan]])
+    var = np.ones_like(dataarr)
+    comb, comb_var, count = kernels.combine_stack(dataarr, var,
+                                                  method='median',
+                                                  backend=backend)
+    assert np.allclose(comb, [3.0, 4.0])
+    assert np.allclose(comb_var, [1.0 / 3.0, 1.0])
+    assert np.array_equal(count, [3, 1])
+
+
+@pytest.mark.parametrize("backend", backends)
+@pytest.mark.parametrize("operation", ['+', '-', '*', '/'])
+def test_propagate_matches_reference(backend, operation):
+    rng = np.random.default_rng(1)
+    arr1 = rng.uniform(1.0, 2.0, size=(4, 5))
+    arr2 = rng.uniform(1.0, 2.0, size=(5,))
+    var1 = rng.uniform(0.1, 0.2, size=(4, 5))
+    var2 = rng.uniform(0.1, 0.2, size=(5,))
+
+    expected, expected_var = ari_operations(arr1, arr2, var1, var2,
+                                            operation=operation)
+    answer, var_tot = kernels.propagate(arr1, arr2, var1, var2,
+                                        operation=operation,
+                                        backend=backend)
+    assert np.allclose(answer, expected)
+    assert np.allclose(var_tot, expected_var)
+
+
+def test_resolve_backend_rejects_unknown():
+    with pytest.raises(ValueError):
+        kernels.resolve_backend('cuda')
+
+# End
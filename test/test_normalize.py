@@ -0,0 +1,66 @@
+import gzip
+import shutil
+
+import numpy as np
+from astropy.io import fits
+
+from ariastro.handle_frame import combine_process
+from ariastro.normalize import frame_normalization
+from ariastro.normalize import sample_pixels
+
+
+def test_sample_pixels(tmp_path):
+    rng = np.random.default_rng(7)
+    data = rng.normal(50, 2, size=(200, 100))
+    fits.writeto(tmp_path / "plain.fits", data)
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data, tile_shape=(10, 100))]
+                 ).writeto(tmp_path / "tiled.fits.fz")
+    with open(tmp_path / "plain.fits", 'rb') as src, \
+            gzip.open(tmp_path / "plain.fits.gz", 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+    for fname, ext in (("plain.fits", 0), ("tiled.fits.fz", 1),
+                       ("plain.fits.gz", 0)):
+        sample = sample_pixels(tmp_path / fname, ext, nsamples=2000)
+        assert 2000 <= sample.size < data.size
+        assert abs(np.median(sample) - 50) < 0.3
+
+
+def test_combine_with_scale_and_offset(tmp_path):
+    rng = np.random.default_rng(8)
+    sky = rng.normal(100, 1, size=(60, 80))
+    files = []
+    for index, (level, zero) in enumerate(((1.0, 0.0), (2.0, 0.0),
+                                           (0.5, 0.0))):
+        fname = tmp_path / "f{}.fits".format(index)
+        header = fits.Header({'EXPTIME': 10 * level})
+        fits.writeto(fname, sky * level + zero, header=header)
+        files.append(str(fname))
+
+    scales, offsets, errors = frame_normalization(files, scale='median',
+                                                  nsamples=1000)
+    assert np.allclose(scales, [1, 0.5, 2], rtol=1e-2)
+    assert errors[0, 0] == 0 and 0 < errors[1, 0] < 1e-2
+
+    for scale, chunk_rows in (('median', None), ('exptime', 16)):
+        opfilename = tmp_path / "comb_{}.fits".format(scale)
+        combine_process(files, opfilename, method='mean', scale=scale,
+                        chunk_rows=chunk_rows)
+        assert np.allclose(fits.getdata(opfilename), sky, rtol=1e-2)
+    history = [str(card) for card in fits.getheader(
+        tmp_path / "comb_median.fits")['HISTORY'] if 'scale' in str(card)]
+    assert len(history) == 3
+    assert history[1].startswith("scale f1.fits 0.5")
+    words = history[1].split()
+    assert words[3] == '+-' and 0 < float(words[4]) < 5e-3
+    assert words[5:] == ['offset', '0', '+-', '0']
+
+    # Offsets of frames with the same scale
+    fits.writeto(files[1], sky + 5, overwrite=True)
+    opfilename = tmp_path / "comb_offset.fits"
+    combine_process(files[:2], opfilename, method='mean', offset='median')
+    assert np.allclose(fits.getdata(opfilename), sky, atol=0.2)
+    assert 'offset' in str(fits.getheader(opfilename)['HISTORY'])
+
+# End
@@ -2,9 +2,13 @@ import numpy as np
 import pytest
 
 from ariastro.operations import ari_operations
+from ariastro.operations import ari_operations_out
 from ariastro.operations import combine_data
 from ariastro.operations import combine_data_full
+from ariastro.operations import combine_diagnostics
 from ariastro.operations import weighted_mean_and_variance
+from ariastro.uncertainty import resample_indices
+from ariastro.uncertainty import resampled_variance
 
 
 @pytest.mark.parametrize(
@@ -39,6 +43,57 @@ def test_add(arr1, arr2,
         assert var_result is None
 
 
+@pytest.mark.parametrize("operation", ['+', '-', '*', '/'])
+def test_ari_operations_out_matches(operation):
+    rng = np.random.default_rng(3)
+    arr1 = rng.uniform(1.0, 2.0, size=(30, 20))
+    arr2 = rng.uniform(1.0, 2.0, size=(20,))
+    var1 = rng.uniform(0.1, 0.2, size=(30, 20))
+    var2 = rng.uniform(0.1, 0.2, size=(20,))
+    expected, expected_var = ari_operations(arr1, arr2, var1, var2,
+                                            operation)
+
+    out = np.empty_like(arr1)
+    var_out = np.empty_like(arr1)
+    result, var_result = ari_operations_out(arr1, arr2, var1, var2,
+                                            operation, out=out,
+                                            var_out=var_out,
+                                            block_elements=100)
+    assert result is out and var_result is var_out
+    assert np.allclose(result, expected)
+    assert np.allclose(var_result, expected_var)
+
+    # In place, with an exact scalar operand
+    expected, expected_var = ari_operations(arr1, 4.0, var1, 0,
+                                            operation)
+    result, var_result = ari_operations_out(arr1, 4.0, var1, None,
+                                            operation, inplace=True)
+    assert result is arr1 and var_result is var1
+    assert np.allclose(arr1, expected)
+    assert np.allclose(var1, expected_var)
+
+
+def test_ari_operations_out_without_variance():
+    result, var_result = ari_operations_out(np.array([1.0, 2.0]), 2.0,
+                                            operation='*')
+    assert np.allclose(result, [2.0, 4.0])
+    assert var_result is None
+
+
+def test_ari_operations_out_dtype():
+    frame = np.ones((4, 3), dtype=np.float32)
+    for operation in '+-*/':
+        result, var_result = ari_operations_out(frame, frame, frame, frame,
+                                                operation)
+        assert result.dtype == var_result.dtype == np.float32
+        assert ari_operations_out(frame, 2.0, operation=operation)[0].dtype \
+            == np.float32
+    counts = np.ones((4, 3), dtype=np.int16)
+    assert ari_operations_out(counts, counts)[0].dtype == np.int16
+    assert ari_operations_out(counts, counts, operation='/')[0].dtype \
+        == np.float64
+
+
 @pytest.mark.parametrize(
     "dataarr, var, method, expected_data, expected_var",
     [
@@ -94,6 +149,22 @@ def test_combine_data_full_basic():
     # expected_var = np.array([0.01, 0.025])  # example propagated variance
 
 
+@pytest.mark.parametrize("backend", ['numpy', 'numba'])
+@pytest.mark.parametrize("method",
+                         ['mean', 'median', 'biweight', 'weightedavg'])
+def test_combine_data_pixel_major(method, backend):
+    rng = np.random.default_rng(8)
+    dataarr = rng.normal(size=(5, 6, 7))
+    var = rng.uniform(1, 2, size=dataarr.shape)
+    dataarr[2, 3, 4] = np.nan
+    expected = combine_data(dataarr, var, method=method, backend=backend)
+    result = combine_data(np.moveaxis(dataarr, 0, -1).copy(),
+                          np.moveaxis(var, 0, -1).copy(), method=method,
+                          backend=backend, axis=-1)
+    assert np.allclose(result[0], expected[0], equal_nan=True)
+    assert np.allclose(result[1], expected[1], equal_nan=True)
+
+
 def test_weighted_mean_and_variance():
     values = np.array([10.0, 20.0, 30.0])
     variances = np.array([1.0, 4.0, 9.0])
@@ -118,4 +189,58 @@ def test_weighted_mean_in_combine_data():
     assert np.allclose(mean, expected_mean, rtol=1e-6)
     assert np.allclose(var, expected_var, rtol=1e-6)
 
+
+def test_jackknife_variance_of_mean():
+    rng = np.random.default_rng(7)
+    stack = rng.normal(size=(9, 5, 6))
+    _, var = combine_data(stack, method='mean', uncertainty='jackknife')
+    assert np.allclose(var, np.var(stack, axis=0, ddof=1) / 9)
+
+
+@pytest.mark.parametrize("method", ['mean', 'median', 'biweight'])
+def test_bootstrap_variance_matches_loop(method):
+    rng = np.random.default_rng(8)
+    stack = rng.normal(size=(7, 4, 5))
+    stack[2, 1, 1] = np.nan
+    indices = resample_indices(7, 'bootstrap', nsamples=30, seed=1)
+    stats = [combine_data(stack[idx], method=method)[0] for idx in indices]
+    expected = np.var(stats, axis=0, ddof=1)
+    assert np.isfinite(expected[1, 1]) == (method != "biweight")
+
+    # A tiny chunk budget forces one pixel per chunk.
+    var = resampled_variance(stack, method=method, nsamples=30, seed=1,
+                             chunk_bytes=8)
+    assert np.allclose(var, expected, equal_nan=True)
+    _, var = combine_data(stack, method=method, uncertainty='bootstrap',
+                          nsamples=30, seed=1)
+    assert np.allclose(var, expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("backend", ['numpy', 'numba'])
+def test_combine_data_diagnostics(backend):
+    rng = np.random.default_rng(9)
+    stack = rng.normal(size=(6, 4, 5))
+    var = np.ones_like(stack)
+    stack[0, 0, 0] = np.nan
+    var[1, 0, 0] = np.inf
+    stack[:5, 3, 4] = np.nan
+    comb, comb_var, diag = combine_data(stack, var, backend=backend,
+                                        diagnostics=True)
+    expected, expected_var = combine_data(stack, var, backend=backend)
+    assert np.allclose(comb, expected, equal_nan=True)
+    assert np.allclose(comb_var, expected_var, equal_nan=True)
+
+    assert diag['NCOMBINE'].dtype == np.uint8
+    assert diag['NCOMBINE'][0, 0] == 4
+    assert diag['NCOMBINE'][3, 4] == 1
+    assert diag['NCOMBINE'][2, 2] == 6
+    assert np.isclose(diag['REJFRAC'][0, 0], 2 / 6)
+    assert np.isnan(diag['STDDEV'][3, 4])
+    assert np.allclose(diag['STDDEV'][1:3],
+                       np.std(stack[:, 1:3], axis=0, ddof=1))
+    assert np.isclose(diag['STDDEV'][0, 0],
+                      np.std(stack[2:, 0, 0], ddof=1))
+    assert combine_diagnostics(np.zeros((300, 2)))['NCOMBINE'].dtype \
+        == np.uint16
+
 # End
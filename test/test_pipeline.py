@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.pipeline import Pipeline
+from ariastro.pipeline import Step
+
+CONFIG = """
+workers = 2
+
+[steps.combine]
+run = "combine"
+inputs = ["*_sub.fits"]
+output = "combined.fits"
+method = "mean"
+
+[steps.sub_a]
+run = "operation"
+inputs = ["a.fits", "bias.fits"]
+output = "a_sub.fits"
+operation = "-"
+
+[steps.sub_b]
+run = "operation"
+inputs = ["b.fits", {scale}]
+output = "b_sub.fits"
+operation = "-"
+"""
+
+
+def test_pipeline_runs_and_skips(tmp_path):
+    fits.writeto(tmp_path / "a.fits", np.full((4, 5), 12.0))
+    fits.writeto(tmp_path / "b.fits", np.full((4, 5), 8.0))
+    fits.writeto(tmp_path / "bias.fits", np.full((4, 5), 2.0))
+    config = tmp_path / "pipeline.toml"
+    config.write_text(CONFIG.format(scale=2.0))
+
+    pipeline = Pipeline.from_file(config)
+    assert pipeline.dependencies['combine'] == {'sub_a', 'sub_b'}
+    assert pipeline.order() == ['sub_a', 'sub_b', 'combine']
+    assert pipeline.run() == {'sub_a': 'ran', 'sub_b': 'ran',
+                              'combine': 'ran'}
+    assert np.allclose(fits.getdata(tmp_path / "combined.fits"), 8.0)
+
+    status = Pipeline.from_file(config).run()
+    assert set(status.values()) == {'skipped'}
+
+    # A changed parameter reruns the step and everything downstream.
+    config.write_text(CONFIG.format(scale=4.0))
+    status = Pipeline.from_file(config).run()
+    assert status == {'sub_a': 'skipped', 'sub_b': 'ran', 'combine': 'ran'}
+    assert np.allclose(fits.getdata(tmp_path / "combined.fits"), 7.0)
+
+
+def test_pipeline_failure_and_cycle(tmp_path):
+    fits.writeto(tmp_path / "a.fits", np.ones((3, 3)))
+    steps = [Step('bad', 'operation', ['missing.fits', 1.0], 'x.fits',
+                  directory=tmp_path),
+             Step('after', 'operation', ['x.fits', 1.0], 'y.fits',
+                  directory=tmp_path),
+             Step('good', 'operation', ['a.fits', 1.0], 'z.fits',
+                  {'operation': '*'}, directory=tmp_path)]
+    status = Pipeline(steps, state_file=tmp_path / "state.json").run()
+    assert status == {'bad': 'failed', 'after': 'blocked', 'good': 'ran'}
+
+    with pytest.raises(ValueError):
+        Pipeline([Step('p', 'combine', ['q.fits'], 'p.fits'),
+                  Step('q', 'combine', ['p.fits'], 'q.fits')])
+
+# End
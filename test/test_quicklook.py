@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.handle_frame import combine_process
+from ariastro.handle_frame import operate_process
+from ariastro.quicklook import decimate
+from ariastro.quicklook import quicklook_process
+from ariastro.quicklook import quicklook_spectra
+
+
+def write_frames(directory, nframes=3, shape=(12, 10)):
+    frames = []
+    for index in range(nframes):
+        data = np.arange(np.prod(shape), dtype=float).reshape(shape) + index
+        fits.writeto(directory / "f{}.fits".format(index), data)
+        frames.append(data)
+    return np.array(frames)
+
+
+def test_combine_process_resolves_pattern_first(tmp_path):
+    frames = write_frames(tmp_path)
+    # As a pattern, and as a quoted pattern in a list (command line).
+    for files in ("f*.fits", ["f*.fits"]):
+        combine_process(files, tmp_path / "ql.fits", path=tmp_path,
+                        fluxext=[0], quicklook=2)
+        assert np.allclose(fits.getdata(tmp_path / "ql.fits"),
+                           frames.mean(axis=0)[::2, ::2])
+        combine_process(files, tmp_path / "full.fits", path=tmp_path,
+                        fluxext=[0])
+        assert np.allclose(fits.getdata(tmp_path / "full.fits"),
+                           frames.mean(axis=0))
+
+
+def assert_flagged(hdul, factor, mode):
+    for hdu in hdul:
+        assert hdu.header['QUICKLK'] is True
+        assert hdu.header['QLFACTOR'] == factor
+        assert hdu.header['QLMODE'] == mode
+
+
+def test_decimate():
+    data = np.arange(7 * 9, dtype=float).reshape(7, 9)
+    assert np.array_equal(decimate(data, 3), data[::3, ::3])
+    binned = decimate(data, 3, mode='bin')
+    assert binned.shape == (2, 3)
+    assert binned[1, 2] == data[3:6, 6:9].mean()
+    with pytest.raises(ValueError):
+        decimate(data, 3, mode='nearest')
+
+
+@pytest.mark.parametrize("mode", ['stride', 'bin'])
+def test_quicklook_process(tmp_path, mode):
+    rng = np.random.default_rng(13)
+    files, frames, variances = [], [], []
+    for index in range(3):
+        data = rng.normal(100, 1, size=(12, 10))
+        var = rng.uniform(1, 2, size=data.shape)
+        fname = tmp_path / "f{}.fits".format(index)
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data),
+                      fits.ImageHDU(var)]).writeto(fname)
+        files.append(fname)
+        frames.append(decimate(data, 2, mode))
+        scale = 4 if mode == 'bin' else 1
+        variances.append(decimate(var, 2, mode) / scale)
+    quicklook_process(files, tmp_path / "ql.fits", factor=2, mode=mode,
+                      fluxext=[1], varext=[2])
+    with fits.open(tmp_path / "ql.fits") as hdul:
+        assert [hdu.name for hdu in hdul] == ['PRIMARY', 'FLUX', 'VARIANCE']
+        assert np.allclose(hdul['FLUX'].data, np.mean(frames, axis=0))
+        assert np.allclose(hdul['VARIANCE'].data,
+                           np.sum(variances, axis=0) / 9)
+        assert_flagged(hdul, 2, mode)
+
+
+@pytest.mark.parametrize("mode", ['stride', 'bin'])
+def test_operate_process_quicklook(tmp_path, mode):
+    rng = np.random.default_rng(17)
+    files, frames, variances = [], [], []
+    for index in range(2):
+        data = rng.normal(100, 1, size=(12, 10))
+        var = rng.uniform(1, 2, size=data.shape)
+        fname = tmp_path / "f{}.fits".format(index)
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data),
+                      fits.ImageHDU(var)]).writeto(fname)
+        files.append(str(fname))
+        frames.append(decimate(data, 2, mode))
+        scale = 4 if mode == 'bin' else 1
+        variances.append(decimate(var, 2, mode) / scale)
+    output = tmp_path / "ql.fits"
+    operate_process(files[0], files[1], output, operation='-',
+                    fluxext=[1], varext=[2], quicklook=2,
+                    quicklook_mode=mode)
+    with fits.open(output) as hdul:
+        assert [hdu.name for hdu in hdul] == ['PRIMARY', 'FLUX', 'VARIANCE']
+        assert np.allclose(hdul['FLUX'].data, frames[0] - frames[1])
+        assert np.allclose(hdul['VARIANCE'].data, variances[0] + variances[1])
+        assert 'f0.fits - f1.fits' in str(hdul['FLUX'].header['HISTORY'])
+        assert_flagged(hdul, 2, mode)
+
+    operate_process(files[0], 2.0, output, operation='*', fluxext=[1],
+                    quicklook=2, quicklook_mode=mode)
+    with fits.open(output) as hdul:
+        assert np.allclose(hdul['FLUX'].data, frames[0] * 2.0)
+        assert_flagged(hdul, 2, mode)
+
+
+def write_neid_like(fname, seed):
+    rng = np.random.default_rng(seed)
+    shape = (8, 40)
+    wl = np.linspace(5000, 5100, shape[0] * shape[1]).reshape(shape)
+    blaze = np.linspace(0.5, 1.0, shape[1]) * np.ones(shape)
+    hdus = [fits.PrimaryHDU()]
+    for ext in range(1, 18):
+        if ext <= 3:
+            data = rng.normal(100, 1, shape) * blaze
+        elif ext <= 6:
+            data = np.ones(shape)
+        elif ext <= 9:
+            data = wl
+        elif ext >= 15:
+            data = blaze
+        else:
+            data = np.zeros(shape)
+        hdus.append(fits.ImageHDU(data))
+    fits.HDUList(hdus).writeto(fname)
+    return wl, blaze
+
+
+def test_quicklook_spectra(tmp_path):
+    files = []
+    for index in range(3):
+        fname = tmp_path / "s{}.fits".format(index)
+        wl, blaze = write_neid_like(fname, index)
+        files.append(fname)
+    fluxes = np.array([fits.getdata(fname, 1) for fname in files])
+    quicklook_spectra(files, tmp_path / "ql.fits", instrumentname='NEID',
+                      order_step=2, pixel_step=4)
+    sub = (slice(None, None, 2), slice(None, None, 4))
+    with fits.open(tmp_path / "ql.fits") as hdul:
+        assert len(hdul) == 10
+        assert np.allclose(hdul[1].data,
+                           (fluxes / blaze).mean(axis=0)[sub])
+        assert np.allclose(hdul[4].data, (1 / blaze ** 2)[sub] / 3)
+        assert np.allclose(hdul[7].data, wl[sub])
+        assert_flagged(hdul, 2, 'stride')
+        assert all(hdu.header['QLPIXSTP'] == 4 for hdu in hdul)
+
+# End
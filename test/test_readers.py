@@ -0,0 +1,147 @@
+import gzip
+import shutil
+
+import numpy as np
+from astropy.io import fits
+
+from ariastro.align import iter_shifted_blocks
+from ariastro.handle_frame import combine_process
+from ariastro.readers import GzipRowReader
+from ariastro.readers import HandlePool
+from ariastro.readers import handle_pool
+from ariastro.readers import is_compressed
+from ariastro.readers import iter_row_blocks
+from ariastro.readers import read_image
+
+
+def write_frames(tmp_path, data, var):
+    plain = tmp_path / "plain.fits"
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data),
+                  fits.ImageHDU(var)]).writeto(plain)
+
+    tiled = tmp_path / "tiled.fits.fz"
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data + 1, compression_type='GZIP_1',
+                                    tile_shape=(8, data.shape[1])),
+                  fits.CompImageHDU(var, compression_type='GZIP_1',
+                                    tile_shape=(8, data.shape[1]))]
+                 ).writeto(tiled)
+
+    gzipped = tmp_path / "plain.fits.gz"
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data + 2),
+                  fits.ImageHDU(var)]).writeto(tmp_path / "tmp.fits")
+    with open(tmp_path / "tmp.fits", 'rb') as src, \
+            gzip.open(gzipped, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return [plain, tiled, gzipped]
+
+
+def test_readers_match_astropy(tmp_path):
+    rng = np.random.default_rng(3)
+    data = rng.normal(size=(50, 20))
+    files = write_frames(tmp_path, data, np.ones_like(data))
+    assert [is_compressed(fname) for fname in files] == [False, True, True]
+    for index, fname in enumerate(files):
+        # Tile compression quantizes floats: compare with astropy.
+        expected = fits.getdata(fname, ext=1)
+        blocks = list(iter_row_blocks(fname, ext=1, block_rows=12))
+        assert blocks[0][:2] == (0, 8 if index == 1 else 12)
+        assert np.array_equal(np.concatenate([b[2] for b in blocks]),
+                              expected)
+        assert np.array_equal(read_image(fname, ext=1, workers=3),
+                              expected)
+
+
+def test_combine_process_blocked(tmp_path):
+    rng = np.random.default_rng(4)
+    data = rng.normal(size=(50, 20))
+    var = rng.uniform(1, 2, size=data.shape)
+    files = write_frames(tmp_path, data, var)
+    opfilename = tmp_path / "combined.fits"
+    combine_process(files, opfilename, method='median',
+                    fluxext=[1], varext=[2])
+    stack = [fits.getdata(fname, ext=1) for fname in files]
+    var_stack = [fits.getdata(fname, ext=2) for fname in files]
+    with fits.open(opfilename) as hdul:
+        assert np.allclose(hdul[1].data, np.median(stack, axis=0))
+        assert np.allclose(hdul[2].data, np.sum(var_stack, axis=0) / 9)
+        assert 'tiled.fits.fz' in str(hdul[1].header['HISTORY'])
+
+
+def test_handle_pool_is_bounded(tmp_path):
+    pool = HandlePool(maxsize=2)
+    files = []
+    for index in range(5):
+        fname = tmp_path / "f{}.fits".format(index)
+        fits.writeto(fname, np.full((4, 4), index, dtype=float))
+        files.append(fname)
+
+    with pool.open(files[0]) as first:
+        for fname in files[1:]:
+            with pool.open(fname) as hdul:
+                assert hdul[0].data[0, 0] == int(fname.stem[1:])
+        # The borrowed file is kept open beyond the limit.
+        assert first[0].data[0, 0] == 0
+        assert len(pool) == 2
+    assert len(pool) == 2
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_gzip_row_reader_streams_forward(tmp_path, monkeypatch):
+    rng = np.random.default_rng(6)
+    data = rng.normal(size=(50, 20))
+    plain, _, gzipped = write_frames(tmp_path, data, np.ones_like(data))
+    expected = data + 2
+    rewinds = []
+    rewind = GzipRowReader._rewind
+    monkeypatch.setattr(GzipRowReader, '_rewind',
+                        lambda self: rewinds.append(1) or rewind(self))
+    with GzipRowReader(gzipped, 1) as rows:
+        # Overlapping, increasing windows, as iter_shifted_blocks reads.
+        for start, stop in [(0, 14), (10, 26), (24, 30), (35, 60)]:
+            assert np.array_equal(rows.read(start, stop),
+                                  expected[start:stop])
+        assert len(rewinds) == 1
+        assert np.array_equal(rows.read(5, 9), expected[5:9])
+        assert len(rewinds) == 2
+
+    shift = (2.3, -1.6)
+    for (_, _, gz_block), (_, _, block) in zip(
+            iter_shifted_blocks(gzipped, 1, shift, block_rows=8),
+            iter_shifted_blocks(plain, 1, shift, block_rows=8)):
+        assert np.allclose(gz_block, block + 2, equal_nan=True)
+    assert len(rewinds) == 3
+
+
+def test_handle_pool_closes_stale_and_run_handles(tmp_path):
+    pool = HandlePool(maxsize=4)
+    fname = tmp_path / "f.fits"
+    fits.writeto(fname, np.zeros((4, 4)))
+    with pool.open(fname) as hdul:
+        assert hdul[0].data[0, 0] == 0
+    fits.writeto(fname, np.ones((6, 4)), overwrite=True)
+    with pool.open(fname) as hdul:
+        assert hdul[0].data[0, 0] == 1
+        # The handle of the replaced file is closed at once.
+        assert len(pool) == 1
+
+    other = tmp_path / "g.fits"
+    fits.writeto(other, np.ones((2, 2)))
+    with pool.open(fname):
+        with pool.scope():
+            with pool.open(other):
+                pass
+            assert len(pool) == 2
+        # Only the file opened inside the scope is closed.
+        assert len(pool) == 1
+
+    rng = np.random.default_rng(7)
+    data = rng.normal(size=(50, 20))
+    files = write_frames(tmp_path, data, np.ones_like(data))
+    handle_pool.close()
+    combine_process(files, tmp_path / "combined.fits", fluxext=[1],
+                    varext=[2])
+    assert len(handle_pool) == 0
+
+# End
@@ -0,0 +1,157 @@
+import os
+import json
+
+import numpy as np
+from astropy.io import fits
+
+from ariastro.service import ReferenceCache
+from ariastro.service import WatchService
+
+
+def write_frame(fname, data, var=None):
+    hdus = [fits.PrimaryHDU(), fits.ImageHDU(data)]
+    if var is not None:
+        hdus.append(fits.ImageHDU(var))
+    fits.HDUList(hdus).writeto(fname, overwrite=True)
+
+
+def make_service(tmp_path, **kwargs):
+    watchdir = tmp_path / "watch"
+    watchdir.mkdir(exist_ok=True)
+    kwargs.setdefault('fluxext', [1])
+    kwargs.setdefault('workers', 2)
+    return WatchService(watchdir, outdir=tmp_path / "products",
+                        poll_interval=0, **kwargs)
+
+
+def read_status(service):
+    with open(service.status_file) as fobj:
+        return json.load(fobj)
+
+
+def test_product_name(tmp_path):
+    service = make_service(tmp_path)
+    names = [service.product_name(name).name
+             for name in ["obs.001.fits", "obs.002.fits", "obs.fits.fz"]]
+    service.stop()
+    assert names == ["obs.001_proc.fits", "obs.002_proc.fits",
+                     "obs_proc.fits"]
+
+
+def test_scan_waits_for_settled_files(tmp_path):
+    service = make_service(tmp_path)
+    fname = service.watchdir / "a.fits"
+    write_frame(fname, np.ones((6, 5)))
+    assert service.scan() == []
+    assert service.status()['waiting_to_settle'] == 1
+    # Still being written: the signature changed since the last scan.
+    write_frame(fname, np.ones((80, 50)))
+    assert service.scan() == []
+    assert service.scan() == [fname]
+    assert service.scan() == []
+    service.stop()
+    with fits.open(service.product_name(fname)) as hdul:
+        assert hdul['FLUX'].data.shape == (80, 50)
+    assert service.stats['processed'] == 1
+
+
+def test_up_to_date_products_are_skipped(tmp_path):
+    service = make_service(tmp_path)
+    fname = service.watchdir / "a.fits"
+    write_frame(fname, np.ones((6, 5)))
+    product = service.product_name(fname)
+    write_frame(product, np.zeros((6, 5)))
+    stat = fname.stat()
+    os.utime(product, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    service.run(max_scans=3)
+    service.stop()
+    assert service.stats['processed'] == 0
+    assert np.all(fits.getdata(product) == 0)
+
+
+def test_operation_with_reference(tmp_path):
+    rng = np.random.default_rng(3)
+    reference = tmp_path / "bias.fits"
+    bias = rng.normal(10, 1, (6, 5))
+    bias_var = np.full((6, 5), 0.5)
+    write_frame(reference, bias, bias_var)
+    service = make_service(tmp_path, operation='-', operand=str(reference),
+                           varext=[2])
+    data = rng.normal(100, 1, (6, 5))
+    write_frame(service.watchdir / "a.fits", data, np.ones((6, 5)))
+    service.run(max_scans=2)
+    service.stop()
+    with fits.open(service.product_name("a.fits")) as hdul:
+        assert np.allclose(hdul['FLUX'].data, data - bias)
+        assert np.allclose(hdul['VARIANCE'].data, 1.5)
+        assert 'bias.fits' in str(hdul['FLUX'].header['HISTORY'])
+
+
+def test_operation_with_constant_and_cosmic_rays(tmp_path):
+    rng = np.random.default_rng(5)
+    data = rng.normal(1000, 10, (64, 64))
+    data[20, 30] = 60000
+    service = make_service(tmp_path, operation='*', operand=2.0,
+                           cosmic=True)
+    write_frame(service.watchdir / "a.fits", data)
+    service.run(max_scans=2)
+    service.stop()
+    with fits.open(service.product_name("a.fits")) as hdul:
+        result = hdul['FLUX'].data
+        assert "Cosmic Rays" in str(hdul['FLUX'].header['HISTORY'])
+    assert result[20, 30] < 4000
+    unchanged = np.ones(data.shape, dtype=bool)
+    unchanged[18:23, 28:33] = False
+    assert np.allclose(result[unchanged], 2 * data[unchanged])
+
+
+def test_combine_every(tmp_path):
+    # One worker: the frames are combined in their arrival order.
+    service = make_service(tmp_path, combine='mean', combine_every=2,
+                           workers=1)
+    for index in range(5):
+        write_frame(service.watchdir / "f{}.fits".format(index),
+                    np.full((4, 3), float(index)))
+    service.run(max_scans=2)
+    service.stop()
+    combined = sorted(service.outdir.glob("combined_*.fits"))
+    assert [path.name for path in combined] == [
+        "combined_0001.fits", "combined_0002.fits", "combined_0003.fits"]
+    # The last frame is left over and combined by stop().
+    means = [np.mean(fits.getdata(path, 1)) for path in combined]
+    assert np.allclose(means, [0.5, 2.5, 4.0])
+    assert "['f4.fits']" in str(fits.getheader(combined[-1], 1)['HISTORY'])
+    assert service.stats['combined'] == 3
+    assert read_status(service)['pending_combine'] == 0
+
+
+def test_status_and_failures(tmp_path):
+    service = make_service(tmp_path)
+    write_frame(service.watchdir / "good.fits", np.ones((4, 3)))
+    (service.watchdir / "bad.fits").write_bytes(b"not a fits file")
+    service.run(max_scans=2)
+    service.stop()
+    status = read_status(service)
+    assert status['processed'] == 1
+    assert status['failed'] == 1
+    assert status['combined'] == 0
+    assert status['queue_depth'] == 0
+    assert status['waiting_to_settle'] == 0
+    assert status['throughput_per_min'] == 1
+    assert status['mean_latency'] >= 0
+    assert not service.product_name("bad.fits").exists()
+
+
+def test_reference_cache_reloads_modified_files(tmp_path):
+    fname = tmp_path / "ref.fits"
+    write_frame(fname, np.ones((3, 3)))
+    cache = ReferenceCache([1])
+    first = cache.get(fname)
+    assert cache.get(fname)[0][0] is first[0][0]
+    write_frame(fname, np.full((3, 3), 2.0))
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    datas, variances = cache.get(fname)
+    assert variances is None
+    assert np.all(datas[0] == 2)
+    assert not datas[0].flags.writeable
@@ -0,0 +1,140 @@
+import json
+
+import numpy as np
+from astropy.io import fits
+
+from ariastro.spectral_utils import combine_spectra
+from ariastro.spectral_utils import interpolation_spectra
+from ariastro.spectral_utils import resample_epoch
+from ariastro.spectral_utils import spectral_section
+
+
+def test_resample_epoch_matches_interpolation_spectra(
+        tmp_path, make_spectrum):
+    from ariastro.utils import extract_allexts
+    files = []
+    for index in range(3):
+        fname = tmp_path / "spec{}.fits".format(index)
+        make_spectrum(fname, shift=0.01 * index, seed=index)
+        files.append(fname)
+    stacked = {}
+    epochs = []
+    for fname in files:
+        datadict, _ = extract_allexts(fname)
+        epochs.append(datadict)
+        for key, data in datadict.items():
+            stacked.setdefault(key, []).append(np.array(data))
+    ref = interpolation_spectra(stacked, (1, 2, 3), (7, 8, 9), (4, 5, 6))
+
+    keys = list(epochs[0].keys())
+    ref_wl = [np.array(epochs[0][keys[wext]]) for wext in (7, 8, 9)]
+    for epoin, datadict in enumerate(epochs):
+        resampled = resample_epoch(datadict, ref_wl,
+                                   (1, 2, 3), (7, 8, 9), (4, 5, 6))
+        assert np.allclose(resampled['SCIFLUX'], ref['SCIFLUX'][epoin])
+        assert np.allclose(resampled['SCIWAVE'], ref['SCIWAVE'][epoin])
+
+
+def test_combine_spectra_checkpoint_resume(tmp_path, monkeypatch,
+                                           make_spectrum):
+    files = []
+    for index in range(3):
+        fname = tmp_path / "spec{}.fits".format(index)
+        make_spectrum(fname, seed=index)
+        files.append(fname)
+    bad = tmp_path / "corrupt.fits"
+    bad.write_bytes(b"not a fits file")
+    scratch = tmp_path / "scratch"
+
+    combine_spectra(files + [bad], directory=str(tmp_path),
+                    opfilename="first.fits",
+                    checkpoint_dir=scratch, keep_checkpoint=True)
+    rundir, = scratch.iterdir()
+    assert len(list(rundir.glob("*.fits.npz"))) == 3
+    assert (rundir / "reference.npz").exists()
+    # The manifest holds the identities of the files, not their headers.
+    entries = [json.loads(line) for line in
+               (rundir / "manifest.jsonl").read_text().splitlines()]
+    assert [entry.get('event') for entry in entries] == \
+        [None, 'saved', 'saved', 'saved', 'quarantined']
+    assert set(entries[1]['record']) == {'path', 'size', 'mtime_ns',
+                                         'arrays'}
+
+    # On resume the saved epochs are used, no file is read again.
+    def fail(fname):
+        raise AssertionError("{} was read again".format(fname))
+    monkeypatch.setattr("ariastro.spectral_utils.extract_allexts", fail)
+    combine_spectra(files + [bad], directory=str(tmp_path),
+                    opfilename="second.fits",
+                    checkpoint_dir=scratch)
+    first = fits.getdata(tmp_path / "first.fits", ext=1)
+    second = fits.getdata(tmp_path / "second.fits", ext=1)
+    assert np.allclose(first, second)
+    assert not rundir.exists()
+
+
+def test_combine_spectra_checkpoint_keeps_reference(tmp_path,
+                                                    make_spectrum):
+    files = []
+    for index in range(3):
+        fname = tmp_path / "spec{}.fits".format(index)
+        make_spectrum(fname, shift=0.01 * index, seed=index)
+        files.append(fname)
+    scratch = tmp_path / "scratch"
+    combine_spectra(files, directory=str(tmp_path), opfilename="first.fits",
+                    checkpoint_dir=scratch, keep_checkpoint=True)
+    ref_wl = fits.getdata(tmp_path / "first.fits", 'SCIWAVE')
+
+    # The reference file changes: it is processed again, but onto the
+    # saved grid of the other epochs.
+    make_spectrum(files[0], shift=0.005, seed=0)
+    combine_spectra(files, directory=str(tmp_path), opfilename="second.fits",
+                    checkpoint_dir=scratch)
+    assert np.array_equal(fits.getdata(tmp_path / "second.fits", 'SCIWAVE'),
+                          ref_wl)
+
+
+def test_combine_spectra_wavelength_section(tmp_path, make_spectrum):
+    files = []
+    for index in range(3):
+        fname = tmp_path / "spec{}.fits".format(index)
+        make_spectrum(fname, seed=index)
+        files.append(fname)
+    wl = fits.getdata(files[0], ext=7)
+    assert spectral_section([wl]) is None
+    assert spectral_section([wl], orders=(2, 1)) == (slice(1, 3),
+                                                     slice(0, 50))
+    rows, pixels = spectral_section([wl], wl_range=(5040, 5045), margin=2)
+    assert (rows.start, rows.stop) == (1, 2)
+    inside = (wl[1] >= 5040) & (wl[1] <= 5045)
+    assert pixels.start == np.flatnonzero(inside)[0] - 2
+    assert pixels.stop == np.flatnonzero(inside)[-1] + 3
+
+    combine_spectra(files, directory=str(tmp_path), opfilename="full.fits")
+    combine_spectra(files, directory=str(tmp_path), opfilename="part.fits",
+                    wl_range=(5040, 5045))
+    rows, pixels = spectral_section([wl], wl_range=(5040, 5045))
+    full = fits.getdata(tmp_path / "full.fits", ext=1)
+    part = fits.getdata(tmp_path / "part.fits", ext=1)
+    assert part.shape == (rows.stop - rows.start, pixels.stop - pixels.start)
+    assert np.allclose(part, full[rows, pixels])
+    assert 'section' in str(fits.getheader(tmp_path / "part.fits")['HISTORY'])
+
+
+def test_combine_spectra_rest_frame(tmp_path, make_spectrum):
+    files = []
+    for index, velocity in enumerate((-3.0, 0.0, 5.0)):
+        fname = tmp_path / "spec{}.fits".format(index)
+        make_spectrum(fname, seed=index)
+        fits.setval(fname, 'CCFRVMOD', value=velocity, ext=1)
+        files.append(fname)
+    combine_spectra(files, directory=str(tmp_path), opfilename="rest.fits",
+                    velocity='CCFRVMOD')
+    with fits.open(tmp_path / "rest.fits") as hdul:
+        lnwl = np.log(hdul['SCIWAVE'].data)
+        steps = np.diff(lnwl, axis=1)[np.isfinite(np.diff(lnwl, axis=1))]
+        assert np.allclose(steps, steps[0])
+        assert np.isfinite(hdul['SCIFLUX'].data[np.isfinite(lnwl)]).all()
+        assert 'rest frame' in str(hdul[0].header['HISTORY'])
+
+# End
@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from ariastro.utils import clear_header_cache
+from ariastro.utils import get_header
+from ariastro.utils import header_cache_info
+
+
+def test_get_header_is_cached_and_copied(tmp_path):
+    fname = tmp_path / "frame.fits"
+    header = fits.Header({'OBJECT': 'first'})
+    fits.writeto(fname, np.zeros((2, 2)), header=header)
+    clear_header_cache()
+
+    first = get_header(fname)
+    first['OBJECT'] = 'modified'
+    second = get_header(fname, ext=0)
+    assert second['OBJECT'] == 'first'
+    assert header_cache_info().hits == 1
+
+    # A rewritten file is parsed again.
+    header['OBJECT'] = 'second'
+    fits.writeto(fname, np.zeros((2, 2)), header=header, overwrite=True)
+    stat = os.stat(fname)
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert get_header(fname)['OBJECT'] == 'second'
+
+# End
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ariastro.spectral_utils import combine_spectra
+from ariastro.wlmask import WavelengthMask
+from ariastro.wlmask import MIN_WAVELENGTH
+
+
+def elementwise(wl, intervals):
+    mask = np.zeros(wl.shape, dtype=bool)
+    for lo, hi in intervals:
+        mask |= (wl >= lo) & (wl < hi)
+    return mask
+
+
+def test_ranges_match_elementwise():
+    rng = np.random.default_rng(12)
+    wl = np.linspace(4000, 7000, 3 * 2000).reshape(3, 2000)
+    lo = rng.uniform(3990, 7010, 200)
+    intervals = np.column_stack([lo, lo + rng.uniform(0, 3, 200)])
+    wlmask = WavelengthMask(intervals)
+    assert len(wlmask) <= 200
+    assert np.array_equal(wlmask.mask(wl), elementwise(wl, intervals))
+    # The ranges of a grid are computed once.
+    assert wlmask.ranges(wl.copy()) is wlmask.ranges(wl)
+
+    # Padding and NaNs fall back to the comparison.
+    wl[0, :10] = 0.0
+    wl[1, -5:] = 0.0
+    wl[2, 100] = np.nan
+    assert np.array_equal(wlmask.mask(wl), elementwise(wl, intervals))
+    padding = WavelengthMask([(-np.inf, MIN_WAVELENGTH)])
+    assert np.array_equal(padding.mask(wl), wl < MIN_WAVELENGTH)
+
+    flux = np.ones(wl.shape)
+    wlmask.apply(flux, wl)
+    assert np.array_equal(np.isnan(flux), elementwise(wl, intervals))
+
+    with pytest.raises(ValueError):
+        WavelengthMask([(5000, 4000)])
+
+
+def test_combine_spectra_masks_intervals(tmp_path, make_spectrum):
+    files = []
+    for index in range(3):
+        fname = tmp_path / "spec{}.fits".format(index)
+        make_spectrum(fname, seed=index)
+        files.append(fname)
+    linelist = tmp_path / "tellurics.txt"
+    np.savetxt(linelist, [(5020.0, 5025.0), (5070.0, 5071.0)])
+    combine_spectra(files, directory=str(tmp_path), opfilename="masked.fits",
+                    wl_mask=str(linelist))
+    with fits.open(tmp_path / "masked.fits") as hdul:
+        wl = hdul['SCIWAVE'].data
+        expected = elementwise(wl, [(5020.0, 5025.0), (5070.0, 5071.0)])
+        assert np.array_equal(np.isnan(hdul['SCIFLUX'].data), expected)
+        assert 'masked 2' in str(hdul[0].header['HISTORY'])
+
+
+def test_combine_spectra_masks_reference_grid_once(tmp_path, make_spectrum,
+                                                   monkeypatch):
+    files = []
+    for index in range(3):
+        fname = tmp_path / "spec{}.fits".format(index)
+        make_spectrum(fname, shift=0.3 * index, seed=index)
+        files.append(fname)
+    intervals = [(5020.0, 5025.0), (5070.0, 5071.0)]
+    wlmask = WavelengthMask(intervals)
+    calls = []
+    row_ranges = wlmask._row_ranges
+    monkeypatch.setattr(wlmask, '_row_ranges',
+                        lambda row: calls.append(1) or row_ranges(row))
+    combine_spectra(files, directory=str(tmp_path), opfilename="masked.fits",
+                    wl_mask=wlmask)
+    # The epochs have their own grids, but are masked once on the
+    # reference grid (shared by the three fibers): one call per order.
+    assert len(calls) == 3
+    with fits.open(tmp_path / "masked.fits") as hdul:
+        wl = hdul['SKYWAVE'].data
+        assert np.array_equal(np.isnan(hdul['SKYFLUX'].data),
+                              elementwise(wl, intervals))
+
+# End